@@ -0,0 +1,57 @@
+"""Benchmarks of the API's handling of the analysis requests."""
+import copy
+import gzip
+
+from benchmarks.suite import benchmark
+from nmma_api.simulator.synthetic import synthetic_request
+
+NB_POINTS = [10, 100, 1000]
+
+
+@benchmark(nb_points=NB_POINTS)
+def decode_request(nb_points):
+    from nmma_api.services.api import REQUEST_SCHEMA
+    from nmma_api.utils.codec import decode, dumps
+
+    request = synthetic_request(0, nb_points=nb_points)
+    request["callback_url"] = "http://localhost"
+    body = dumps(request)
+    return lambda: decode(body, REQUEST_SCHEMA)
+
+
+@benchmark(nb_points=NB_POINTS, masked_fraction=[0.0, 0.3])
+def validate(nb_points, masked_fraction):
+    from nmma_api.services.api import validate
+
+    request = synthetic_request(0, nb_points=nb_points, masked_fraction=masked_fraction)
+    request["callback_url"] = "http://localhost"
+    return lambda: validate(request)
+
+
+@benchmark(nb_points=NB_POINTS)
+def mongify(nb_points):
+    from nmma_api.services.api import mongify
+
+    request = synthetic_request(0, nb_points=nb_points)
+    # mongify compresses the inputs in place
+    return lambda: mongify({**request, "inputs": copy.copy(request["inputs"])})
+
+
+@benchmark(nb_points=NB_POINTS)
+def gzip_roundtrip(nb_points):
+    photometry = synthetic_request(0, nb_points=nb_points)["inputs"]["photometry"]
+    # compressed by the API (mongify), decompressed when preparing the analysis
+    return lambda: gzip.decompress(gzip.compress(str(photometry).encode())).decode()
+
+
+@benchmark(model=["Me2017", "Bu2022Ye"], filter=["ztfg", "sdssg"])
+def verify_and_match_filter(model, filter):
+    from nmma_api.tools.enums import verify_and_match_filter
+
+    def match():
+        try:
+            verify_and_match_filter(model, filter)
+        except ValueError:
+            pass
+
+    return match
@@ -0,0 +1,49 @@
+"""Benchmarks of the preparation of the jobs, and the packaging of their results."""
+import os
+import tempfile
+
+from benchmarks.suite import benchmark
+from nmma_api.simulator.synthetic import synthetic_outputs, synthetic_request
+
+
+@benchmark(nb_points=[10, 100, 1000], model=["Me2017", "Bu2022Ye"])
+def prepare_analysis(nb_points, model):
+    from nmma_api.services.api import mongify
+    from nmma_api.tools.analysis import prepare_analysis
+
+    analysis = mongify(synthetic_request(0, model=model, nb_points=nb_points))
+    data_dir = tempfile.mkdtemp(prefix="nmma_bench_")
+    # decompresses the photometry and writes the .dat file expected by NMMA
+    return lambda: prepare_analysis(analysis, data_dir)
+
+
+def write_outputs(analysis: dict, nb_samples: int) -> str:
+    """Write synthetic outputs of an analysis to a temporary directory."""
+    from nmma_api.tools.analysis import analysis_label
+
+    LABEL = analysis_label(analysis)
+    output_dir = tempfile.mkdtemp(prefix="nmma_bench_")
+    for suffix, data in synthetic_outputs(nb_samples, seed=0).items():
+        with open(os.path.join(output_dir, f"{LABEL}{suffix}"), "wb") as f:
+            f.write(data)
+    return output_dir
+
+
+@benchmark(nb_samples=[1000, 10000, 100000])
+def package_results(nb_samples):
+    from nmma_api.tools.analysis import package_results
+
+    analysis = synthetic_request(0)
+    output_dir = write_outputs(analysis, nb_samples)
+    return lambda: package_results(analysis, output_dir)
+
+
+@benchmark(nb_samples=[1000, 10000, 100000])
+def encode_results(nb_samples):
+    from nmma_api.tools.analysis import package_results
+    from nmma_api.tools.webhook import encode_body
+
+    analysis = synthetic_request(0)
+    results = package_results(analysis, write_outputs(analysis, nb_samples))
+    # the streamed body of the upload to the webhook
+    return lambda: b"".join(encode_body(results, "http://localhost")[0])
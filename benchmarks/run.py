@@ -0,0 +1,177 @@
+"""
+Run the benchmarks of the ingestion and job preparation hot paths, offline,
+store their results as JSON and compare them with a previous run:
+
+    make bench
+    make bench ARGS="--filter=package_results --compare=<commit or results file>"
+
+The results are stored in benchmarks/results/<commit>.json (<commit>-dirty with
+uncommitted changes). Only compare results obtained on the same machine.
+"""
+import glob
+import importlib
+import json
+import os
+import pkgutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import timeit
+from datetime import datetime
+
+import fire
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+
+
+def git_revision() -> str:
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=BENCHMARKS_DIR, capture_output=True, text=True
+        ).stdout.strip()
+
+    revision = git("rev-parse", "--short", "HEAD") or "unknown"
+    if git("status", "--porcelain", "--untracked-files=no"):
+        revision += "-dirty"
+    return revision
+
+
+def use_synthetic_models_metadata(directory: str):
+    """Load the models metadata from a synthetic cache, rather than from the network."""
+    from nmma_api.simulator.synthetic import synthetic_models_metadata
+    from nmma_api.tools import models_metadata
+
+    models_metadata.cache_path = os.path.join(directory, "models.json")
+    models_metadata.write_entry(models_metadata.cache_path, synthetic_models_metadata())
+
+
+def load_benchmarks() -> list:
+    from benchmarks.suite import BENCHMARKS
+
+    for module in pkgutil.iter_modules([BENCHMARKS_DIR]):
+        if module.name.startswith("bench_"):
+            importlib.import_module(f"benchmarks.{module.name}")
+    return BENCHMARKS
+
+
+def time_case(setup, params: dict, repeat: int) -> dict:
+    """Time a benchmark case, in seconds per call."""
+    func = setup(**params)
+    # the first call is not timed (imports, caches)
+    func()
+    timer = timeit.Timer(func)
+    # at least 0.2s per repetition, to keep the timer's resolution negligible
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def previous_results(compare: str, current: str) -> dict:
+    """The results to compare with: a results file, a commit, or by default the latest other run."""
+    if compare is None:
+        paths = [
+            path
+            for path in glob.glob(os.path.join(RESULTS_DIR, "*.json"))
+            if os.path.abspath(path) != os.path.abspath(current)
+        ]
+        if len(paths) == 0:
+            return None
+        compare = max(paths, key=os.path.getmtime)
+    elif not os.path.exists(compare):
+        compare = os.path.join(RESULTS_DIR, f"{compare}.json")
+    with open(compare) as f:
+        return json.load(f)
+
+
+def run(
+    filter: str = None,
+    repeat: int = 5,
+    compare: str = None,
+    threshold: float = 0.1,
+    save: bool = True,
+):
+    """
+    Run the benchmarks, printing their median time per call.
+
+    Parameters
+    ----------
+    filter : str, optional
+        Only run the benchmarks whose name contains this string.
+    repeat : int, optional
+        Number of timed repetitions of each benchmark, by default 5.
+    compare : str, optional
+        A results file or commit to compare with, by default the latest other run.
+    threshold : float, optional
+        Relative change of the median reported as a regression or improvement, by default 10%.
+    save : bool, optional
+        Store the results in benchmarks/results, by default True.
+    """
+    revision = git_revision()
+    path = os.path.join(RESULTS_DIR, f"{revision}.json")
+    results = {
+        "revision": revision,
+        "date": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+    }
+    measured = {}
+
+    with tempfile.TemporaryDirectory(prefix="nmma_bench_") as directory:
+        # all the files written by the benchmarks go to the temporary directory
+        tempfile.tempdir = directory
+        use_synthetic_models_metadata(directory)
+        for benchmark in load_benchmarks():
+            for name, params in benchmark.cases():
+                if filter and filter not in name:
+                    continue
+                result = time_case(benchmark.setup, params, repeat)
+                measured[name] = result
+                print(f"{name:<60} {format_time(result['median']):>10}", flush=True)
+        tempfile.tempdir = None
+
+    if save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        # a partial (filtered) run updates the results of its benchmarks only
+        results["benchmarks"] = measured
+        if os.path.exists(path):
+            with open(path) as f:
+                results["benchmarks"] = {**json.load(f)["benchmarks"], **measured}
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults saved to {os.path.relpath(path)}")
+
+    previous = previous_results(compare, path)
+    if previous is None:
+        return
+    print(f"\nCompared with {previous['revision']} ({previous['date']}):")
+    for name, result in measured.items():
+        before = previous["benchmarks"].get(name)
+        if before is None:
+            continue
+        change = result["median"] / before["median"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "slower"
+        elif change < -threshold:
+            flag = "faster"
+        print(
+            f"{name:<60} {format_time(before['median']):>10} -> {format_time(result['median']):>10} {change:+7.1%} {flag}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,41 @@
+"""
+Registry of the benchmarks: each module of this package declares its benchmarks
+with the `benchmark` decorator, and `benchmarks/run.py` times them.
+"""
+import itertools
+from typing import Callable, NamedTuple
+
+BENCHMARKS = []
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # called with each combination of the parameters (untimed), returns the function to time
+    setup: Callable
+    params: dict
+
+    def cases(self):
+        """The name and parameters of each combination of the parameters."""
+        keys = list(self.params)
+        for values in itertools.product(*(self.params[key] for key in keys)):
+            params = dict(zip(keys, values))
+            suffix = ",".join(f"{key}={value}" for key, value in params.items())
+            yield (f"{self.name}[{suffix}]" if suffix else self.name), params
+
+
+def benchmark(**params):
+    """
+    Declare a benchmark, parametrized by lists of values, e.g.:
+
+        @benchmark(nb_points=[10, 100])
+        def validate(nb_points):
+            request = synthetic_request(0, nb_points=nb_points)
+            return lambda: api.validate(request)
+    """
+
+    def register(setup: Callable) -> Callable:
+        module = setup.__module__.rsplit(".", 1)[-1].removeprefix("bench_")
+        BENCHMARKS.append(Benchmark(f"{module}.{setup.__name__}", setup, params))
+        return setup
+
+    return register
@@ -1,18 +1,33 @@
 import os
 import gzip
-import json
 import traceback
 from datetime import datetime
-from astropy.table import Table, unique
 
-import tornado.escape
+import tornado.ioloop
 import tornado.web
 
+from nmma_api.utils.codec import DecodeError, Field, SchemaError, decode
 from nmma_api.utils.config import load_config
-from nmma_api.utils.logs import make_log
+from nmma_api.utils.dates import parse_datetime
+from nmma_api.utils.logs import install_sigterm_flush, make_log
 from nmma_api.utils.mongo import Mongo, init_db
-from nmma_api.tools.expanse import validate_credentials
-from nmma_api.tools.enums import verify_and_match_filter
+from nmma_api.utils.profiling import install_toggle, profiled
+from nmma_api.tools.admission import (
+    admission_state,
+    admit,
+    record_admission,
+    retry_after,
+)
+from nmma_api.tools.backend import backend_name, configured_backends, get_backend
+from nmma_api.tools.breaker import breakers
+from nmma_api.tools.enums import (
+    ALLOWED_MODELS,
+    model_registry,
+    verify_and_match_filter,
+)
+from nmma_api.tools.lifecycle import event
+from nmma_api.tools.photometry import compaction_options
+from nmma_api.tools.posterior import posterior_options
 
 log = make_log("main")
 
@@ -20,28 +35,51 @@ config = load_config()
 
 mongo = Mongo(**config["database"])
 
-ALLOWED_MODELS = ["Me2017", "Piro2021", "nugent-hyper", "TrPi2018", "Bu2022Ye"]
-REQUEST_REQUIRED_KEYS = ["inputs", "callback_url", "callback_method"]
+# the structure of the analysis requests, checked when decoding them (see `decode`)
+REQUEST_SCHEMA = {
+    "inputs": Field(
+        dict,
+        schema={
+            "photometry": Field(str, required=False),
+            "redshift": Field((str, int, float), required=False),
+            "analysis_parameters": Field(
+                dict, required=False, schema={"source": Field(str, required=False)}
+            ),
+        },
+    ),
+    "callback_url": Field(str),
+    "callback_method": Field(str),
+}
 
 
 def validate(data: dict) -> str:
-    """Validate the data_dict to make sure it has the required keys and the model is allowed."""
-    missing_keys = [key for key in REQUEST_REQUIRED_KEYS if key not in data]
-    if len(missing_keys) > 0:
-        return f"missing required key(s) {missing_keys} in data_dict"
-
-    if "inputs" not in data:
-        return "missing inputs key in data_dict"
+    """
+    Validate the contents of a data_dict decoded with the REQUEST_SCHEMA,
+    to make sure the model is allowed and the photometry can be analyzed.
+    """
+    if data["callback_method"] != "POST":
+        return (
+            f"callback_method {data['callback_method']} is not supported, must be POST"
+        )
 
     model = data["inputs"].get("analysis_parameters", {}).get("source", None)
     if model is None:
         return "model not specified in data_dict.inputs.analysis_parameters"
     elif model not in ALLOWED_MODELS:
         return (
-            f"model {model} is not allowed, must be one of: {ALLOWED_MODELS.join(',')}"
+            f"model {model} is not allowed, must be one of: {', '.join(ALLOWED_MODELS)}"
         )
 
+    try:
+        posterior_options(data)
+        compaction_options(data)
+    except ValueError as e:
+        return str(e)
+
     if "photometry" in data["inputs"]:
+        # astropy is slow to import, only load it once we get a request
+        from astropy.table import Table, unique
+
         if (
             isinstance(data["inputs"]["photometry"], str)
             and len(data["inputs"]["photometry"]) > 0
@@ -89,6 +127,10 @@ def mongify(data: dict) -> dict:
     return data
 
 
+def validate_backend(name: str) -> bool:
+    return get_backend(name).validate_credentials()
+
+
 class MainHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
         self.set_header("Content-Type", "application/json")
@@ -100,6 +142,8 @@ class MainHandler(tornado.web.RequestHandler):
     def get(self):
         self.write({"status": "active"})
 
+    # the other threads (e.g. the health checks) are not part of the request
+    @profiled("api", count=1, all_threads=False)
     def post(self):
         """
         Analysis endpoint which sends the `data_dict` off for
@@ -109,71 +153,116 @@ class MainHandler(tornado.web.RequestHandler):
         """
 
         try:
-            data_dict = tornado.escape.json_decode(self.request.body)
-        except json.decoder.JSONDecodeError:
+            # parsed and checked against the REQUEST_SCHEMA in one pass
+            data_dict = decode(self.request.body, REQUEST_SCHEMA)
+        except DecodeError:
             err = traceback.format_exc()
             log(f"JSON decode error: {err}")
             return self.error(400, "Invalid JSON")
+        except SchemaError as e:
+            log(f"Validation error: {e}")
+            return self.error(400, str(e))
+
+        # before the validation, which parses the photometry: cheap backpressure
+        decision = admit(backend_name(data_dict))
+        if not decision.admitted:
+            log(f"Rejected analysis: {decision.message}", level="warning")
+            self.set_header("Retry-After", str(retry_after))
+            return self.error(429, decision.message)
 
-        # validate
         err = validate(data_dict)
         if err is not None:
             log(f"Validation error: {err}")
             return self.error(400, err)
 
+        # stored as a BSON date, so that expired webhooks can be queried server-side
+        if data_dict.get("invalid_after") not in [None, ""]:
+            try:
+                data_dict["invalid_after"] = parse_datetime(data_dict["invalid_after"])
+            except ValueError:
+                log(
+                    f"Validation error: invalid invalid_after {data_dict['invalid_after']}"
+                )
+                return self.error(400, "invalid_after is not a valid date")
+
         # insert into database
         data = {
             **data_dict,
             "status": "pending",
             "created_at": datetime.timestamp(datetime.utcnow()),
+            "events": [event("pending")],
         }
         data = mongify(data)
         mongo.insert_one("analysis", data)
+        # only now, so that the rejected requests don't count toward the backlog
+        record_admission()
 
-        return self.write(
-            {
-                "status": "pending",
-                "message": "nmma_analysis_service: analysis submitted",
-            }
-        )
+        response = {
+            "status": "pending",
+            "message": "nmma_analysis_service: analysis submitted",
+        }
+        if decision.deferred:
+            response["message"] += f" ({decision.message})"
+            response["deferred"] = True
+        return self.write(response)
 
 
 class HealthHandler(tornado.web.RequestHandler):
-    def get(self):
+    async def get(self):
         # check if the database is up
         health = {
             "database": True,
-            "expanse": True,
         }
         try:
             mongo.db.command("ping")
         except Exception:
             health["database"] = False
 
-        # check if the expanse credentials are valid
-        try:
-            valid = validate_credentials()
-            if not valid:
-                health["expanse"] = False
-        except Exception:
-            health["expanse"] = False
+        # check if the backends (e.g. the expanse credentials) are valid
+        # (in a thread, as connecting to a backend can take a while)
+        loop = tornado.ioloop.IOLoop.current()
+        for name in configured_backends():
+            try:
+                health[name] = await loop.run_in_executor(None, validate_backend, name)
+            except Exception:
+                health[name] = False
 
         self.write(health)
         self.set_status(200)
 
 
+class BreakersHandler(tornado.web.RequestHandler):
+    def get(self):
+        # state of the circuit breaker of each callback host, for monitoring
+        self.write({"breakers": breakers()})
+        self.set_status(200)
+
+
+class AdmissionHandler(tornado.web.RequestHandler):
+    def get(self):
+        # analyses waiting and jobs in flight, against the admission limits, for monitoring
+        self.write({"admission": admission_state()})
+        self.set_status(200)
+
+
 def make_app():
     return tornado.web.Application(
         [
             (r"/analysis", MainHandler),
             (r"/health", HealthHandler),
+            (r"/breakers", BreakersHandler),
+            (r"/admission", AdmissionHandler),
             (r"/", HealthHandler),
         ]
     )
 
 
-if __name__ == "__main__":
+def start() -> tornado.web.Application:
+    """Initialize the database, and start listening (on the current event loop)."""
     init_db(config)
+    # load sncosmo and the models metadata (downloaded if there is no cache nor snapshot)
+    # now, rather than blocking the event loop on the first request
+    model_registry()
     app = make_app()
     if os.environ.get("USE_HEROKU") == str(1):
         port = int(os.environ.get("PORT"))
@@ -182,4 +271,11 @@ if __name__ == "__main__":
         port = config["ports"]["api"]
     app.listen(port)
     log(f"NMMA Service Listening on port {port}")
+    return app
+
+
+if __name__ == "__main__":
+    install_toggle()
+    install_sigterm_flush()
+    start()
     tornado.ioloop.IOLoop.current().start()
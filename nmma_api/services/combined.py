@@ -0,0 +1,94 @@
+"""
+Run the API and the submission, retrieval and delivery queues in a single process,
+on one event loop: an alternative to the one-process-per-service layout of
+supervisor.conf, for small hosts (e.g. a Heroku dyno).
+
+The services share the scientific stack, the Mongo client (see `shared_client`),
+the backends and their connections (e.g. the SSH connection to Expanse) and the
+packaging processes. The queue cycles, which are blocking, run in a shared
+thread pool, also used by the API for its blocking work (e.g. the health checks).
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple
+
+from nmma_api.services import (
+    api,
+    delivery_queue,
+    retrieval_queue,
+    submission_queue,
+)
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import install_sigterm_flush, make_log
+from nmma_api.utils.profiling import install_toggle, profiled
+
+log = make_log("combined")
+
+config = load_config()
+
+executor_workers = (config.get("combined") or {}).get("executor_workers", 8)
+
+
+class Queue(NamedTuple):
+    name: str
+    # blocking, returns the number of analyses (or deliveries) it found
+    cycle: Callable
+    # how long to wait after a cycle, given what it returned, in seconds
+    wait_time: Callable
+
+
+QUEUES = [
+    Queue(
+        "submission_queue",
+        submission_queue.submission_cycle,
+        lambda count: submission_queue.submission_wait_time,
+    ),
+    Queue(
+        "retrieval_queue",
+        retrieval_queue.retrieval_cycle,
+        lambda count: retrieval_queue.retrieval_wait_time,
+    ),
+    Queue(
+        "delivery_queue",
+        delivery_queue.delivery_cycle,
+        delivery_queue.wait_time,
+    ),
+]
+
+
+def run_cycle(queue: Queue) -> int:
+    with profiled(queue.name) as profile:
+        profile.count = queue.cycle()
+    return profile.count
+
+
+async def run_queue(queue: Queue):
+    """Run the cycles of a queue forever, each in the shared thread pool."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            count = await loop.run_in_executor(None, run_cycle, queue)
+        except Exception as e:
+            log(f"{queue.name} cycle failed: {e}", level="error")
+            count = 0
+        await asyncio.sleep(queue.wait_time(count or 0))
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(executor_workers, thread_name_prefix="combined")
+    )
+    # blocking, but only once, before serving
+    submission_queue.setup()
+    retrieval_queue.setup()
+    delivery_queue.setup()
+    api.start()
+    log(f"Running {', '.join(queue.name for queue in QUEUES)} and the API")
+    await asyncio.gather(*(run_queue(queue) for queue in QUEUES))
+
+
+if __name__ == "__main__":
+    install_toggle()
+    install_sigterm_flush()
+    asyncio.run(main())
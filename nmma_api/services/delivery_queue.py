@@ -0,0 +1,140 @@
+import collections
+import os
+import socket
+import threading
+import time
+
+from nmma_api.tools import breaker
+from nmma_api.tools.outbox import (
+    claim,
+    create_indexes,
+    expire,
+    finish,
+    record_attempt,
+    release,
+)
+from nmma_api.tools.webhook import WebhookDispatcher, callback_host, max_concurrency
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import install_sigterm_flush, make_log
+
+log = make_log("delivery_queue")
+
+config = load_config()
+
+delivery_wait_time = config["wait_times"].get("delivery", 5)
+
+worker = f"{socket.gethostname()}:{os.getpid()}"
+dispatcher = WebhookDispatcher()
+# one slot per delivery in flight, released once its attempt is recorded
+slots = threading.BoundedSemaphore(max_concurrency)
+# deliveries in flight per callback host, capped at breaker.max_in_flight_per_host
+in_flight = collections.Counter()
+in_flight_lock = threading.Lock()
+
+
+def release_slot(host: str):
+    with in_flight_lock:
+        in_flight[host] -= 1
+    slots.release()
+
+
+def deliver(entry: dict, host: str):
+    """Make one attempt at sending a claimed delivery, recording it once done."""
+    start = time.time()
+
+    def callback(uploaded, error):
+        try:
+            breaker.record(host, uploaded)
+            record_attempt(entry, worker, uploaded, error, time.time() - start)
+        finally:
+            release_slot(host)
+
+    # the retries are scheduled through the outbox, so that they survive restarts
+    dispatcher.dispatch(entry["results"], entry, callback=callback, attempts=1)
+
+
+def delivery_cycle() -> int:
+    """Claim and start sending the deliveries due, while slots are free, returning how many."""
+    expire()
+    nb_claimed = 0
+    # hosts whose breaker is open, or being probed
+    blocked = breaker.blocked_hosts()
+    while slots.acquire(blocking=False):
+        with in_flight_lock:
+            busy = [
+                host
+                for host, count in in_flight.items()
+                if count >= breaker.max_in_flight_per_host
+            ]
+        entry = claim(worker, excluded_hosts=blocked + busy)
+        if entry is None:
+            slots.release()
+            break
+
+        host = entry.get("callback_host") or callback_host(entry["callback_url"])
+        if entry["callback_method"] != "POST":
+            # can't ever be delivered: fail it now, without retries nor tripping the breaker
+            # (the API rejects these, but they may have been stored before it did)
+            error = f"callback method {entry['callback_method']} not supported"
+            log(
+                f"Delivery {entry['_id']} failed: {error}",
+                level="warning",
+                analysis_id=entry.get("analysis_id"),
+            )
+            finish(entry, worker, "failed", entry["status_on_failure"], error=error)
+            slots.release()
+            nb_claimed += 1
+            continue
+
+        if not breaker.allow(host, worker):
+            release(entry, worker)
+            slots.release()
+            blocked.append(host)
+            continue
+
+        nb_claimed += 1
+        with in_flight_lock:
+            in_flight[host] += 1
+        try:
+            deliver(entry, host)
+        except Exception as e:
+            log(
+                f"Failed to start delivery {entry['_id']}: {e}",
+                level="error",
+                analysis_id=entry.get("analysis_id"),
+            )
+            release_slot(host)
+    return nb_claimed
+
+
+def setup():
+    create_indexes()
+    log(
+        f"Delivering with at most {max_concurrency} uploads in flight, {breaker.max_in_flight_per_host} per callback host"
+    )
+
+
+def wait_time(nb_claimed: int) -> float:
+    """How long to wait after a cycle that claimed `nb_claimed` deliveries, in seconds."""
+    if nb_claimed == 0:
+        return delivery_wait_time
+    # more deliveries may be due, claim them as soon as slots free up
+    return 0.1
+
+
+def delivery_queue():
+    """Deliver the results in the outbox to the webhooks."""
+    install_sigterm_flush()
+    setup()
+    while True:
+        try:
+            nb_claimed = delivery_cycle()
+        except Exception as e:
+            log(f"Failed to deliver analysis results: {e}", level="error")
+            nb_claimed = 0
+
+        time.sleep(wait_time(nb_claimed))
+
+
+if __name__ == "__main__":
+    delivery_queue()
@@ -1,11 +1,21 @@
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-from nmma_api.tools.expanse import retrieve, cancel_job  # noqa 401
-from nmma_api.tools.webhook import upload_analysis_results
+from pymongo import ASCENDING
+
+from nmma_api.tools.analysis import package_results
+from nmma_api.tools.backend import configured_backends, get_backend
+from nmma_api.tools.lifecycle import event, push_events, transition
+from nmma_api.tools.outbox import enqueue
+from nmma_api.tools.polling import next_check_at, time_limit
 from nmma_api.utils.config import load_config
-from nmma_api.utils.logs import make_log
+from nmma_api.utils.logs import install_sigterm_flush, make_log
+from nmma_api.utils.migrations import migrate_dates
 from nmma_api.utils.mongo import Mongo
+from nmma_api.utils.pipeline import Stage, run_pipeline
+from nmma_api.utils.profiling import install_toggle, profiled
 
 log = make_log("retrieval_queue")
 
@@ -13,174 +23,334 @@ config = load_config()
 
 mongo = Mongo(**config["database"])
 retrieval_wait_time = config["wait_times"]["retrieval"]
-max_upload_failures = config["wait_times"].get("max_upload_failures", 10)
-time_limit = config["expanse"].get("time_limit", 6) * 3600  # in seconds
 
 if time_limit > 24 * 3600:
     raise ValueError("time_limit cannot be greater than 24 hours")
 if time_limit < 3600:
     raise ValueError("time_limit cannot be less than 1 hour")
 
+# the completed analyses go through a pipeline: their outputs are fetched (I/O, threads),
+# packaged (CPU, processes), then handed over to the delivery queue (I/O, threads)
+pipeline_config = config.get("retrieval_pipeline") or {}
+fetch_workers = pipeline_config.get("fetch_workers", 4)
+package_processes = pipeline_config.get("package_processes", 2)
+persist_workers = pipeline_config.get("persist_workers", 1)
+queue_size = pipeline_config.get("queue_size", 8)
 
-def retrieval_queue():
-    """Retrieve analysis results from expanse."""
-    while True:
+_package_pool = None
+
+
+def package_pool() -> ProcessPoolExecutor:
+    """The process pool packaging the results, started on first use and kept across cycles."""
+    global _package_pool
+    if _package_pool is None:
+        # spawn rather than fork, as the pipeline threads may hold locks when forking
+        _package_pool = ProcessPoolExecutor(
+            max_workers=package_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _package_pool
+
+
+def import_packaging_modules(_=None):
+    import arviz  # noqa: F401
+    import joblib  # noqa: F401
+    from astropy.table import Table  # noqa: F401
+
+
+def warm_up_package_pool():
+    """Start the packaging processes and import their heavy modules ahead of the first results."""
+    if package_processes > 0:
+        list(package_pool().map(import_packaging_modules, range(package_processes)))
+
+
+def fetch(analysis: dict):
+    """Pipeline stage: fetch the outputs of an analysis, if it has completed."""
+    local_dir = get_backend(analysis.get("backend")).fetch(analysis)
+    if local_dir is None:
+        log(
+            f"Analysis {analysis['_id']} has not completed yet. Skipping.",
+            analysis_id=analysis["_id"],
+            job_id=analysis.get("job_id"),
+        )
+        mongo.db.analysis.update_one(
+            {"_id": analysis["_id"]},
+            {"$set": {"next_check_at": next_check_at(analysis)}},
+        )
+        return None
+    # recorded along with the next transition, to tell the job and the retrieval apart
+    analysis["fetched_at"] = datetime.utcnow()
+    return analysis, local_dir
+
+
+def package(fetched: tuple):
+    """Pipeline stage: package the results of an analysis from its outputs."""
+    analysis, local_dir = fetched
+    log(
+        f"Packaging results for analysis {analysis['_id']} ({analysis['resource_id']}, {analysis['created_at']})",
+        analysis_id=analysis["_id"],
+        job_id=analysis.get("job_id"),
+    )
+    if package_processes > 0:
+        results = package_pool().submit(package_results, analysis, local_dir).result()
+    else:
+        results = package_results(analysis, local_dir)
+    if results is None:
+        log(
+            f"Analysis {analysis['_id']} outputs are incomplete. Skipping.",
+            level="warning",
+            analysis_id=analysis["_id"],
+            job_id=analysis.get("job_id"),
+        )
+        return None
+    return analysis, results
+
+
+def persist(packaged: tuple):
+    """Pipeline stage: hand the results of an analysis over to the delivery queue."""
+    analysis, results = packaged
+    log(
+        f"Enqueuing results for delivery to the webhook for analysis {analysis['_id']} ({analysis['resource_id']}, {analysis['created_at']})",
+        analysis_id=analysis["_id"],
+        job_id=analysis.get("job_id"),
+        # from the submission of the job to its results being ready
+        duration=datetime.timestamp(datetime.utcnow()) - analysis["submitted_at"]
+        if analysis.get("submitted_at")
+        else None,
+    )
+    # the delivery queue uploads the results and sets the final status
+    enqueue(
+        analysis,
+        results,
+        status_on_delivery="completed",
+        status_on_failure="failed_upload",
+    )
+    events = [event("uploading")]
+    if analysis.get("fetched_at") is not None:
+        events.insert(0, event("fetched", at=analysis["fetched_at"]))
+    mongo.db.analysis.update_one(
+        {"_id": analysis["_id"]},
+        {"$set": {"status": "uploading"}, "$push": push_events(*events)},
+    )
+    mongo.db.results.delete_one({"analysis_id": analysis["_id"]})
+    # the outputs are not needed anymore: retries are delivered from the outbox
+    get_backend(analysis.get("backend")).release(analysis)
+    return analysis
+
+
+# analyses the retrieval queue is responsible for
+ACTIVE_STATUSES = [
+    "running",  # analysis is running on expanse
+    "running_plot",  # analysis ran for too long, plot are being generated from checkpoints
+    "retry_upload",  # analysis retrieved before the outbox existed, its results are to be enqueued
+    "failed_submission_to_upload",  # analysis failed to submit to expanse (didn't start at all)
+]
+
+
+def cancel_jobs(analyses: list):
+    for analysis in analyses:
+        if analysis.get("job_id") is not None:
+            get_backend(analysis.get("backend")).cancel(analysis["job_id"])
+
+
+def release_outputs(analyses: list):
+    """Free the local outputs of analyses that ended without their results being enqueued."""
+    for analysis in analyses:
         try:
-            # get the analysis requests that have been processed
-            analysis_requests = mongo.db.analysis.find(
+            get_backend(analysis.get("backend")).release(analysis)
+        except Exception as e:
+            log(
+                f"Failed to release the outputs of analysis {analysis['_id']}: {e}",
+                analysis_id=analysis["_id"],
+            )
+
+
+def expire_webhooks(now: datetime) -> int:
+    """Cancel the jobs of the analyses whose webhook has expired, and mark them as such."""
+    expired = list(
+        mongo.db.analysis.find(
+            {"status": {"$in": ACTIVE_STATUSES}, "invalid_after": {"$lt": now}},
+            {"job_id": 1, "backend": 1, "resource_id": 1, "created_at": 1},
+        )
+    )
+    if len(expired) == 0:
+        return 0
+    log(
+        f"{len(expired)} analyses webhook has expired. Skipping and deleting the results if they exist."
+    )
+    cancel_jobs(expired)
+    ids = [analysis["_id"] for analysis in expired]
+    mongo.db.analysis.update_many(
+        {"_id": {"$in": ids}, "status": {"$in": ACTIVE_STATUSES}},
+        transition("webhook_expired"),
+    )
+    mongo.db.results.delete_many({"analysis_id": {"$in": ids}})
+    release_outputs(expired)
+    return len(expired)
+
+
+def expire_jobs(now: datetime) -> int:
+    """
+    Cancel the jobs that ran past their deadline.
+
+    Analyses that ran for too long are set to job_expired, the submission queue will take
+    care of starting the plot generation job and setting the status to "running_plot".
+    If the plots have been generating for too long (an edge case), the analysis is set to
+    failed and that failure status is uploaded upstream.
+    """
+    timed_out = list(
+        mongo.db.analysis.find(
+            {
+                "status": {"$in": ["running", "running_plot"]},
+                "deadline_at": {"$lt": now},
+            },
+            {
+                "status": 1,
+                "job_id": 1,
+                "backend": 1,
+                "resource_id": 1,
+                "created_at": 1,
+                "callback_url": 1,
+                "callback_method": 1,
+                "invalid_after": 1,
+            },
+        )
+    )
+    if len(timed_out) == 0:
+        return 0
+    cancel_jobs(timed_out)
+
+    running = [a["_id"] for a in timed_out if a["status"] == "running"]
+    if running:
+        log(
+            f"{len(running)} analyses have been running for too long. Cancelled the jobs, starting plot generation jobs."
+        )
+        mongo.db.analysis.update_many(
+            {"_id": {"$in": running}, "status": "running"},
+            transition("job_expired"),
+        )
+
+    plotting = [a for a in timed_out if a["status"] == "running_plot"]
+    if plotting:
+        log(
+            f"{len(plotting)} analyses plot generation has been running for too long. Cancelled the jobs, setting them to failed."
+        )
+        for analysis in plotting:
+            enqueue(
+                analysis,
                 {
-                    "status": {
-                        "$in": [
-                            "running",  # analysis is running on expanse
-                            "running_plot",  # analysis ran for too long, plot are being generated from checkpoints
-                            "retry_upload",  # analysis has been retrieved but failed to upload back to the webhook
-                            "failed_submission_to_upload",  # analysis failed to submit to expanse (didn't start at all)
-                        ]
-                    }
-                }
+                    "status": "failure",
+                    "message": "analysis ran for too long, and failed to generate plots",
+                },
             )
-            analysis_requests = [x for x in analysis_requests]
+        mongo.db.analysis.update_many(
+            {"_id": {"$in": [a["_id"] for a in plotting]}, "status": "running_plot"},
+            transition("failed_plot"),
+        )
+        # (the jobs set to job_expired keep theirs, the plot generation resumes from them)
+        release_outputs(plotting)
+    return len(timed_out)
+
+
+def retrieval_cycle() -> int:
+    """Retrieve and process the running analyses, returning how many were found."""
+    now = datetime.utcnow()
+    # the expired webhooks and jobs are selected and transitioned server-side
+    expire_webhooks(now)
+    expire_jobs(now)
+    for name in configured_backends():
+        get_backend(name).cleanup()
+
+    # get the live analysis requests that have been processed, or are due for a check
+    analysis_requests = mongo.db.analysis.find(
+        {
+            "status": {"$in": ACTIVE_STATUSES},
+            "invalid_after": {"$not": {"$lt": now}},
+            "deadline_at": {"$not": {"$lt": now}},
+            # analyses without a schedule (not running, or submitted before it existed) are always due
+            "$or": [
+                {"next_check_at": {"$lte": datetime.timestamp(now)}},
+                {"next_check_at": None},
+            ],
+        }
+    )
+    analysis_requests = [x for x in analysis_requests]
+    log(f"Found {len(analysis_requests)} analysis requests to retrieve/process.")
+    # the analyses to fetch the results of, if they completed
+    to_fetch = []
+    for analysis in analysis_requests:
+        # analysis failed to submit to expanse, update the status upstream
+        if analysis["status"] == "failed_submission_to_upload":
             log(
-                f"Found {len(analysis_requests)} analysis requests to retrieve/process."
+                f"Analysis {analysis['_id']} failed to submit to expanse. Updating status upstream.",
+                level="warning",
+                analysis_id=analysis["_id"],
+            )
+            results = {
+                "status": "failure",
+                "message": analysis.get("error", "unknown error"),
+            }
+            enqueue(analysis, results)
+            mongo.db.analysis.update_one(
+                {"_id": analysis["_id"]},
+                transition("failed_submission"),
             )
-            for analysis in analysis_requests:
-                # webhook has expired, can't upload results upstream anymore
-                if (
-                    datetime.strptime(analysis["invalid_after"], "%Y-%m-%d %H:%M:%S.%f")
-                    < datetime.utcnow()
-                ):
-                    cancel_job(analysis.get("job_id", None))
-                    log(
-                        f"Analysis {analysis['_id']} webhook has expired. Skipping and deleting the results if they exist."
-                    )
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis["_id"]},
-                        {"$set": {"status": "webhook_expired"}},
-                    )
-
-                    try:
-                        mongo.db.results.delete_one({"analysis_id": analysis["_id"]})
-                    except Exception:
-                        pass
-                    continue
-
-                # analysis has been running for too long, cancel the job and set the status to job_expired
-                # the submission queue will take care of starting the plot generation job
-                # and setting the status to "running_plot"
-                if analysis["status"] == "running" and analysis.get(
-                    "submitted_at"
-                ) + time_limit < datetime.timestamp(datetime.utcnow()):
-                    log(
-                        f"Analysis {analysis['_id']} has been pending for too long. Cancelling the job and starting plot generation job."
-                    )
-                    cancel_job(analysis.get("job_id", None))
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis["_id"]},
-                        {"$set": {"status": "job_expired"}},
-                    )
-                    continue
-
-                # analysis failed to submit to expanse, update the status upstream
-                if analysis["status"] == "failed_submission_to_upload":
-                    log(
-                        f"Analysis {analysis['_id']} failed to submit to expanse. Updating status upstream."
-                    )
-                    results = {
-                        "status": "failure",
-                        "message": analysis.get("error", "unknown error"),
-                    }
-                    upload_analysis_results(
-                        results, analysis
-                    )  # for a failure, we don't bother with retries
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis["_id"]},
-                        {"$set": {"status": "failed_submission"}},
-                    )
-                    continue
-
-                # an edge case, but the plots have been generating for too long, we cancel the job, set it to failed
-                # and upload that failure status upstream
-                if analysis["status"] == "running_plot" and analysis.get(
-                    "submitted_at"
-                ) + time_limit < datetime.timestamp(datetime.utcnow()):
-                    log(
-                        f"Analysis {analysis['_id']} plot generation has been running for too long. Cancelling the job and setting it to failed."
-                    )
-                    cancel_job(analysis.get("job_id", None))
-                    results = {
-                        "status": "failure",
-                        "message": "analysis ran for too long, and failed to generate plots",
-                    }
-                    upload_analysis_results(results, analysis)
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis["_id"]},
-                        {"$set": {"status": "failed_plot"}},
-                    )
-                    continue
-
-                # analysis has failed to upload upstream 10 times, delete the results and skip
-                if (
-                    analysis["status"] == "retry_upload"
-                    and analysis.get("nb_upload_failures", 0) >= max_upload_failures
-                ):
-                    log(
-                        f"Analysis {analysis['_id']} has failed to upload 10 times. Skipping and deleting the results."
-                    )
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis["_id"]},
-                        {"$set": {"status": "failed_upload"}},
-                    )
-                    mongo.db.results.delete_one({"analysis_id": analysis["_id"]})
-                    continue
-
-                # analysis or plot generation is running, try to retrieve the results if finished
-                if analysis["status"] in ["running", "running_plot"]:
-                    results = retrieve(analysis)
-                else:
-                    try:
-                        results = mongo.db.results.find_one(
-                            {"analysis_id": analysis["_id"]}
-                        )["results"]
-                    except Exception:
-                        results = retrieve(analysis)
-
-                if results is not None:
-                    log(
-                        f"Uploading results to webhook for analysis {analysis['_id']} ({analysis['resource_id']}, {analysis['created_at']})"
-                    )
-
-                    if analysis["status"] == "running":
-                        mongo.insert_one(
-                            "results",
-                            {"analysis_id": analysis["_id"], "results": results},
-                        )
-
-                    uploaded, error = upload_analysis_results(results, analysis)
-                    if uploaded:
-                        mongo.db.analysis.update_one(
-                            {"_id": analysis["_id"]},
-                            {"$set": {"status": "completed"}},
-                        )
-                        # delete the results from the database
-                        mongo.db.results.delete_one({"analysis_id": analysis["_id"]})
-                    else:
-                        mongo.db.analysis.update_one(
-                            {"_id": analysis["_id"]},
-                            {
-                                "$set": {
-                                    "status": "retry_upload",
-                                    "nb_upload_failures": analysis.get(
-                                        "nb_upload_failures", 0
-                                    )
-                                    + 1,
-                                    "upload_error": error,
-                                }
-                            },
-                        )
-                else:
-                    log(f"Analysis {analysis['_id']} has not completed yet. Skipping.")
+            release_outputs([analysis])
+            continue
+
+        # analysis or plot generation is running, try to retrieve the results if finished
+        if analysis["status"] in ["running", "running_plot"]:
+            to_fetch.append(analysis)
+            continue
+
+        # retry_upload: the results were kept in the results collection
+        results = (
+            mongo.db.results.find_one({"analysis_id": analysis["_id"]}) or {}
+        ).get("results")
+        if results is not None:
+            persist((analysis, results))
+        else:
+            to_fetch.append(analysis)
+
+    if len(to_fetch) > 0:
+        stats = run_pipeline(
+            to_fetch,
+            [
+                Stage("fetch", fetch, fetch_workers),
+                Stage("package", package, max(package_processes, 1)),
+                Stage("persist", persist, persist_workers),
+            ],
+            queue_size=queue_size,
+        )
+        log(
+            "Retrieval pipeline: "
+            + ", ".join(
+                f"{name} {stage['items']} in {stage['busy']:.1f}s"
+                for name, stage in stats.items()
+            )
+        )
+    return len(analysis_requests)
+
+
+def setup():
+    """Migrate and index the analyses, and start the packaging processes, before the first cycle."""
+    migrate_dates(mongo)
+    for field in ["next_check_at", "invalid_after", "deadline_at"]:
+        mongo.db.analysis.create_index([("status", ASCENDING), (field, ASCENDING)])
+    warm_up_package_pool()
+
+
+def retrieval_queue():
+    """Retrieve analysis results from expanse."""
+    setup()
+    install_toggle()
+    install_sigterm_flush()
+    while True:
+        try:
+            with profiled("retrieval_queue") as profile:
+                profile.count = retrieval_cycle()
         except Exception as e:
-            log(f"Failed to retrieve analysis results from expanse: {e}")
+            log(f"Failed to retrieve analysis results from expanse: {e}", level="error")
 
         time.sleep(retrieval_wait_time)
 
@@ -1,9 +1,24 @@
 import time
+from datetime import timedelta
 
-from nmma_api.tools.expanse import submit
+from pymongo import ASCENDING
+
+from nmma_api.tools.admission import (
+    BACKLOG_STATUSES,
+    JOB_STATUSES,
+    count_analyses,
+    max_jobs,
+    max_submissions,
+    submission_quotas,
+)
+from nmma_api.tools.backend import backend_name, configured_backends, get_backend
+from nmma_api.tools.lifecycle import event, push_events, transition
+from nmma_api.tools.polling import next_check_at, time_limit
 from nmma_api.utils.config import load_config
-from nmma_api.utils.logs import make_log
+from nmma_api.utils.dates import from_timestamp
+from nmma_api.utils.logs import install_sigterm_flush, make_log
 from nmma_api.utils.mongo import Mongo
+from nmma_api.utils.profiling import install_toggle, profiled
 
 log = make_log("submission_queue")
 
@@ -14,53 +29,138 @@ mongo = Mongo(**config["database"])
 submission_wait_time = config["wait_times"]["submission"]
 
 
+def submission_cycle() -> int:
+    """
+    Submit the analysis requests that haven't been processed yet, oldest first,
+    within the submission quota of their backend, returning how many were submitted.
+    """
+    # at most max_submissions per backend, and max_jobs in flight (see admission.py)
+    counts = count_analyses()
+    quotas = submission_quotas(configured_backends(), counts["jobs"])
+    analysis_cursor = mongo.db.analysis.find(
+        {"status": {"$in": BACKLOG_STATUSES}}
+    ).sort("created_at", ASCENDING)
+
+    # group the analyses per backend, so each backend gets a single batch
+    batches = {}
+    analysis_requests = []
+    for analysis_request in analysis_cursor:
+        if all(quota <= 0 for quota in quotas.values()):
+            break
+        name = backend_name(analysis_request)
+        if name not in quotas:
+            quotas.update(submission_quotas([name], counts["jobs"]))
+        if quotas[name] <= 0:
+            continue
+        quotas[name] -= 1
+        batches.setdefault(name, []).append(analysis_request)
+        analysis_requests.append(analysis_request)
+
+    waiting = counts["backlog"]
+    if len(analysis_requests) < waiting:
+        log(
+            f"Found {waiting} analysis requests to submit or resubmit, submitting {len(analysis_requests)} (at most {max_submissions} per cycle and {max_jobs} jobs in flight per backend)."
+        )
+    else:
+        log(f"Found {waiting} analysis requests to submit or resubmit.")
+    if len(analysis_requests) == 0:
+        return 0
+
+    jobs = {}
+    for name, batch in batches.items():
+        try:
+            jobs.update(get_backend(name).submit_batch(batch))
+        except Exception as e:
+            log(
+                f"Failed to submit analysis requests to backend {name}: {e}",
+                level="error",
+            )
+            for analysis_request in batch:
+                jobs[analysis_request["_id"]] = {
+                    "job_id": None,
+                    "message": f"failed to submit to backend {name}: {e}",
+                }
+    for analysis_request in analysis_requests:
+        job = jobs.get(analysis_request["_id"], {})
+        message = jobs.get(analysis_request["_id"], {}).get("message", "")
+        if job.get("job_id") is not None:
+            running = {
+                "status": "running_plot"
+                if analysis_request["status"] == "job_expired"
+                else "running",
+                "job_id": job.get("job_id"),
+                "backend": backend_name(analysis_request),
+                "submitted_at": job.get("submitted_at"),
+                "warning": message,
+            }
+            # the job is cancelled once it runs past its deadline
+            running["deadline_at"] = from_timestamp(
+                running["submitted_at"]
+            ) + timedelta(seconds=time_limit)
+            # the retrieval queue only checks the job once it is due
+            running["next_check_at"] = next_check_at({**analysis_request, **running})
+            mongo.db.analysis.update_one(
+                {"_id": analysis_request["_id"]},
+                {"$set": running, "$push": push_events(event(running["status"]))},
+            )
+        else:
+            mongo.db.analysis.update_one(
+                {"_id": analysis_request["_id"]},
+                transition("failed_submission_to_upload", error=message, job_id=None),
+            )
+    return len(analysis_requests)
+
+
+def expire_orphaned_jobs() -> int:
+    """
+    Set the analyses whose local job was lost to job_expired, returning how many were.
+
+    The local jobs are queued in (and run by) a process pool of the submission queue,
+    so those not running yet are lost when it restarts. As with the jobs that ran past
+    their deadline, the submission queue then starts their plot generation job.
+    """
+    analyses = list(
+        mongo.db.analysis.find(
+            {"status": {"$in": JOB_STATUSES}, "backend": "local"},
+            {"status": 1, "job_id": 1, "resource_id": 1, "created_at": 1},
+        )
+    )
+    if len(analyses) == 0:
+        return 0
+    backend = get_backend("local")
+    orphans = [analysis for analysis in analyses if backend.orphaned(analysis)]
+    if len(orphans) == 0:
+        return 0
+    log(
+        f"{len(orphans)} analyses lost their local job (the submission queue restarted), setting them to job_expired.",
+        level="warning",
+    )
+    for analysis in orphans:
+        mongo.db.analysis.update_one(
+            {"_id": analysis["_id"], "status": analysis["status"]},
+            transition("job_expired"),
+        )
+    return len(orphans)
+
+
+def setup():
+    # the backlog is submitted in the order of creation
+    mongo.db.analysis.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+    # before submitting anything, as the new local jobs are not running yet either
+    expire_orphaned_jobs()
+
+
 def submission_queue():
     """Submit analysis requests to expanse."""
+    install_toggle()
+    install_sigterm_flush()
+    setup()
     while True:
         try:
-            # get the analysis requests that haven't been processed yet
-            analysis_cursor = mongo.db.analysis.find(
-                {"status": {"$in": ["pending", "job_expired"]}}
-            )
-
-            analysis_requests = [x for x in analysis_cursor]
-            log(
-                f"Found {len(analysis_requests)} analysis requests to submit or resubmit."
-            )
-            if len(analysis_requests) == 0:
-                time.sleep(submission_wait_time)
-                continue
-            jobs = submit(analysis_requests)
-            for analysis_request in analysis_requests:
-                job = jobs.get(analysis_request["_id"], {})
-                message = jobs.get(analysis_request["_id"], {}).get("message", "")
-                if job.get("job_id") is not None:
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis_request["_id"]},
-                        {
-                            "$set": {
-                                "status": "running_plot"
-                                if analysis_request["status"] == "job_expired"
-                                else "running",
-                                "job_id": job.get("job_id"),
-                                "submitted_at": job.get("submitted_at"),
-                                "warning": message,
-                            }
-                        },
-                    )
-                else:
-                    mongo.db.analysis.update_one(
-                        {"_id": analysis_request["_id"]},
-                        {
-                            "$set": {
-                                "status": "failed_submission_to_upload",
-                                "error": message,
-                                "job_id": None,
-                            }
-                        },
-                    )
+            with profiled("submission_queue") as profile:
+                profile.count = submission_cycle()
         except Exception as e:
-            log(f"Failed to submit analysis requests to expanse: {e}")
+            log(f"Failed to submit analysis requests to expanse: {e}", level="error")
 
         time.sleep(submission_wait_time)
 
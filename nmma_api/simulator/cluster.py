@@ -0,0 +1,214 @@
+import io
+import os
+import random
+import shlex
+import tarfile
+import threading
+import time
+from collections import Counter
+
+from nmma_api.simulator.synthetic import synthetic_outputs
+from nmma_api.tools.expanse import expanse_output_dir
+
+
+class SimulatedCluster:
+    """
+    An in-memory stand-in for Expanse: a filesystem, and a SLURM scheduler
+    whose jobs write synthetic NMMA outputs once they are done.
+
+    Parameters
+    ----------
+    latency : float, optional
+        Mean latency of each remote call (exec_command, sftp operation), in seconds.
+    latency_jitter : float, optional
+        Maximum random jitter added to the latency, in seconds.
+    job_duration : tuple[float, float], optional
+        Range of the (uniformly sampled) duration of a sampling job, in seconds.
+    plot_duration : tuple[float, float], optional
+        Range of the duration of a plot-only (--skip-sampling) job, in seconds.
+    failure_rate : float, optional
+        Probability that a job fails and never writes its outputs.
+    submission_failure_rate : float, optional
+        Probability that sbatch rejects a job.
+    nb_samples : int, optional
+        Number of posterior samples written by each job.
+    seed : int, optional
+        Seed of the random number generator.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        latency_jitter: float = 0.02,
+        job_duration: tuple = (5.0, 30.0),
+        plot_duration: tuple = (1.0, 5.0),
+        failure_rate: float = 0.0,
+        submission_failure_rate: float = 0.0,
+        nb_samples: int = 2000,
+        seed: int = 42,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.job_duration = job_duration
+        self.plot_duration = plot_duration
+        self.failure_rate = failure_rate
+        self.submission_failure_rate = submission_failure_rate
+        self.nb_samples = nb_samples
+        self.random = random.Random(seed)
+
+        self.files = {}
+        self.directories = {"/"}
+        self.jobs = {}
+        self.next_job_id = 1000
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def remote_call(self, kind: str):
+        """Count a remote call and simulate its latency."""
+        with self.lock:
+            self.calls[kind] += 1
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        self.advance()
+
+    # filesystem
+
+    def exists(self, path: str) -> bool:
+        return os.path.normpath(path) in self.files
+
+    def read(self, path: str) -> bytes:
+        path = os.path.normpath(path)
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return self.files[path]
+
+    def write(self, path: str, data: bytes):
+        path = os.path.normpath(path)
+        with self.lock:
+            self.files[path] = data
+            self.directories.add(os.path.dirname(path))
+
+    def mkdir(self, path: str) -> bool:
+        path = os.path.normpath(path)
+        with self.lock:
+            if path in self.directories:
+                return False
+            self.directories.add(path)
+        return True
+
+    # scheduler
+
+    def sbatch(self, exports: dict) -> int:
+        """Queue a job, returning its id (None if it was rejected)."""
+        with self.lock:
+            if self.random.random() < self.submission_failure_rate:
+                return None
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            if exports.get("SKIP_SAMPLING"):
+                duration = self.random.uniform(*self.plot_duration)
+            else:
+                duration = self.random.uniform(*self.job_duration)
+            self.jobs[job_id] = {
+                "label": exports.get("LABEL"),
+                "ends_at": time.time() + duration,
+                "fails": self.random.random() < self.failure_rate,
+                "state": "RUNNING",
+            }
+        return job_id
+
+    def scancel(self, job_id: int) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] != "RUNNING":
+                return False
+            job["state"] = "CANCELLED"
+        return True
+
+    def advance(self):
+        """Complete the jobs that are done, writing their outputs."""
+        now = time.time()
+        with self.lock:
+            done = [
+                job
+                for job in self.jobs.values()
+                if job["state"] == "RUNNING" and job["ends_at"] <= now
+            ]
+            for job in done:
+                job["state"] = "FAILED" if job["fails"] else "COMPLETED"
+        for job in done:
+            if job["state"] == "COMPLETED":
+                self.write_outputs(job["label"])
+
+    def write_outputs(self, LABEL: str):
+        """Write synthetic NMMA outputs for an analysis."""
+        for suffix, data in synthetic_outputs(self.nb_samples).items():
+            self.write(
+                os.path.join(expanse_output_dir, LABEL, f"{LABEL}{suffix}"), data
+            )
+
+    def exec(self, command: str) -> tuple:
+        """Run a shell command, returning its stdout, stderr and exit status."""
+        if command.startswith("echo "):
+            return (" ".join(shlex.split(command)[1:]) + "\n").encode(), b"", 0
+        if command.startswith("mkdir "):
+            path = shlex.split(command)[1]
+            if not self.mkdir(path):
+                error = f"mkdir: cannot create directory '{path}': File exists\n"
+                return b"", error.encode(), 1
+            return b"", b"", 0
+        if command.startswith("scancel "):
+            job_id = int(shlex.split(command)[1])
+            if not self.scancel(job_id):
+                error = f"scancel: error: Invalid job id specified: {job_id}\n"
+                return b"", error.encode(), 1
+            return b"", b"", 0
+        if "sbatch " in command:
+            return self.exec_sbatch(command)
+        return self.exec_chain(command)
+
+    def exec_sbatch(self, command: str) -> tuple:
+        arguments = shlex.split(command.split("sbatch ", 1)[1])
+        exports = {}
+        for argument in arguments:
+            if argument.startswith("--export="):
+                for export in argument.removeprefix("--export=").split(","):
+                    key, _, value = export.partition("=")
+                    exports[key] = value
+        job_id = self.sbatch(exports)
+        if job_id is None:
+            return b"", b"sbatch: error: Batch job submission failed\n", 1
+        return f"Submitted batch job {job_id}\n".encode(), b"", 0
+
+    def exec_chain(self, command: str) -> tuple:
+        """Run a `&&` chain of cd, test -f and tar commands."""
+        cwd = "/"
+        for part in command.split(" && "):
+            arguments = shlex.split(part.replace("2>/dev/null", ""))
+            if arguments[0] == "cd":
+                cwd = os.path.join(cwd, arguments[1])
+                if os.path.normpath(cwd) not in self.directories:
+                    return b"", b"", 1
+            elif arguments[:2] == ["test", "-f"]:
+                if not self.exists(os.path.join(cwd, arguments[2])):
+                    return b"", b"", 1
+            elif arguments[0] == "tar":
+                return self.exec_tar(cwd, arguments)
+            else:
+                return b"", f"{arguments[0]}: command not found\n".encode(), 127
+        return b"", b"", 0
+
+    def exec_tar(self, cwd: str, arguments: list) -> tuple:
+        if "--zstd" in arguments:
+            return b"", b"tar: zstd is not supported by the simulator\n", 2
+        position = arguments.index("-") + 1
+        names = arguments[position:]
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            for name in names:
+                data = self.read(os.path.join(cwd, name))
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return buffer.getvalue(), b"", 0
@@ -0,0 +1,216 @@
+"""
+End-to-end load test of the API, submission, retrieval and delivery queues,
+against a simulated Expanse (see `nmma_api.simulator.cluster`).
+
+It runs all the services in a single process, replays analysis requests
+(from a JSONL file with one request per line and an optional `delay` in
+seconds, or synthetic ones), receives the results on a local webhook, and
+reports end-to-end latencies, queue cycle times and remote calls.
+
+Run it against a dedicated database, e.g.:
+
+    DATABASE_DB=nmma_loadtest PYTHONPATH=. python nmma_api/simulator/loadtest.py --nb_analyses=1000
+"""
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+import fire
+import numpy as np
+import requests
+import tornado.ioloop
+import tornado.web
+
+from nmma_api.services.api import make_app
+from nmma_api.services.delivery_queue import delivery_cycle
+from nmma_api.services.retrieval_queue import retrieval_cycle, warm_up_package_pool
+from nmma_api.services.submission_queue import submission_cycle
+from nmma_api.simulator.cluster import SimulatedCluster
+from nmma_api.simulator.ssh import SimulatedExpanse
+from nmma_api.simulator.synthetic import synthetic_request
+from nmma_api.tools import polling
+from nmma_api.tools.backend import set_backend
+from nmma_api.tools.expanse import ExpanseBackend
+from nmma_api.tools.webhook import connection_stats
+from nmma_api.utils.codec import loads
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import make_log
+
+log = make_log("loadtest")
+
+config = load_config()
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, received):
+        self.received = received
+
+    def post(self, index):
+        body = loads(self.request.body)
+        self.received[int(index)] = (time.time(), body.get("status"))
+        self.write({"status": "success"})
+
+
+def percentiles(values: list) -> str:
+    if len(values) == 0:
+        return "n/a"
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return f"p50={p50:.2f}s p90={p90:.2f}s p99={p99:.2f}s max={max(values):.2f}s (n={len(values)})"
+
+
+def run_loop(cycle, wait_time: float, durations: list, stop: threading.Event):
+    while not stop.is_set():
+        start = time.time()
+        try:
+            cycle()
+        except Exception as e:
+            log(f"{cycle.__name__} failed: {e}")
+        durations.append(time.time() - start)
+        stop.wait(wait_time)
+
+
+def run(
+    traffic: str = None,
+    nb_analyses: int = 100,
+    rate: float = 10.0,
+    model: str = "Me2017",
+    nb_points: int = 20,
+    api_port: int = 4100,
+    webhook_port: int = 4101,
+    latency: float = 0.05,
+    min_job_duration: float = 5.0,
+    max_job_duration: float = 30.0,
+    failure_rate: float = 0.0,
+    submission_failure_rate: float = 0.0,
+    nb_samples: int = 2000,
+    submission_wait_time: float = 1.0,
+    retrieval_wait_time: float = 1.0,
+    delivery_wait_time: float = 0.5,
+    timeout: float = 600.0,
+    force: bool = False,
+):
+    """
+    Run the load test.
+
+    Parameters
+    ----------
+    traffic : str, optional
+        JSONL file of analysis requests to replay. By default, `nb_analyses`
+        synthetic requests are sent at `rate` requests per second.
+    latency : float, optional
+        Mean latency of each remote call to the simulated cluster, in seconds.
+    min_job_duration, max_job_duration : float, optional
+        Range of the duration of the simulated jobs, in seconds.
+    failure_rate, submission_failure_rate : float, optional
+        Probability that a simulated job fails, or is rejected by sbatch.
+    timeout : float, optional
+        Maximum duration of the load test, in seconds.
+    force : bool, optional
+        Run even if the database name doesn't contain "loadtest".
+    """
+    if "loadtest" not in config["database"]["db"] and not force:
+        raise ValueError(
+            f"refusing to run against database {config['database']['db']}, "
+            "use a dedicated database (e.g. DATABASE_DB=nmma_loadtest) or --force"
+        )
+
+    cluster = SimulatedCluster(
+        latency=latency,
+        job_duration=(min_job_duration, max_job_duration),
+        failure_rate=failure_rate,
+        submission_failure_rate=submission_failure_rate,
+        nb_samples=nb_samples,
+    )
+    set_backend("expanse", ExpanseBackend(expanse=SimulatedExpanse(cluster)))
+    # scale the polling schedule down to the simulated jobs
+    polling.expected_runtime = (min_job_duration + max_job_duration) / 2
+    polling.expected_plot_runtime = sum(cluster.plot_duration) / 2
+    polling.min_interval = retrieval_wait_time
+
+    if traffic is not None:
+        with open(traffic) as f:
+            analysis_requests = [loads(line) for line in f if line.strip()]
+    else:
+        analysis_requests = [
+            {**synthetic_request(i, model, nb_points), "delay": i / rate}
+            for i in range(nb_analyses)
+        ]
+
+    received = {}
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        make_app().listen(api_port)
+        tornado.web.Application(
+            [(r"/webhook/(\d+)", WebhookHandler, {"received": received})]
+        ).listen(webhook_port)
+        tornado.ioloop.IOLoop.current().start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    warm_up_package_pool()
+    time.sleep(1)
+
+    stop = threading.Event()
+    cycle_durations = {
+        "submission_queue": [],
+        "retrieval_queue": [],
+        "delivery_queue": [],
+    }
+    for cycle, wait_time, durations in [
+        (submission_cycle, submission_wait_time, cycle_durations["submission_queue"]),
+        (retrieval_cycle, retrieval_wait_time, cycle_durations["retrieval_queue"]),
+        (delivery_cycle, delivery_wait_time, cycle_durations["delivery_queue"]),
+    ]:
+        threading.Thread(
+            target=run_loop, args=(cycle, wait_time, durations, stop), daemon=True
+        ).start()
+
+    sent = {}
+    start = time.time()
+    for index, analysis_request in enumerate(analysis_requests):
+        delay = analysis_request.pop("delay", None)
+        if delay is not None:
+            time.sleep(max(0, start + delay - time.time()))
+        analysis_request[
+            "callback_url"
+        ] = f"http://127.0.0.1:{webhook_port}/webhook/{index}"
+        analysis_request["invalid_after"] = str(datetime.utcnow() + timedelta(days=1))
+        response = requests.post(
+            f"http://127.0.0.1:{api_port}/analysis", json=analysis_request
+        )
+        if response.status_code == 200:
+            sent[index] = time.time()
+        else:
+            log(f"Request {index} rejected: {response.text}")
+
+    while len(received) < len(sent) and time.time() - start < timeout:
+        time.sleep(1)
+    stop.set()
+
+    latencies = [received[i][0] - sent[i] for i in received if i in sent]
+    failures = [i for i in received if received[i][1] != "success"]
+    nb_calls = sum(cluster.calls.values())
+
+    print()
+    print("=" * 78)
+    print(
+        f"Analyses sent: {len(sent)}, completed: {len(received)}, failed: {len(failures)}"
+    )
+    print(f"Total duration: {time.time() - start:.1f}s")
+    print(f"End-to-end latency: {percentiles(latencies)}")
+    for name, durations in cycle_durations.items():
+        print(f"{name} cycle time: {percentiles(durations)}")
+    print(f"Remote calls: {nb_calls} ({nb_calls / max(len(sent), 1):.1f} per analysis)")
+    for kind, count in sorted(cluster.calls.items()):
+        print(f"  {kind.ljust(20)} {count}")
+    for host, stats in connection_stats().items():
+        print(
+            f"Webhook {host}: {stats['requests']} requests, "
+            f"{stats['new_connections']} new connections, {stats['reused_connections']} reused"
+        )
+    print("=" * 78)
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,88 @@
+import io
+
+from nmma_api.simulator.cluster import SimulatedCluster
+
+# commands counted separately in the remote calls, by order of precedence
+COMMANDS = ["sbatch", "scancel", "tar", "mkdir", "test", "echo"]
+
+
+class SimulatedChannel:
+    def __init__(self, exit_status: int):
+        self.exit_status = exit_status
+
+    def recv_exit_status(self) -> int:
+        return self.exit_status
+
+
+class SimulatedChannelFile(io.BytesIO):
+    """The stdout/stderr of a remote command, like paramiko's ChannelFile."""
+
+    def __init__(self, data: bytes, channel: SimulatedChannel):
+        super().__init__(data)
+        self.channel = channel
+
+
+class SimulatedSFTPClient:
+    """The subset of paramiko's SFTPClient used by the expanse backend."""
+
+    def __init__(self, cluster: SimulatedCluster):
+        self.cluster = cluster
+
+    def put(self, localpath: str, remotepath: str):
+        self.cluster.remote_call("sftp.put")
+        with open(localpath, "rb") as f:
+            self.cluster.write(remotepath, f.read())
+
+    def get(self, remotepath: str, localpath: str):
+        self.cluster.remote_call("sftp.get")
+        data = self.cluster.read(remotepath)
+        with open(localpath, "wb") as f:
+            f.write(data)
+
+    def stat(self, path: str):
+        self.cluster.remote_call("sftp.stat")
+        if not self.cluster.exists(path):
+            raise FileNotFoundError(f"[Errno 2] No such file: {path}")
+        return len(self.cluster.read(path))
+
+    def close(self):
+        pass
+
+
+class SimulatedSSHClient:
+    """The subset of paramiko's SSHClient used by the expanse backend."""
+
+    def __init__(self, cluster: SimulatedCluster):
+        self.cluster = cluster
+
+    def exec_command(self, command: str):
+        words = command.split()
+        kind = next((c for c in COMMANDS if c in words), words[0])
+        self.cluster.remote_call(f"exec.{kind}")
+        stdout, stderr, exit_status = self.cluster.exec(command)
+        channel = SimulatedChannel(exit_status)
+        return (
+            SimulatedChannelFile(b"", channel),
+            SimulatedChannelFile(stdout, channel),
+            SimulatedChannelFile(stderr, channel),
+        )
+
+    def open_sftp(self) -> SimulatedSFTPClient:
+        self.cluster.remote_call("sftp.open")
+        return SimulatedSFTPClient(self.cluster)
+
+    def close(self):
+        pass
+
+
+class SimulatedExpanse:
+    """Stands in for `nmma_api.tools.expanse.Expanse`, without any network access."""
+
+    def __init__(self, cluster: SimulatedCluster):
+        self.client = SimulatedSSHClient(cluster)
+
+    def reconnect(self):
+        pass
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,112 @@
+"""
+Synthetic inputs and outputs of analyses, for the load test and the benchmarks.
+"""
+import io
+import json
+import time
+
+import numpy as np
+
+from nmma_api.tools.analysis import RESULT_FILES_SUFFIXES
+from nmma_api.tools.enums import ALLOWED_MODELS, CENTRAL_WAVELENGTH_MODELS
+
+FILTERS = ["ztfg", "ztfr", "ztfi"]
+
+
+def synthetic_photometry(
+    nb_points: int = 20,
+    seed: int = None,
+    filters: list = None,
+    masked_fraction: float = 0.0,
+) -> str:
+    """
+    Generate a synthetic light curve, as the ascii csv sent by SkyPortal.
+
+    Parameters
+    ----------
+    nb_points : int, optional
+        Number of observations, by default 20.
+    seed : int, optional
+        Seed of the random number generator.
+    filters : list, optional
+        Filters of the observations (cycled through), by default FILTERS.
+    masked_fraction : float, optional
+        Fraction of the observations without mag and magerr (non-detections).
+    """
+    filters = filters or FILTERS
+    rng = np.random.default_rng(seed)
+    mjd = 60000 + np.sort(rng.uniform(0, 10, nb_points))
+    masked = rng.uniform(size=nb_points) < masked_fraction
+    # the first observation is always a detection, to set the trigger time
+    masked[0] = False
+    lines = ["mjd,filter,mag,magerr,magsys"]
+    for i in range(nb_points):
+        if masked[i]:
+            mag, magerr = "", ""
+        else:
+            mag = 18 + 0.3 * (mjd[i] - mjd[0]) + rng.normal(0, 0.05)
+            magerr = rng.uniform(0.02, 0.2)
+        lines.append(f"{mjd[i]},{filters[i % len(filters)]},{mag},{magerr},ab")
+    return "\n".join(lines)
+
+
+def synthetic_request(
+    index: int, model: str = "Me2017", nb_points: int = 20, **photometry_options
+) -> dict:
+    """Generate a synthetic analysis request, as sent by SkyPortal."""
+    return {
+        "inputs": {
+            "photometry": synthetic_photometry(
+                nb_points, seed=index, **photometry_options
+            ),
+            "redshift": "redshift\n0.05",
+            "analysis_parameters": {
+                "source": model,
+                "tmin": 0.01,
+                "tmax": 7,
+                "dt": 0.1,
+            },
+        },
+        "resource_id": f"loadtest_{index}",
+        "callback_method": "POST",
+    }
+
+
+def synthetic_outputs(nb_samples: int = 2000, seed: int = None) -> dict:
+    """
+    Generate synthetic NMMA outputs: the contents of the files of an analysis,
+    per suffix (see `RESULT_FILES_SUFFIXES`).
+    """
+    samples = np.random.default_rng(seed).normal(size=(nb_samples, 4))
+    posterior_suffix, json_suffix, lightcurves_suffix = RESULT_FILES_SUFFIXES
+    posterior = io.StringIO()
+    np.savetxt(
+        posterior,
+        samples,
+        header="log10_mej log10_vej KNtheta luminosity_distance",
+        comments="",
+    )
+    return {
+        posterior_suffix: posterior.getvalue().encode(),
+        json_suffix: json.dumps(
+            {
+                "log_bayes_factor": float(samples[0, 0]),
+                "samples": samples.tolist()[:10],
+                "nested_samples": samples.tolist()[:10],
+            }
+        ).encode(),
+        lightcurves_suffix: b"\x89PNG\r\n\x1a\n" + b"\x00" * 1024,
+    }
+
+
+def synthetic_models_metadata(filters: list = None) -> dict:
+    """
+    Generate a models metadata cache entry (see `nmma_api.tools.models_metadata`),
+    in which the trained models support the given filters, by default FILTERS.
+    """
+    models = {
+        f"{model}_tf": {"filters": list(filters or FILTERS)}
+        for model in ALLOWED_MODELS
+        if model not in CENTRAL_WAVELENGTH_MODELS
+    }
+    return {"models": models, "fetched_at": time.time()}
@@ -0,0 +1,130 @@
+import threading
+import time
+from typing import NamedTuple
+
+from nmma_api.tools.backend import backend_name
+from nmma_api.utils.config import load_config
+from nmma_api.utils.mongo import Mongo
+
+config = load_config()
+
+mongo = Mongo(**config["database"])
+
+admission_config = config.get("admission") or {}
+max_backlog = admission_config.get("max_backlog", 1000)
+max_jobs = admission_config.get("max_jobs", 200)
+max_submissions = admission_config.get("max_submissions", 50)
+retry_after = admission_config.get("retry_after", 300)  # in seconds
+cache_ttl = admission_config.get("cache_ttl", 10)  # in seconds
+
+# waiting for the submission queue (the plot generation jobs are resubmitted)
+BACKLOG_STATUSES = ["pending", "job_expired"]
+# with a job in flight on a backend
+JOB_STATUSES = ["running", "running_plot"]
+
+# Backpressure during alert floods:
+# - the API rejects new analyses (429, with a Retry-After) once `max_backlog`
+#   analyses are waiting to be submitted
+# - over `max_jobs` jobs in flight on a backend (the high-water mark), new analyses
+#   are accepted but deferred: they stay pending until jobs complete
+# - the submission queue submits at most `max_submissions` jobs per backend and
+#   per cycle, and never more than `max_jobs` in flight
+# The API reuses the counts for `cache_ttl` seconds, rather than counting per request.
+
+_counts = None
+_counted_at = 0
+_lock = threading.Lock()
+
+
+class Decision(NamedTuple):
+    admitted: bool
+    # admitted, but not submitted until jobs complete on its backend
+    deferred: bool
+    message: str
+
+
+def count_analyses() -> dict:
+    """The number of analyses waiting to be submitted, and with a job in flight per backend."""
+    counts = {"backlog": 0, "jobs": {}}
+    for group in mongo.db.analysis.aggregate(
+        [
+            {"$match": {"status": {"$in": BACKLOG_STATUSES + JOB_STATUSES}}},
+            {
+                "$group": {
+                    "_id": {"status": "$status", "backend": "$backend"},
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
+    ):
+        if group["_id"]["status"] in BACKLOG_STATUSES:
+            counts["backlog"] += group["count"]
+        else:
+            # analyses submitted before the backends were tracked ran on the default one
+            name = group["_id"].get("backend") or backend_name()
+            counts["jobs"][name] = counts["jobs"].get(name, 0) + group["count"]
+    return counts
+
+
+def cached_counts() -> dict:
+    """The counts of `count_analyses`, refreshed at most every `cache_ttl` seconds."""
+    global _counts, _counted_at
+    with _lock:
+        if _counts is None or time.time() - _counted_at > cache_ttl:
+            _counts = count_analyses()
+            _counted_at = time.time()
+        return _counts
+
+
+def admit(backend: str) -> Decision:
+    """
+    Decide whether the API accepts a new analysis, to be run on a backend.
+
+    The analysis is only counted once stored, see `record_admission`.
+    """
+    counts = cached_counts()
+    with _lock:
+        backlog = counts["backlog"]
+        jobs = counts["jobs"].get(backend, 0)
+    if backlog >= max_backlog:
+        return Decision(
+            False,
+            False,
+            f"too many analyses waiting to be submitted ({backlog}), retry later",
+        )
+    if jobs >= max_jobs:
+        return Decision(
+            True, True, f"submission deferred, {jobs} jobs already running on {backend}"
+        )
+    return Decision(True, False, "")
+
+
+def record_admission():
+    """
+    Count an admitted analysis once it is stored (pending), until the next refresh
+    of the counts, so that a flood is noticed within `cache_ttl`.
+    """
+    counts = cached_counts()
+    with _lock:
+        counts["backlog"] += 1
+
+
+def submission_quotas(backends: list, jobs: dict) -> dict:
+    """
+    How many jobs the submission queue can submit to each backend in a cycle,
+    given the jobs in flight per backend (see `count_analyses`).
+    """
+    return {
+        name: max(min(max_submissions, max_jobs - jobs.get(name, 0)), 0)
+        for name in backends
+    }
+
+
+def admission_state() -> dict:
+    """The (cached) counts and the limits, for monitoring."""
+    return {
+        **cached_counts(),
+        "max_backlog": max_backlog,
+        "max_jobs": max_jobs,
+        "max_submissions": max_submissions,
+    }
@@ -0,0 +1,293 @@
+import base64
+import gzip
+import os
+import tempfile
+
+from nmma_api.tools.enums import get_model, verify_and_match_filter
+from nmma_api.tools.photometry import compact_photometry, compaction_options
+from nmma_api.tools.posterior import (
+    posterior_options,
+    reduce_posterior,
+    write_inference_data,
+)
+from nmma_api.utils.codec import loads
+from nmma_api.utils.config import load_config
+
+config = load_config()
+
+# parameters of an NMMA run, passed to the analysis script as environment variables
+NMMA_PARAMETERS = [
+    "MODEL",
+    "PRIOR",
+    "LABEL",
+    "TT",
+    "DATA",
+    "TMIN",
+    "TMAX",
+    "DT",
+    "SKIP_SAMPLING",
+]
+
+RESULT_FILES_SUFFIXES = [
+    "_posterior_samples.dat",
+    "_result.json",
+    "_lightcurves.png",
+]
+
+
+def analysis_label(analysis: dict) -> str:
+    """The label of an analysis, used to name its data file and output directory."""
+    return f"{analysis.get('resource_id', '')}_{analysis.get('created_at', None)}"
+
+
+def result_files(LABEL: str) -> list[str]:
+    """Names of the output files of an analysis, relative to its output directory."""
+    return [f"{LABEL}{suffix}" for suffix in RESULT_FILES_SUFFIXES]
+
+
+def prepare_analysis(data_dict: dict, data_dir: str) -> dict:
+    """
+    Write the photometry of an analysis in the format expected by NMMA,
+    and gather the parameters of the NMMA run.
+
+    Parameters
+    ----------
+    data_dict : dict
+        The analysis request, as stored in the database.
+    data_dir : str
+        The local directory where the data file is written.
+
+    Returns
+    -------
+    dict
+        The parameters of the NMMA run (see `NMMA_PARAMETERS`, except DATA which
+        depends on where the backend copies the data file), the path of the data
+        file (local_data_path) and a message listing the observations that were
+        skipped (message).
+
+    Raises
+    ------
+    ValueError
+        If the input data is not in the expected format or can't be formatted.
+    """
+    # the scientific stack is slow to import, only load it when it is needed
+    import numpy as np
+    from astropy.table import Table
+    from astropy.time import Time
+
+    try:
+        analysis_parameters = data_dict["inputs"].get("analysis_parameters", {})
+        status = data_dict.get("status", None)
+
+        MODEL = analysis_parameters.get("source")
+        PRIOR = get_model(MODEL).prior
+        LABEL = analysis_label(data_dict)
+        TMIN = analysis_parameters.get("tmin")
+        TMAX = analysis_parameters.get("tmax")
+        DT = analysis_parameters.get("dt")
+        SKIP_SAMPLING = ""
+        if status == "job_expired":
+            SKIP_SAMPLING = "--skip-sampling"
+
+        # this example analysis service expects the photometry to be in
+        # a csv file (at data_dict["inputs"]["photometry"]) with the following columns
+        # - filter: the name of the bandpass
+        # - mjd: the modified Julian date of the observation
+        # - magsys: the mag system (e.g. ab) of the observations
+        # - flux: the flux of the observation
+        #
+        # the following code transforms these inputs from SkyPortal
+        # to the format expected by nmma.
+        #
+
+        # first, decompress the data
+        data_decompressed = gzip.decompress(data_dict["inputs"]["photometry"]).decode()
+        redshift_decompressed = gzip.decompress(
+            data_dict["inputs"]["redshift"]
+        ).decode()
+        data = Table.read(data_decompressed, format="ascii.csv")
+        redshift = Table.read(redshift_decompressed, format="ascii.csv")
+        z = redshift["redshift"][0]  # noqa F841
+    except Exception as e:
+        raise ValueError(f"input data is not in the expected format {e}")
+
+    skipped = 0
+    skipped_filters = []
+    try:
+        # Set trigger time based on first detection
+        TT = np.min(data[data["mag"] != np.ma.masked]["mjd"])
+
+        # remove rows where mag and magerr are missing, or not float, or negative
+        data = data[
+            np.isfinite(data["mag"])
+            & np.isfinite(data["magerr"])
+            & (data["mag"] > 0)
+            & (data["magerr"] > 0)
+        ]
+        filters, valid = [], []
+        for row in data:
+            try:
+                filters.append(verify_and_match_filter(MODEL, row["filter"]))
+                valid.append(True)
+            except ValueError:
+                skipped += 1
+                skipped_filters.append(row["filter"])
+                valid.append(False)
+        if skipped == len(data):
+            raise ValueError("no valid filters found in photometry data")
+        data = data[valid]
+        data = Table(
+            {
+                "mjd": data["mjd"],
+                "filter": filters,
+                "mag": data["mag"],
+                "magerr": data["magerr"],
+            }
+        )
+
+        # fewer points make for a faster sampling on the backend
+        data, reductions = compact_photometry(
+            data, TT, compaction_options(data_dict), TMIN, TMAX
+        )
+        # e.g. all clipped: fail the submission, rather than the job on the backend
+        if len(data) == 0:
+            raise ValueError(
+                f"no observations left in photometry data after compaction ({', '.join(reductions)})"
+            )
+
+        # Give each source a different filename. This file will be copied to the backend.
+        filename = f"{LABEL}.dat"
+        os.makedirs(data_dir, exist_ok=True)
+
+        local_data_path = os.path.join(data_dir, filename)
+        with open(local_data_path, "w") as f:
+            # output the data in the format desired by NMMA
+            times = Time(np.asarray(data["mjd"], dtype=float), format="mjd").isot
+            for tt, row in zip(times, data):
+                f.write(f"{tt} {row['filter']} {row['mag']} {row['magerr']}\n")
+    except Exception as e:
+        raise ValueError(f"failed to format data {e}")
+
+    messages = []
+    if skipped > 0:
+        messages.append(
+            f"Skipped {skipped} observations with filters: {', '.join(list(set(skipped_filters)))} as they are not supported by the model."
+        )
+    if len(reductions) > 0:
+        messages.append(f"Light curve compacted: {', '.join(reductions)}.")
+    message = " ".join(messages)
+
+    return {
+        "MODEL": MODEL,
+        "PRIOR": PRIOR,
+        "LABEL": LABEL,
+        "TT": TT,
+        "TMIN": TMIN,
+        "TMAX": TMAX,
+        "DT": DT,
+        "SKIP_SAMPLING": SKIP_SAMPLING,
+        "local_data_path": local_data_path,
+        "message": message,
+    }
+
+
+def package_results(analysis: dict, output_dir: str) -> dict:
+    """
+    Package the outputs of an analysis into the results uploaded to the webhook.
+
+    Parameters
+    ----------
+    analysis : dict
+        The analysis request.
+    output_dir : str
+        The local directory containing the output files of the analysis.
+
+    Returns
+    -------
+    dict
+        The results, or None if some of the output files are missing.
+    """
+    # the scientific stack is slow to import, only load it when it is needed
+    import arviz as az
+    import joblib
+    from astropy.table import Table
+
+    LABEL = analysis_label(analysis)
+    local_posterior_file, local_json_file, local_lightcurves_file = [
+        os.path.join(output_dir, filename) for filename in result_files(LABEL)
+    ]
+
+    local_temp_files = []
+
+    try:
+        # Structure files to prepare for return
+        options = posterior_options(analysis)
+        tab = Table.read(local_posterior_file, format="csv", delimiter=" ")
+        posterior, reductions = reduce_posterior(tab.to_pandas(), options)
+        inference = az.convert_to_inference_data(
+            {column: posterior[column].to_numpy() for column in posterior.columns}
+        )
+
+        f = tempfile.NamedTemporaryFile(
+            suffix=".nc", prefix="inferencedata_", delete=False
+        )
+        f.close()
+
+        write_inference_data(inference, f.name, options["compression_level"])
+        inference_data = base64.b64encode(open(f.name, "rb").read()).decode()
+        local_temp_files.append(f.name)
+
+        with open(local_json_file, "rb") as f:
+            result = loads(f.read())
+        log_bayes_factor = result["log_bayes_factor"]
+
+        # Remove some keys to maintain a reasonable results size
+        pop_list = ["samples", "nested_samples"]
+        [result.pop(x) for x in pop_list]
+
+        if "warning" in analysis:
+            result["warning"] = analysis["warning"]
+        if len(reductions) > 0:
+            result["posterior_reduction"] = reductions
+
+        f = tempfile.NamedTemporaryFile(suffix=".png", prefix="nmmaplot_", delete=False)
+        f.close()
+
+        plot_data = base64.b64encode(open(local_lightcurves_file, "rb").read()).decode()
+        local_temp_files.append(f.name)
+
+        f = tempfile.NamedTemporaryFile(
+            suffix=".joblib", prefix="results_", delete=False
+        )
+        f.close()
+
+        joblib.dump(result, f.name, compress=3)
+        result_data = base64.b64encode(open(f.name, "rb").read()).decode()
+        local_temp_files.append(f.name)
+
+        analysis_results = {
+            "inference_data": {"format": "netcdf4", "data": inference_data},
+            "plots": [{"format": "png", "data": plot_data}],
+            "results": {"format": "joblib", "data": result_data},
+        }
+
+        message = f"Good results with log Bayes factor={log_bayes_factor}"
+        if len(reductions) > 0:
+            message += f" (posterior reduced: {', '.join(reductions)})"
+
+        results = {
+            "analysis": analysis_results,
+            "status": "success",
+            "message": message,
+        }
+
+    except FileNotFoundError:
+        return None
+    finally:
+        for f in local_temp_files:
+            try:
+                os.remove(f)
+            except:  # noqa E722
+                pass
+
+    return results
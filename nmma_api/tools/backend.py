@@ -0,0 +1,143 @@
+import importlib
+
+from nmma_api.tools.analysis import package_results
+from nmma_api.tools.enums import model_registry
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import make_log
+
+config = load_config()
+
+log = make_log("backend")
+
+# backends are imported on first use, so that a process only pays for
+# (and connects to) the backends it actually uses
+BACKENDS = {
+    "expanse": "nmma_api.tools.expanse.ExpanseBackend",
+    "local": "nmma_api.tools.local.LocalBackend",
+}
+
+_backends = {}
+
+
+class Backend:
+    """
+    A compute backend, running the NMMA analyses.
+
+    Jobs are identified by the job_id returned by `submit_batch`, and their
+    outputs are laid out as `{output_dir}/{LABEL}/{LABEL}_<suffix>` (see
+    `nmma_api.tools.analysis.result_files`).
+    """
+
+    name = None
+
+    def validate_credentials(self) -> bool:
+        """Check that the backend is reachable and usable."""
+        raise NotImplementedError
+
+    def submit_batch(self, analyses: list[dict]) -> dict:
+        """
+        Submit analyses to the backend.
+
+        Parameters
+        ----------
+        analyses : list[dict]
+            The analysis requests.
+
+        Returns
+        -------
+        dict
+            For each analysis _id, a dict with the job_id (None if the
+            submission failed), the submitted_at timestamp and a message.
+        """
+        raise NotImplementedError
+
+    def fetch(self, analysis: dict) -> str:
+        """
+        Make the outputs of an analysis available locally.
+
+        Returns
+        -------
+        str
+            The local directory with the outputs, or None if the analysis
+            has not completed yet.
+        """
+        raise NotImplementedError
+
+    def release(self, analysis: dict):
+        """
+        Free the local copy of the outputs of an analysis (see `fetch`), once they
+        are not needed anymore: its results are packaged and stored for delivery,
+        or it ended without results (e.g. its webhook expired).
+        """
+        pass
+
+    def cleanup(self):
+        """Delete the local outputs left over (e.g. past their retention), called every retrieval cycle."""
+        pass
+
+    def fetch_results(self, analysis: dict) -> dict:
+        """
+        Fetch and package the results of an analysis.
+
+        Returns
+        -------
+        dict
+            The results to upload to the webhook, or None if the analysis
+            has not completed yet.
+        """
+        log(
+            f"Retrieving results for analysis {analysis['_id']} ({analysis['resource_id']}, {analysis['created_at']})"
+        )
+        local_dir = self.fetch(analysis)
+        if local_dir is None:
+            return None
+        return package_results(analysis, local_dir)
+
+    def cancel(self, job_id) -> bool:
+        """Cancel a job, returning whether it was cancelled."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def backend_name(analysis: dict = None) -> str:
+    """
+    Get the name of the backend running an analysis.
+
+    Analyses that have already been submitted keep the backend they were submitted to,
+    others are routed per model (see the resource profiles of the model registry).
+    """
+    if analysis is not None:
+        if analysis.get("backend") is not None:
+            return analysis["backend"]
+        model = analysis.get("inputs", {}).get("analysis_parameters", {}).get("source")
+        if model in model_registry():
+            return model_registry()[model].resources["backend"]
+    return config.get("backends.default") or "expanse"
+
+
+def get_backend(name: str = None) -> Backend:
+    """Get the (per-process) instance of a backend, by default the default backend."""
+    if name is None:
+        name = backend_name()
+    if name not in BACKENDS:
+        raise ValueError(
+            f"backend {name} is not supported, must be one of: {', '.join(BACKENDS)}"
+        )
+    if name not in _backends:
+        module_name, class_name = BACKENDS[name].rsplit(".", 1)
+        module = importlib.import_module(module_name)
+        _backends[name] = getattr(module, class_name)()
+    return _backends[name]
+
+
+def set_backend(name: str, backend: Backend):
+    """Replace the instance of a backend (e.g. with one using a simulated cluster)."""
+    _backends[name] = backend
+
+
+def configured_backends() -> list[str]:
+    """Names of all the backends analyses can be routed to."""
+    names = [backend_name()] + list((config.get("backends.models") or {}).values())
+    return list(dict.fromkeys(names))
@@ -0,0 +1,128 @@
+import time
+
+from pymongo import ReturnDocument
+
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import make_log
+from nmma_api.utils.mongo import Mongo
+
+log = make_log("breaker")
+
+config = load_config()
+
+mongo = Mongo(**config["database"])
+
+breaker_config = config.get("breaker") or {}
+failure_threshold = breaker_config.get("failure_threshold", 5)
+open_duration = breaker_config.get("open_duration", 300)  # in seconds
+max_in_flight_per_host = breaker_config.get("max_in_flight_per_host", 2)
+# a probe not reported within this delay is considered lost (its worker died)
+probe_timeout = breaker_config.get("probe_timeout", 300)  # in seconds
+
+# The circuit breaker of each callback host is stored in the breakers collection,
+# so that all workers share it:
+# - closed: uploads go through, consecutive failures are counted
+# - open: after `failure_threshold` consecutive failures, no upload is attempted
+#   until `retry_at`, `open_duration` later
+# - half_open: a single upload (the probe) is attempted, closing the breaker
+#   if it succeeds or opening it again if it fails
+
+
+def blocked_hosts() -> list:
+    """The callback hosts whose breaker doesn't let any upload through right now."""
+    now = time.time()
+    return [
+        breaker["_id"]
+        for breaker in mongo.db.breakers.find(
+            {
+                "$or": [
+                    {"state": "open", "retry_at": {"$gt": now}},
+                    {"state": "half_open", "probe_until": {"$gt": now}},
+                ]
+            },
+            {"_id": 1},
+        )
+    ]
+
+
+def allow(host: str, worker: str) -> bool:
+    """
+    Check whether an upload to a callback host can be attempted.
+
+    Once the breaker of an open host is due for a retry, the first worker asking
+    gets to send the probe, and the breaker turns half-open.
+    """
+    now = time.time()
+    breaker = mongo.db.breakers.find_one({"_id": host})
+    if breaker is None or breaker["state"] == "closed":
+        return True
+
+    probe = mongo.db.breakers.find_one_and_update(
+        {
+            "_id": host,
+            "$or": [
+                {"state": "open", "retry_at": {"$lte": now}},
+                {"state": "half_open", "probe_until": {"$lte": now}},
+            ],
+        },
+        {
+            "$set": {
+                "state": "half_open",
+                "probe_until": now + probe_timeout,
+                "probe_by": worker,
+            }
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+    if probe is not None:
+        log(f"Probing callback host {host}")
+    return probe is not None
+
+
+def record(host: str, success: bool):
+    """Record the outcome of an upload to a callback host, tripping its breaker if needed."""
+    now = time.time()
+    if success:
+        breaker = mongo.db.breakers.find_one_and_update(
+            {"_id": host},
+            {"$set": {"state": "closed", "failures": 0, "last_success_at": now}},
+            upsert=True,
+        )
+        if breaker is not None and breaker.get("state") != "closed":
+            log(f"Closed the circuit breaker of callback host {host}")
+        return
+
+    breaker = mongo.db.breakers.find_one_and_update(
+        {"_id": host},
+        {
+            "$inc": {"failures": 1},
+            "$set": {"last_failure_at": now},
+            "$setOnInsert": {"state": "closed"},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    if breaker["state"] == "half_open" or (
+        breaker["state"] == "closed" and breaker["failures"] >= failure_threshold
+    ):
+        log(
+            f"Opened the circuit breaker of callback host {host} after {breaker['failures']} consecutive failures"
+        )
+        mongo.db.breakers.update_one(
+            {"_id": host},
+            {
+                "$set": {
+                    "state": "open",
+                    "opened_at": now,
+                    "retry_at": now + open_duration,
+                }
+            },
+        )
+
+
+def breakers() -> list:
+    """The state of the circuit breakers of all the callback hosts, for monitoring."""
+    return [
+        {"host": breaker.pop("_id"), **breaker}
+        for breaker in mongo.db.breakers.find().sort("_id")
+    ]
@@ -1,10 +1,13 @@
-import requests
-import yaml
-import os
+import functools
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional
 
-# we map sncosmo filters for which we have no trained models to similar filters for which we do have trained models
+from nmma_api.tools.models_metadata import load_models_metadata, metadata_version
+from nmma_api.utils.config import load_config
+
+config = load_config()
 
-REPO = "https://gitlab.com/Theodlz/nmma-models/raw/main/models.yaml"
+# we map sncosmo filters for which we have no trained models to similar filters for which we do have trained models
 
 FILTERS_MAPPER = {
     "sdssg": "ps1__g",
@@ -15,47 +18,91 @@ FILTERS_MAPPER = {
 }
 
 
-def fetch_models():
-    # check if the file exists
-    try:
-        if os.path.exists("models.yaml"):
-            with open("models.yaml", "r") as f:
-                return yaml.safe_load(f)
-    except Exception:
-        pass
+ALLOWED_MODELS = ["Me2017", "Piro2021", "nugent-hyper", "TrPi2018", "Bu2022Ye"]
+CENTRAL_WAVELENGTH_MODELS = ["Me2017", "Piro2021", "nugent-hyper", "TrPi2018"]
 
-    response = requests.get(REPO)
-    content = response.content.decode("utf-8")
-    models = yaml.safe_load(content)
-    # save to file
-    with open("models.yaml", "w") as f:
-        yaml.dump(models, f)
 
-    return models
+class ModelInfo(NamedTuple):
+    name: str
+    # prior passed to NMMA: the model's own prior, or the generic sncosmo one
+    prior: str
+    # trained model whose filters are supported, None for central wavelength models (any filter)
+    tf_model: Optional[str]
+    # filters of the trained model, None if it is missing from the models metadata
+    filters: Optional[frozenset]
+    # resource profile of the model (backend, ...)
+    resources: Mapping
 
 
-CENTRAL_WAVELENGTH_MODELS = ["Me2017", "Piro2021", "nugent-hyper", "TrPi2018"]
-FIXED_FILTERS_MODELS = fetch_models()
+def model_registry() -> Mapping[str, ModelInfo]:
+    """
+    The registry of the allowed models, rebuilt when the models metadata is refreshed.
 
+    The sncosmo registry and the models metadata are only loaded on the first lookup.
+    """
+    return _build_registry(metadata_version())
 
-def verify_and_match_filter(model, filter):
-    if model in CENTRAL_WAVELENGTH_MODELS:
-        return filter
 
-    # we only support _tf models for now, so if the model does not end with _tf, we add it
-    if not model.endswith("_tf"):
-        model = model + "_tf"
+@functools.lru_cache(maxsize=1)
+def _build_registry(version: float) -> Mapping[str, ModelInfo]:
+    # the version only keys the cache, see metadata_version
+    from sncosmo.models import _SOURCES
+
+    sncosmo_names = {val["name"] for val in _SOURCES.get_loaders_metadata()}
+    fixed_filters_models = load_models_metadata()
+    default_backend = config.get("backends.default") or "expanse"
+    backends = config.get("backends.models") or {}
+    resources = config.get("model_resources") or {}
 
-    if model not in FIXED_FILTERS_MODELS:
+    registry = {}
+    for model in ALLOWED_MODELS:
+        tf_model = None
+        filters = frozenset()
+        if model not in CENTRAL_WAVELENGTH_MODELS:
+            # we only support _tf models for now, so if the model does not end with _tf, we add it
+            tf_model = model if model.endswith("_tf") else model + "_tf"
+            if tf_model in fixed_filters_models:
+                filters = frozenset(
+                    (fixed_filters_models[tf_model] or {}).get("filters", [])
+                )
+            else:
+                filters = None
+        registry[model] = ModelInfo(
+            name=model,
+            prior=model if model not in sncosmo_names else "sncosmo-generic",
+            tf_model=tf_model,
+            filters=filters,
+            resources=MappingProxyType(
+                {
+                    "backend": backends.get(model, default_backend),
+                    **(resources.get(model) or {}),
+                }
+            ),
+        )
+    return MappingProxyType(registry)
+
+
+def get_model(model: str) -> ModelInfo:
+    """Look up a model in the registry, raising a ValueError if it is not allowed."""
+    try:
+        return model_registry()[model]
+    except KeyError:
         raise ValueError(f"Model {model} not found")
 
-    if filter not in FIXED_FILTERS_MODELS[model].get("filters", []):
+
+def verify_and_match_filter(model, filter):
+    info = get_model(model)
+    if info.tf_model is None:
+        return filter
+
+    if info.filters is None:
+        raise ValueError(f"Model {info.tf_model} not found")
+
+    if filter not in info.filters:
         # see if there is a similar filter
         replacement = FILTERS_MAPPER.get(filter)
-        if replacement and replacement in FIXED_FILTERS_MODELS[model].get(
-            "filters", []
-        ):
+        if replacement and replacement in info.filters:
             return replacement
-        raise ValueError(f"Filter {filter} not found in model {model}")
+        raise ValueError(f"Filter {filter} not found in model {info.tf_model}")
 
     return filter
@@ -1,22 +1,20 @@
-import base64
-import gzip
-import json
 import os
-import tempfile
+import shlex
+import shutil
+import tarfile
+import threading
 import warnings
 from datetime import datetime
 
-import arviz as az
-import joblib
-import numpy as np
-from astropy.table import Table
-from astropy.time import Time
-from paramiko.client import SSHClient, AutoAddPolicy
-
 from nmma_api.utils.logs import make_log
 from nmma_api.utils.config import load_config
-from nmma_api.tools.enums import verify_and_match_filter
-from sncosmo.models import _SOURCES
+from nmma_api.tools.analysis import (
+    NMMA_PARAMETERS,
+    analysis_label,
+    prepare_analysis,
+    result_files,
+)
+from nmma_api.tools.backend import Backend
 
 
 config = load_config()
@@ -37,6 +35,11 @@ expanse_output_dir = os.path.join(expanse_nmma_dir, expanse_output_dirname)
 
 slurm_script_name = config["local"]["slurm_script_name"]
 
+# "sftp" stats and downloads each output file separately, "bundle" streams
+# them all back in a single compressed tar over the exec channel
+retrieval_mode = config["expanse"].get("retrieval_mode", "bundle")
+bundle_compression = config["expanse"].get("bundle_compression", "gzip")
+
 log = make_log("expanse")
 
 
@@ -46,294 +49,254 @@ class Expanse:
         self.port = port
         self.username = username
         self.password = password
-        self.client = SSHClient()
-        self.client.set_missing_host_key_policy(AutoAddPolicy())
-        self.client.connect(
-            self.host, port=self.port, username=self.username, password=self.password
-        )
+        self._client = None
+        # the client is shared by the retrieval threads, each opening its own channels
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The SSH client, connected on first use (and reconnected if the connection dropped)."""
+        with self._lock:
+            if self._client is None:
+                from paramiko.client import SSHClient, AutoAddPolicy
+
+                self._client = SSHClient()
+                self._client.set_missing_host_key_policy(AutoAddPolicy())
+                self.reconnect()
+            else:
+                transport = self._client.get_transport()
+                if transport is None or not transport.is_active():
+                    log("SSH connection to expanse dropped, reconnecting")
+                    self.reconnect()
+            return self._client
 
     def reconnect(self):
-        self.client.connect(self.host, username=self.username, password=self.password)
+        self._client.connect(
+            self.host, port=self.port, username=self.username, password=self.password
+        )
 
     def close(self):
-        self.client.close()
-
-
-expanse = Expanse(**config["expanse"]["ssh"])
+        if self._client is not None:
+            self._client.close()
+            self._client = None
 
 
-def validate_credentials() -> bool:
-    """Validate the credentials for expanse."""
-    try:
-        stdin, stdout, stderr = expanse.client.exec_command("echo 'hello world'")
-        if stdout.read() != b"hello world\n":
-            return False
-        return True
-    except Exception as e:
-        log(f"Failed to validate credentials for expanse: {e}")
-        return False
+class ExpanseBackend(Backend):
+    """Run the analyses as SLURM jobs on Expanse, over SSH."""
 
+    name = "expanse"
 
-def submit(analyses: list[dict], **kwargs) -> bool:
-    """Submit an analysis to expanse."""
-    jobs = {}
-    log(f"Submitting {len(analyses)} analysis requests to expanse")
+    def __init__(self, expanse: Expanse = None):
+        self.expanse = (
+            expanse if expanse is not None else Expanse(**config["expanse"]["ssh"])
+        )
 
-    for data_dict in analyses:
+    def validate_credentials(self) -> bool:
+        """Validate the credentials for expanse."""
         try:
-            try:
-                analysis_parameters = data_dict["inputs"].get("analysis_parameters", {})
-                timestamp = data_dict.get("created_at", None)
-                status = data_dict.get("status", None)
-
-                MODEL = analysis_parameters.get("source")
-                sncosmo_names = [val["name"] for val in _SOURCES.get_loaders_metadata()]
-                PRIOR = MODEL if MODEL not in sncosmo_names else "sncosmo-generic"
-                resource_id = data_dict.get("resource_id", "")
-                LABEL = f"{resource_id}_{timestamp}"
-                TMIN = analysis_parameters.get("tmin")
-                TMAX = analysis_parameters.get("tmax")
-                DT = analysis_parameters.get("dt")
-                SKIP_SAMPLING = ""
-                if status == "job_expired":
-                    SKIP_SAMPLING = "--skip-sampling"
-
-                # this example analysis service expects the photometry to be in
-                # a csv file (at data_dict["inputs"]["photometry"]) with the following columns
-                # - filter: the name of the bandpass
-                # - mjd: the modified Julian date of the observation
-                # - magsys: the mag system (e.g. ab) of the observations
-                # - flux: the flux of the observation
-                #
-                # the following code transforms these inputs from SkyPortal
-                # to the format expected by nmma.
-                #
-
-                # first, decompress the data
-                data_decompressed = gzip.decompress(
-                    data_dict["inputs"]["photometry"]
-                ).decode()
-                redshift_decompressed = gzip.decompress(
-                    data_dict["inputs"]["redshift"]
-                ).decode()
-                data = Table.read(data_decompressed, format="ascii.csv")
-                redshift = Table.read(redshift_decompressed, format="ascii.csv")
-                z = redshift["redshift"][0]  # noqa F841
-            except Exception as e:
-                raise ValueError(f"input data is not in the expected format {e}")
+            stdin, stdout, stderr = self.expanse.client.exec_command(
+                "echo 'hello world'"
+            )
+            if stdout.read() != b"hello world\n":
+                return False
+            return True
+        except Exception as e:
+            log(f"Failed to validate credentials for expanse: {e}")
+            return False
+
+    def submit_batch(self, analyses: list[dict]) -> dict:
+        """Submit analyses to expanse."""
+        jobs = {}
+        log(f"Submitting {len(analyses)} analysis requests to expanse")
 
-            skipped = 0
-            skipped_filters = []
+        for data_dict in analyses:
             try:
-                # Set trigger time based on first detection
-                TT = np.min(data[data["mag"] != np.ma.masked]["mjd"])
-
-                # Give each source a different filename. This file will be copied to Expanse.
-                filename = f"{resource_id}_{timestamp}.dat"
-                os.makedirs(local_data_dir, exist_ok=True)
-
-                local_data_path = os.path.join(local_data_dir, filename)
-                with open(local_data_path, "w") as f:
-                    # output the data in the format desired by NMMA:
-                    # remove rows where mag and magerr are missing, or not float, or negative
-                    data = data[
-                        np.isfinite(data["mag"])
-                        & np.isfinite(data["magerr"])
-                        & (data["mag"] > 0)
-                        & (data["magerr"] > 0)
-                    ]
-                    for row in data:
-                        tt = Time(row["mjd"], format="mjd").isot
-                        try:
-                            filt = verify_and_match_filter(MODEL, row["filter"])
-                        except ValueError:
-                            skipped += 1
-                            skipped_filters.append(row["filter"])
-                            continue
-                        mag = row["mag"]
-                        magerr = row["magerr"]
-                        f.write(f"{tt} {filt} {mag} {magerr}\n")
-                    if skipped == len(data):
-                        raise ValueError("no valid filters found in photometry data")
+                parameters = prepare_analysis(data_dict, local_data_dir)
+
+                try:
+                    self.expanse.client.exec_command(f"mkdir {expanse_data_dir}")
+
+                    expanse_data_path = os.path.join(
+                        expanse_data_dir,
+                        os.path.basename(parameters["local_data_path"]),
+                    )
+
+                    sftp = self.expanse.client.open_sftp()
+                    sftp.put(parameters["local_data_path"], expanse_data_path)
+                    sftp.close()
+
+                    run_parameters = {**parameters, "DATA": expanse_data_path}
+                    exports = ",".join(
+                        f"{key}={run_parameters[key]}" for key in NMMA_PARAMETERS
+                    )
+
+                    _, stdout, stderr = self.expanse.client.exec_command(
+                        f"cd {expanse_nmma_dir}; sbatch --export={exports} {slurm_script_name}"
+                    )
+                except Exception as e:
+                    raise ValueError(f"failed to submit job {e}")
+
+                submit_message = stdout.read().decode("utf-8").strip()
+                submit_error = stderr.read().decode("utf-8").strip()
+
+                if submit_error != "":
+                    warnings.warn(f"Submission error: {submit_error}")
+                    raise ValueError(f"Submission error: {submit_error}")
+                else:
+                    job_id = int(submit_message.split(" ")[-1].strip())
+                    jobs[data_dict["_id"]] = {
+                        "job_id": job_id,
+                        "message": parameters["message"],
+                        "submitted_at": datetime.timestamp(datetime.utcnow()),
+                    }
+                    log(
+                        f"Submitted job {job_id} for analysis {data_dict['_id']}",
+                        analysis_id=data_dict["_id"],
+                        job_id=job_id,
+                    )
             except Exception as e:
-                raise ValueError(f"failed to format data {e}")
+                log(
+                    f"Failed to submit analysis {data_dict['_id']} to expanse: {e}",
+                    level="error",
+                    analysis_id=data_dict["_id"],
+                )
+                jobs[data_dict["_id"]] = {"job_id": None, "message": str(e)}
+        return jobs
 
-            try:
-                expanse.client.exec_command(f"mkdir {expanse_data_dir}")
+    def fetch_results_sftp(self, LABEL: str, local_dir: str) -> bool:
+        """Download the output files of an analysis one by one over SFTP.
 
-                expanse_data_path = os.path.join(expanse_data_dir, filename)
+        Returns False if the analysis has not produced all of its outputs yet.
+        """
+        remote_dir = os.path.join(expanse_output_dir, LABEL)
+        filenames = result_files(LABEL)
 
-                sftp = expanse.client.open_sftp()
-                sftp.put(local_data_path, expanse_data_path)
-                sftp.close()
+        sftp = self.expanse.client.open_sftp()
+        try:
+            # Check if results files exist
+            for filename in filenames:
+                sftp.stat(os.path.join(remote_dir, filename))
+
+            # Download files to local directory
+            for filename in filenames:
+                sftp.get(
+                    os.path.join(remote_dir, filename),
+                    os.path.join(local_dir, filename),
+                )
+        except FileNotFoundError:
+            return False
+        finally:
+            sftp.close()
 
-                DATA = expanse_data_path
+        return True
 
-                _, stdout, stderr = expanse.client.exec_command(
-                    f"cd {expanse_nmma_dir}; sbatch --export=MODEL={MODEL},PRIOR={PRIOR},LABEL={LABEL},TT={TT},DATA={DATA},TMIN={TMIN},TMAX={TMAX},DT={DT},SKIP_SAMPLING={SKIP_SAMPLING} {slurm_script_name}"
-                )
-            except Exception as e:
-                raise ValueError(f"failed to submit job {e}")
+    def fetch_results_bundle(self, LABEL: str, local_dir: str) -> bool:
+        """Fetch the output files of an analysis in a single round-trip.
 
-            submit_message = stdout.read().decode("utf-8").strip()
-            submit_error = stderr.read().decode("utf-8").strip()
+        A single remote command checks that all the outputs exist and writes them
+        as a compressed tar to stdout, which is unpacked as it is read off the
+        exec channel. Returns False if the analysis has not produced all of its
+        outputs yet.
+        """
+        remote_dir = os.path.join(expanse_output_dir, LABEL)
+        filenames = result_files(LABEL)
 
-            if submit_error != "":
-                warnings.warn(f"Submission error: {submit_error}")
-                raise ValueError(f"Submission error: {submit_error}")
-            else:
-                job_id = int(submit_message.split(" ")[-1].strip())
-                jobs[data_dict["_id"]] = {
-                    "job_id": job_id,
-                    "message": "",
-                    "submitted_at": datetime.timestamp(datetime.utcnow()),
-                }
-                if skipped > 0:
-                    jobs[data_dict["_id"]][
-                        "message"
-                    ] = f"Skipped {skipped} observations with filters: {', '.join(list(set(skipped_filters)))} as they are not supported by the model."
-                log(f"Submitted job {job_id} for analysis {data_dict['_id']}")
-        except Exception as e:
-            log(f"Failed to submit analysis {data_dict['_id']} to expanse: {e}")
-            jobs[data_dict["_id"]] = {"job_id": None, "message": str(e)}
-    return jobs
-
-
-def retrieve(analysis: dict) -> dict:
-    """Retrieve analyses results from expanse."""
-    # retrieve the results from expanse
-    # look into the expanse directory for the results
-    # copy the results to the local directory
-    # update the database
-    # return the results
-
-    log(
-        f"Retrieving results for analysis {analysis['_id']} ({analysis['resource_id']}, {analysis['created_at']})"
-    )
-
-    LABEL = f"{analysis['resource_id']}_{analysis['created_at']}"
-    os.makedirs(os.path.join(local_output_dir, LABEL), exist_ok=True)
-
-    posterior_file = os.path.join(
-        expanse_output_dir, f"{LABEL}/{LABEL}_posterior_samples.dat"
-    )
-    local_posterior_file = os.path.join(
-        local_output_dir, f"{LABEL}/{LABEL}_posterior_samples.dat"
-    )
-
-    json_file = os.path.join(expanse_output_dir, f"{LABEL}/{LABEL}_result.json")
-    local_json_file = os.path.join(local_output_dir, f"{LABEL}/{LABEL}_result.json")
-
-    lightcurves_file = os.path.join(
-        expanse_output_dir, f"{LABEL}/{LABEL}_lightcurves.png"
-    )
-    local_lightcurves_file = os.path.join(
-        local_output_dir, f"{LABEL}/{LABEL}_lightcurves.png"
-    )
-
-    local_temp_files = []
-
-    sftp = expanse.client.open_sftp()
-
-    try:
-        # Check if results files exist
-        sftp.stat(posterior_file)
-        sftp.stat(json_file)
-        sftp.stat(lightcurves_file)
-
-        # Download files to local directory
-        sftp.get(posterior_file, local_posterior_file)
-        sftp.get(json_file, local_json_file)
-        sftp.get(lightcurves_file, local_lightcurves_file)
-
-        # Structure files to prepare for return
-        tab = Table.read(local_posterior_file, format="csv", delimiter=" ")
-        inference = az.convert_to_inference_data(tab.to_pandas().to_dict(orient="list"))
-
-        f = tempfile.NamedTemporaryFile(
-            suffix=".nc", prefix="inferencedata_", delete=False
+        compression = bundle_compression
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                log("zstandard is not installed, falling back to gzip bundles")
+                compression = "gzip"
+
+        checks = " && ".join(f"test -f {shlex.quote(name)}" for name in filenames)
+        tar_flag = "--zstd" if compression == "zstd" else "-z"
+        command = (
+            f"cd {shlex.quote(remote_dir)} 2>/dev/null && {checks} && "
+            f"tar -c {tar_flag} -f - {' '.join(shlex.quote(n) for n in filenames)}"
         )
-        f.close()
+        _, stdout, stderr = self.expanse.client.exec_command(command)
 
-        inference.to_netcdf(f.name)
-        inference_data = base64.b64encode(open(f.name, "rb").read()).decode()
-        local_temp_files.append(f.name)
-
-        with open(local_json_file) as f:
-            result = json.load(f)
-        log_bayes_factor = result["log_bayes_factor"]
+        if compression == "zstd":
+            stream = zstandard.ZstdDecompressor().stream_reader(stdout)
+            mode = "r|"
+        else:
+            stream = stdout
+            mode = "r|gz"
 
-        # Remove some keys to maintain a reasonable results size
-        pop_list = ["samples", "nested_samples"]
-        [result.pop(x) for x in pop_list]
+        extracted = set()
+        try:
+            with tarfile.open(fileobj=stream, mode=mode) as tar:
+                for member in tar:
+                    if member.name not in filenames or not member.isfile():
+                        continue
+                    with open(os.path.join(local_dir, member.name), "wb") as f:
+                        f.write(tar.extractfile(member).read())
+                    extracted.add(member.name)
+        except tarfile.ReadError:
+            # nothing was written to stdout: the outputs are not there (yet)
+            pass
+
+        exit_status = stdout.channel.recv_exit_status()
+        bundle_error = stderr.read().decode("utf-8").strip()
+        if bundle_error != "":
+            raise ValueError(f"Bundle error: {bundle_error}")
+        if exit_status != 0 or len(extracted) != len(filenames):
+            return False
 
-        if "warning" in analysis:
-            result["warning"] = analysis["warning"]
+        return True
 
-        f = tempfile.NamedTemporaryFile(suffix=".png", prefix="nmmaplot_", delete=False)
-        f.close()
+    def fetch(self, analysis: dict) -> str:
+        """Download the outputs of an analysis, returning the local directory they are in
+        (or None if the analysis has not completed yet)."""
+        LABEL = analysis_label(analysis)
+        local_label_dir = os.path.join(local_output_dir, LABEL)
+        os.makedirs(local_label_dir, exist_ok=True)
 
-        plot_data = base64.b64encode(open(local_lightcurves_file, "rb").read()).decode()
-        local_temp_files.append(f.name)
+        if retrieval_mode == "bundle":
+            fetched = self.fetch_results_bundle(LABEL, local_label_dir)
+        else:
+            fetched = self.fetch_results_sftp(LABEL, local_label_dir)
+        return local_label_dir if fetched else None
 
-        f = tempfile.NamedTemporaryFile(
-            suffix=".joblib", prefix="results_", delete=False
+    def release(self, analysis: dict):
+        """Delete the downloaded outputs of an analysis, once they are not needed anymore."""
+        shutil.rmtree(
+            os.path.join(local_output_dir, analysis_label(analysis)), ignore_errors=True
         )
-        f.close()
-
-        joblib.dump(result, f.name, compress=3)
-        result_data = base64.b64encode(open(f.name, "rb").read()).decode()
-        local_temp_files.append(f.name)
-
-        analysis_results = {
-            "inference_data": {"format": "netcdf4", "data": inference_data},
-            "plots": [{"format": "png", "data": plot_data}],
-            "results": {"format": "joblib", "data": result_data},
-        }
-
-        results = {
-            "analysis": analysis_results,
-            "status": "success",
-            "message": f"Good results with log Bayes factor={log_bayes_factor}",
-        }
-
-    except FileNotFoundError:
-        return None
-    finally:
-        sftp.close()
-        for f in local_temp_files:
-            try:
-                os.remove(f)
-            except:  # noqa E722
-                pass
-
-    return results
 
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a job on expanse."""
+        if job_id is None:
+            return False
+        try:
+            _, stdout, stderr = self.expanse.client.exec_command(f"scancel {job_id}")
+            # TODO: verify that the cancel error is in that format
+            cancel_error = stderr.read().decode("utf-8").strip()
 
-def cancel_job(job_id: int) -> bool:
-    """Cancel a job on expanse."""
-    if job_id is None:
-        return False
-    try:
-        _, stdout, stderr = expanse.client.exec_command(f"scancel {job_id}")
-        # TODO: verify that the cancel error is in that format
-        cancel_error = stderr.read().decode("utf-8").strip()
+            if cancel_error != "":
+                warnings.warn(f"Cancel error: {cancel_error}")
+                raise ValueError(f"Cancel error: {cancel_error}")
+            else:
+                log(f"Cancelled job {job_id}", job_id=job_id)
+        except Exception as e:
+            log(
+                f"Failed to cancel job {job_id} on expanse: {e}",
+                level="error",
+                job_id=job_id,
+            )
+            return False
+        return True
 
-        if cancel_error != "":
-            warnings.warn(f"Cancel error: {cancel_error}")
-            raise ValueError(f"Cancel error: {cancel_error}")
-        else:
-            log(f"Cancelled job {job_id}")
-    except Exception as e:
-        log(f"Failed to cancel job {job_id} on expanse: {e}")
-        return False
-    return True
+    def close(self):
+        self.expanse.close()
 
 
 if __name__ == "__main__":
-    valid = validate_credentials()
+    backend = ExpanseBackend()
+    valid = backend.validate_credentials()
     if not valid:
         log("Invalid credentials for expanse")
         exit(1)
     log("Valid credentials for expanse")
-    expanse.close()
+    backend.close()
@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from nmma_api.utils.config import load_config
+
+config = load_config()
+
+# the events of an analysis are bounded, e.g. if its job keeps expiring and being resubmitted
+max_events = (config.get("lifecycle") or {}).get("max_events", 50)
+
+
+def event(name: str, at: datetime = None) -> dict:
+    """
+    An event of the lifecycle of an analysis: a status it transitioned to,
+    or a step without a status of its own (e.g. "fetched", its outputs retrieved).
+    """
+    return {"event": name, "at": at or datetime.utcnow()}
+
+
+def push_events(*events: dict) -> dict:
+    """The `$push` appending events to an analysis, keeping only the latest `lifecycle.max_events`."""
+    return {"events": {"$each": list(events), "$slice": -max_events}}
+
+
+def transition(status: str, **fields) -> dict:
+    """The update setting the status of an analysis (and other fields), recording the transition."""
+    return {"$set": {"status": status, **fields}, "$push": push_events(event(status))}
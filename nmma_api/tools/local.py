@@ -0,0 +1,274 @@
+import os
+import shutil
+import signal
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from nmma_api.tools.analysis import (
+    NMMA_PARAMETERS,
+    analysis_label,
+    prepare_analysis,
+    result_files,
+)
+from nmma_api.tools.backend import Backend
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import make_log
+
+config = load_config()
+
+local_nmma_dir = config["local"]["nmma_dir"]
+local_data_dir = os.path.join(local_nmma_dir, config["local"]["data_dirname"])
+slurm_script_name = config["local"]["slurm_script_name"]
+
+local_backend_config = config.get("backends.local") or {}
+max_workers = local_backend_config.get("max_workers", 2)
+# the analysis command is run from the local nmma_dir, with the NMMA parameters
+# and the OUTDIR where the outputs must be written as environment variables
+command = local_backend_config.get("command", "bash {script}")
+run_dir = os.path.join(
+    local_nmma_dir, local_backend_config.get("output_dirname", "local_outputs")
+)
+# job directories unmodified for longer are deleted, whatever happened to their analysis
+retention = local_backend_config.get("retention_days", 7) * 86400  # in seconds
+# in seconds, between two scans of the job directories for the retention
+cleanup_interval = 3600
+
+JOB_ID_PREFIX = "local:"
+PID_FILENAME = "job.pid"
+CANCELLED_FILENAME = "job.cancelled"
+LOG_FILENAME = "job.log"
+
+log = make_log("local")
+
+
+def process_start_time(pid: int) -> str:
+    """
+    The start time of a process (in clock ticks since boot, from /proc), which tells
+    it apart from a later process reusing its pid. None if there is no such process.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the fields after the command name (in parentheses, which may contain spaces)
+    start = stat.rindex(")") + 2
+    return stat[start:].split()[19]
+
+
+def job_pid(output_dir: str) -> int:
+    """
+    The pid of the process group of the job running in an output directory, None if
+    it is not running: the pid file is missing, or its pid now belongs to another process.
+    """
+    try:
+        with open(os.path.join(output_dir, PID_FILENAME)) as f:
+            pid, start_time = f.read().split()
+    except (OSError, ValueError):
+        return None
+    if process_start_time(int(pid)) != start_time:
+        return None
+    return int(pid)
+
+
+def run_analysis(command: str, cwd: str, env: dict, output_dir: str) -> int:
+    """
+    Run the analysis command, writing its pid and logs in its output directory.
+
+    This runs in one of the processes of the pool, so the state of the job
+    is kept on disk where any process (e.g. the retrieval queue) can see it.
+    The pid file records the start time of the process too, and is removed
+    once it exits, so that a recycled pid is never mistaken for the job.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists(os.path.join(output_dir, CANCELLED_FILENAME)):
+        return -1
+
+    with open(os.path.join(output_dir, LOG_FILENAME), "w") as logfile:
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            cwd=cwd,
+            env={**os.environ, **env},
+            stdout=logfile,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        # not reaped until waited for, so its start time can still be read if it exited
+        with open(os.path.join(output_dir, PID_FILENAME), "w") as f:
+            f.write(f"{process.pid} {process_start_time(process.pid)}")
+        try:
+            return process.wait()
+        finally:
+            os.remove(os.path.join(output_dir, PID_FILENAME))
+
+
+class LocalBackend(Backend):
+    """Run the analyses on this host, in a pool of processes."""
+
+    name = "local"
+
+    def __init__(self):
+        self.executor = None
+        self.cleaned_at = 0
+
+    def validate_credentials(self) -> bool:
+        """Check that the analysis script can be found."""
+        return os.path.isfile(os.path.join(local_nmma_dir, slurm_script_name))
+
+    def submit_batch(self, analyses: list[dict]) -> dict:
+        """Submit analyses to the local process pool."""
+        jobs = {}
+        log(f"Submitting {len(analyses)} analysis requests to the local backend")
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+        for data_dict in analyses:
+            try:
+                parameters = prepare_analysis(data_dict, local_data_dir)
+                output_dir = os.path.join(run_dir, parameters["LABEL"])
+                os.makedirs(output_dir, exist_ok=True)
+                # clear the state of a previous run (e.g. before a plot-only resubmission)
+                for filename in [PID_FILENAME, CANCELLED_FILENAME]:
+                    if os.path.exists(os.path.join(output_dir, filename)):
+                        os.remove(os.path.join(output_dir, filename))
+
+                run_parameters = {**parameters, "DATA": parameters["local_data_path"]}
+                env = {key: str(run_parameters[key]) for key in NMMA_PARAMETERS}
+                env["OUTDIR"] = output_dir
+
+                self.executor.submit(
+                    run_analysis,
+                    command.format(script=slurm_script_name),
+                    local_nmma_dir,
+                    env,
+                    output_dir,
+                )
+                job_id = f"{JOB_ID_PREFIX}{parameters['LABEL']}"
+                jobs[data_dict["_id"]] = {
+                    "job_id": job_id,
+                    "message": parameters["message"],
+                    "submitted_at": datetime.timestamp(datetime.utcnow()),
+                }
+                log(f"Submitted job {job_id} for analysis {data_dict['_id']}")
+            except Exception as e:
+                log(
+                    f"Failed to submit analysis {data_dict['_id']} to the local backend: {e}"
+                )
+                jobs[data_dict["_id"]] = {"job_id": None, "message": str(e)}
+        return jobs
+
+    def completed(self, analysis: dict) -> bool:
+        """Check if the outputs of an analysis have been written."""
+        LABEL = analysis_label(analysis)
+        return all(
+            os.path.isfile(os.path.join(run_dir, LABEL, filename))
+            for filename in result_files(LABEL)
+        )
+
+    def fetch(self, analysis: dict) -> str:
+        """The outputs are written locally, return their directory once they are all written."""
+        if not self.completed(analysis):
+            return None
+        return os.path.join(run_dir, analysis_label(analysis))
+
+    def orphaned(self, analysis: dict) -> bool:
+        """
+        Check if the job of a running analysis was lost: it is neither running nor
+        completed, e.g. queued in (or run by) the pool of a process that since stopped.
+
+        Only meaningful before this process submits jobs, as its own queued jobs
+        are not running yet either.
+        """
+        if analysis.get("job_id") is None or self.completed(analysis):
+            return False
+        return job_pid(os.path.join(run_dir, analysis_label(analysis))) is None
+
+    def release(self, analysis: dict):
+        """
+        Delete the job directory of an analysis, once its outputs are not needed anymore.
+
+        Only its cancelled marker is kept (removed with the retention), as the job may
+        still be queued in the pool of the submission queue, and must not start then.
+        """
+        output_dir = os.path.join(run_dir, analysis_label(analysis))
+        if not os.path.isdir(output_dir) or job_pid(output_dir) is not None:
+            return
+        open(os.path.join(output_dir, CANCELLED_FILENAME), "w").close()
+        for entry in os.scandir(output_dir):
+            if entry.name == CANCELLED_FILENAME:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+    def cleanup(self):
+        """
+        Delete the job directories unmodified for the retention period, every `cleanup_interval`.
+
+        Only the directories of jobs (with a job log or a cancelled marker), and empty ones,
+        are deleted, in case the output directory is shared. Jobs still running are kept.
+        """
+        now = time.time()
+        if now - self.cleaned_at < cleanup_interval or not os.path.isdir(run_dir):
+            return
+        self.cleaned_at = now
+        deleted = 0
+        for directory in os.scandir(run_dir):
+            if not directory.is_dir(follow_symlinks=False):
+                continue
+            try:
+                names = os.listdir(directory.path)
+                modified_at = max(
+                    [directory.stat().st_mtime]
+                    + [
+                        os.stat(os.path.join(directory.path, name)).st_mtime
+                        for name in names
+                    ]
+                )
+            except OSError:
+                continue
+            if now - modified_at < retention:
+                continue
+            if len(names) == 0:
+                os.rmdir(directory.path)
+            elif LOG_FILENAME in names or CANCELLED_FILENAME in names:
+                if job_pid(directory.path) is not None:
+                    continue
+                shutil.rmtree(directory.path, ignore_errors=True)
+            else:
+                continue
+            deleted += 1
+        if deleted > 0:
+            log(f"Deleted {deleted} job directories older than the retention period")
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a local job, whether it is running or still queued."""
+        if job_id is None or not str(job_id).startswith(JOB_ID_PREFIX):
+            return False
+        output_dir = os.path.join(run_dir, str(job_id).removeprefix(JOB_ID_PREFIX))
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            # prevents the job from starting if it is still queued
+            open(os.path.join(output_dir, CANCELLED_FILENAME), "w").close()
+            # only if it is still the process this backend started
+            pid = job_pid(output_dir)
+            if pid is not None:
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            log(f"Cancelled job {job_id}")
+        except Exception as e:
+            log(f"Failed to cancel local job {job_id}: {e}")
+            return False
+        return True
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,171 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+
+import yaml
+
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import make_log
+
+log = make_log("models_metadata")
+
+config = load_config()
+
+metadata_config = config.get("models_metadata") or {}
+url = metadata_config.get(
+    "url", "https://gitlab.com/Theodlz/nmma-models/raw/main/models.yaml"
+)
+cache_path = metadata_config.get("cache_path", "cache/models.json")
+ttl = metadata_config.get("ttl", 86400)
+request_timeout = metadata_config.get("timeout", 10)
+# in seconds, between background refreshes that failed (e.g. offline)
+retry_interval = metadata_config.get("retry_interval", 600)
+
+# snapshot shipped with the package, used when there is no cache yet and we are offline
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "models.json")
+
+_refresh_thread = None
+_refresh_started_at = 0
+_refresh_lock = threading.Lock()
+
+
+def read_entry(path: str) -> dict:
+    """Read a cache entry (models, etag, last_modified, fetched_at), None if missing or invalid."""
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        if not isinstance(entry.get("models"), dict):
+            return None
+        return entry
+    except (OSError, ValueError):
+        return None
+
+
+def write_entry(path: str, entry: dict):
+    """Write a cache entry atomically, so that readers never see a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, prefix=".models_", suffix=".json", delete=False
+    ) as f:
+        json.dump(entry, f)
+    os.replace(f.name, path)
+
+
+def refresh(path: str = None) -> dict:
+    """
+    Download the models metadata, if it changed since it was last cached.
+
+    Parameters
+    ----------
+    path : str, optional
+        The cache file to refresh, by default the configured cache path.
+
+    Returns
+    -------
+    dict
+        The refreshed cache entry, or None if the download failed.
+    """
+    import requests
+
+    path = path or cache_path
+    entry = read_entry(path)
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        response = requests.get(url, headers=headers, timeout=request_timeout)
+        if response.status_code == 304 and entry is not None:
+            entry["fetched_at"] = time.time()
+        elif response.status_code == 200:
+            models = yaml.safe_load(response.content.decode("utf-8"))
+            if not isinstance(models, dict):
+                raise ValueError("models metadata is not a mapping")
+            entry = {
+                "models": models,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+                or formatdate(usegmt=True),
+                "fetched_at": time.time(),
+            }
+        else:
+            raise ValueError(f"status code {response.status_code}")
+        write_entry(path, entry)
+        return entry
+    except Exception as e:
+        log(f"Failed to refresh models metadata from {url}: {e}")
+        return None
+
+
+def refresh_in_background():
+    """
+    Refresh the cache in a background thread, at most one at a time per process,
+    and at most every `retry_interval` seconds.
+    """
+    global _refresh_thread, _refresh_started_at
+    with _refresh_lock:
+        if _refresh_thread is not None and _refresh_thread.is_alive():
+            return
+        if time.time() - _refresh_started_at < retry_interval:
+            return
+        _refresh_started_at = time.time()
+        _refresh_thread = threading.Thread(target=refresh, daemon=True)
+        _refresh_thread.start()
+
+
+def metadata_version() -> float:
+    """
+    The version of the cached models metadata (the mtime of the cache file, rewritten
+    by each refresh, in this process or another), None if there is no cache yet.
+
+    Also starts a background refresh if the cache is missing or older than the TTL,
+    so that long-running processes keyed on this version pick up the new metadata.
+    """
+    try:
+        version = os.path.getmtime(cache_path)
+    except OSError:
+        version = None
+    if version is None or time.time() - version > ttl:
+        refresh_in_background()
+    return version
+
+
+def load_models_metadata() -> dict:
+    """
+    Load the models metadata (filters of each trained model).
+
+    Uses the local cache, refreshing it in the background once it is older than
+    the configured TTL. Without a cache, falls back to the bundled snapshot (and
+    refreshes in the background), and only downloads synchronously as a last resort.
+    """
+    entry = read_entry(cache_path)
+    if entry is not None:
+        if time.time() - entry.get("fetched_at", 0) > ttl:
+            refresh_in_background()
+        return entry["models"]
+
+    snapshot = read_entry(SNAPSHOT_PATH)
+    if snapshot is not None:
+        refresh_in_background()
+        return snapshot["models"]
+
+    entry = refresh()
+    if entry is None:
+        log("No models metadata available, models with fixed filters won't be usable")
+        return {}
+    return entry["models"]
+
+
+if __name__ == "__main__":
+    # update the bundled snapshot
+    entry = refresh(SNAPSHOT_PATH)
+    if entry is None:
+        exit(1)
+    log(f"Updated the snapshot with {len(entry['models'])} models")
@@ -0,0 +1,216 @@
+import time
+from datetime import datetime
+
+from pymongo import ASCENDING, ReturnDocument
+
+from nmma_api.tools.lifecycle import transition
+from nmma_api.tools.webhook import backoff_delay, callback_host, max_attempts
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import make_log
+from nmma_api.utils.mongo import Mongo
+
+log = make_log("outbox")
+
+config = load_config()
+
+mongo = Mongo(**config["database"])
+
+# a claimed delivery is reclaimed by another worker once its lease expired,
+# it must be longer than an attempt (the webhook request timeout applies to the
+# connection and to each read, so allow for at least twice that)
+lease_duration = (config.get("outbox") or {}).get("lease", 300)  # in seconds
+
+
+def create_indexes():
+    mongo.db.outbox.create_index(
+        [("status", ASCENDING), ("next_attempt_at", ASCENDING)]
+    )
+    mongo.db.outbox.create_index([("analysis_id", ASCENDING)])
+    mongo.db.outbox.create_index([("callback_host", ASCENDING)])
+    mongo.db.outbox.create_index([("status", ASCENDING), ("invalid_after", ASCENDING)])
+
+
+def enqueue(
+    analysis: dict,
+    results: dict,
+    status_on_delivery: str = None,
+    status_on_failure: str = None,
+):
+    """
+    Add the delivery of results to the webhook of an analysis to the outbox.
+
+    Parameters
+    ----------
+    analysis : dict
+        The analysis request.
+    results : dict
+        The results to upload.
+    status_on_delivery : str, optional
+        The status to set on the analysis once the results are delivered.
+    status_on_failure : str, optional
+        The status to set on the analysis if the delivery failed for good.
+    """
+    now = time.time()
+    mongo.db.outbox.insert_one(
+        {
+            "analysis_id": analysis["_id"],
+            "callback_url": analysis["callback_url"],
+            "callback_host": callback_host(analysis["callback_url"]),
+            "callback_method": analysis["callback_method"],
+            "invalid_after": analysis.get("invalid_after"),
+            "results": results,
+            "status": "pending",
+            "status_on_delivery": status_on_delivery,
+            "status_on_failure": status_on_failure,
+            "nb_attempts": 0,
+            "attempts": [],
+            "created_at": now,
+            "next_attempt_at": now,
+            "lease_until": None,
+            "worker": None,
+        }
+    )
+
+
+def claim(worker: str, excluded_hosts: list = None) -> dict:
+    """
+    Claim the next delivery due, with a lease, so that no other worker sends it meanwhile.
+
+    Parameters
+    ----------
+    worker : str
+        The identifier of the worker claiming the delivery.
+    excluded_hosts : list, optional
+        Callback hosts whose deliveries can't be sent right now.
+
+    Returns
+    -------
+    dict
+        The outbox entry, or None if no delivery is due.
+    """
+    now = time.time()
+    return mongo.db.outbox.find_one_and_update(
+        {
+            "invalid_after": {"$not": {"$lt": datetime.utcnow()}},
+            "$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                # the worker that claimed it died, or is stuck
+                {"status": "delivering", "lease_until": {"$lt": now}},
+            ],
+            "callback_host": {"$nin": excluded_hosts or []},
+        },
+        {
+            "$set": {
+                "status": "delivering",
+                "lease_until": now + lease_duration,
+                "worker": worker,
+            }
+        },
+        sort=[("next_attempt_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def release(entry: dict, worker: str):
+    """Give up a claimed delivery without attempting it, so that it can be claimed again."""
+    mongo.db.outbox.update_one(
+        {"_id": entry["_id"], "worker": worker},
+        {"$set": {"status": "pending", "lease_until": None}},
+    )
+
+
+def expire() -> int:
+    """Mark the deliveries whose webhook has expired, and their analyses, as expired."""
+    query = {
+        "status": {"$in": ["pending", "delivering"]},
+        "invalid_after": {"$lt": datetime.utcnow()},
+    }
+    expired = list(
+        mongo.db.outbox.find(query, {"analysis_id": 1, "status_on_delivery": 1})
+    )
+    if len(expired) == 0:
+        return 0
+    log(f"{len(expired)} deliveries webhook has expired. Skipping.")
+    mongo.db.outbox.update_many(
+        {"_id": {"$in": [entry["_id"] for entry in expired]}, **query},
+        {"$set": {"status": "expired", "lease_until": None}, "$unset": {"results": ""}},
+    )
+    # only the analyses waiting for their results to be delivered, failures are already final
+    mongo.db.analysis.update_many(
+        {
+            "_id": {
+                "$in": [
+                    entry["analysis_id"]
+                    for entry in expired
+                    if entry.get("status_on_delivery") is not None
+                ]
+            },
+            "status": "uploading",
+        },
+        transition("webhook_expired"),
+    )
+    return len(expired)
+
+
+def finish(
+    entry: dict, worker: str, status: str, analysis_status: str = None, **kwargs
+):
+    """Mark a claimed delivery as finished, dropping its results, and update its analysis."""
+    updated = mongo.db.outbox.update_one(
+        {"_id": entry["_id"], "worker": worker},
+        {
+            "$set": {"status": status, "lease_until": None, **kwargs},
+            "$unset": {"results": ""},
+        },
+    )
+    if updated.modified_count == 0:
+        log(f"Lost the lease on delivery {entry['_id']}")
+        return
+    if analysis_status is not None:
+        mongo.db.analysis.update_one(
+            {"_id": entry["analysis_id"]},
+            transition(analysis_status),
+        )
+
+
+def record_attempt(
+    entry: dict, worker: str, uploaded: bool, error: str, latency: float
+):
+    """
+    Record an attempt at sending a claimed delivery.
+
+    A successful delivery is marked as done, a failed one is retried with backoff,
+    or marked as failed after `webhook.max_attempts` attempts.
+    """
+    now = time.time()
+    nb_attempts = entry["nb_attempts"] + 1
+    mongo.db.outbox.update_one(
+        {"_id": entry["_id"], "worker": worker},
+        {
+            "$set": {"nb_attempts": nb_attempts},
+            "$push": {"attempts": {"at": now, "latency": latency, "error": error}},
+        },
+    )
+    if uploaded:
+        finish(entry, worker, "done", entry["status_on_delivery"], delivered_at=now)
+    elif nb_attempts >= max_attempts:
+        log(
+            f"Delivery {entry['_id']} failed after {nb_attempts} attempts: {error}",
+            level="error",
+            analysis_id=entry.get("analysis_id"),
+        )
+        finish(entry, worker, "failed", entry["status_on_failure"], error=error)
+    else:
+        updated = mongo.db.outbox.update_one(
+            {"_id": entry["_id"], "worker": worker},
+            {
+                "$set": {
+                    "status": "pending",
+                    "next_attempt_at": now + backoff_delay(nb_attempts - 1),
+                    "lease_until": None,
+                    "error": error,
+                }
+            },
+        )
+        if updated.modified_count == 0:
+            log(f"Lost the lease on delivery {entry['_id']}")
@@ -0,0 +1,171 @@
+from nmma_api.utils.config import load_config
+
+config = load_config()
+
+# analysis_parameters keys that can be used to override the compaction options per request
+COMPACTION_PARAMETERS = {
+    "bin_width": "photometry_bin_width",
+    "max_points": "photometry_max_points",
+    "clip": "photometry_clip",
+}
+
+TRUE_VALUES = [True, "true", "True", "1", 1]
+FALSE_VALUES = [False, "false", "False", "0", 0]
+
+
+def compaction_options(analysis: dict) -> dict:
+    """
+    Get the options used to compact the light curve of an analysis before its submission.
+
+    The defaults come from the `photometry` section of the config, which can be
+    overridden per model (`photometry.models.<model>`), and then per request
+    through the analysis parameters (see `COMPACTION_PARAMETERS`).
+
+    Parameters
+    ----------
+    analysis : dict
+        The analysis request.
+
+    Returns
+    -------
+    dict
+        The compaction options: bin_width, max_points and clip.
+
+    Raises
+    ------
+    ValueError
+        If one of the options is invalid.
+    """
+    defaults = config.get("photometry") or {}
+    analysis_parameters = analysis.get("inputs", {}).get("analysis_parameters", {})
+    model = analysis_parameters.get("source")
+
+    options = {
+        "bin_width": None,
+        "max_points": None,
+        "clip": False,
+    }
+    options.update({k: v for k, v in defaults.items() if k in options})
+    options.update((defaults.get("models") or {}).get(model) or {})
+    for key, parameter in COMPACTION_PARAMETERS.items():
+        if analysis_parameters.get(parameter) not in [None, ""]:
+            options[key] = analysis_parameters[parameter]
+
+    # analysis parameters coming from SkyPortal are often strings
+    try:
+        if options["bin_width"] is not None:
+            options["bin_width"] = float(options["bin_width"])
+    except (TypeError, ValueError):
+        raise ValueError("photometry option bin_width must be a number")
+    try:
+        if options["max_points"] is not None:
+            options["max_points"] = int(options["max_points"])
+    except (TypeError, ValueError):
+        raise ValueError("photometry option max_points must be an integer")
+
+    if options["bin_width"] is not None and not options["bin_width"] > 0:
+        raise ValueError("photometry option bin_width must be positive")
+    if options["max_points"] is not None and options["max_points"] < 1:
+        raise ValueError("photometry option max_points must be a positive integer")
+    if options["clip"] in TRUE_VALUES:
+        options["clip"] = True
+    elif options["clip"] in FALSE_VALUES:
+        options["clip"] = False
+    else:
+        raise ValueError("photometry option clip must be true or false")
+
+    return options
+
+
+def compact_photometry(
+    data, TT: float, options: dict, tmin: float = None, tmax: float = None
+) -> tuple:
+    """
+    Clip, time-bin and cap the observations of a light curve, per filter.
+
+    Within each time bin (of `bin_width` days from the trigger time), the observations
+    are replaced by their inverse-variance weighted mean, with the error of that mean.
+    Filters with more than `max_points` observations (after binning) are then thinned
+    to evenly spaced observations.
+
+    Parameters
+    ----------
+    data : astropy.table.Table
+        The observations, with mjd, filter (as expected by NMMA), mag and magerr columns.
+    TT : float
+        The trigger time, in mjd.
+    options : dict
+        The compaction options, as returned by `compaction_options`.
+    tmin, tmax : float, optional
+        The time window of the analysis, in days after the trigger time, used if clip.
+
+    Returns
+    -------
+    astropy.table.Table
+        The compacted observations, sorted by mjd (unchanged if nothing was compacted).
+    list[str]
+        A description of each reduction that was applied.
+    """
+    import numpy as np
+    from astropy.table import Table
+
+    reductions = []
+
+    if options.get("clip") and tmin is not None and tmax is not None:
+        t = np.asarray(data["mjd"], dtype=float) - TT
+        # the detection setting the trigger time is always kept
+        inside = (t >= min(float(tmin), 0)) & (t <= float(tmax))
+        if not inside.all():
+            reductions.append(
+                f"removed {int((~inside).sum())} points outside of [{tmin}, {tmax}] days after the trigger time"
+            )
+            data = data[inside]
+
+    bin_width, max_points = options.get("bin_width"), options.get("max_points")
+    if bin_width is None and max_points is None:
+        return data, reductions
+
+    columns = {"mjd": [], "filter": [], "mag": [], "magerr": []}
+    nb_points, nb_bins, capped = len(data), 0, []
+    filters = np.asarray(data["filter"]).astype(str)
+    for filt in dict.fromkeys(filters):
+        rows = filters == filt
+        mjd = np.asarray(data["mjd"][rows], dtype=float)
+        mag = np.asarray(data["mag"][rows], dtype=float)
+        magerr = np.asarray(data["magerr"][rows], dtype=float)
+        if bin_width is not None:
+            bins = np.floor((mjd - TT) / bin_width).astype(int)
+            _, inverse = np.unique(bins, return_inverse=True)
+            weights = 1 / magerr**2
+            total = np.bincount(inverse, weights)
+            mjd = np.bincount(inverse, weights * mjd) / total
+            mag = np.bincount(inverse, weights * mag) / total
+            magerr = 1 / np.sqrt(total)
+            nb_bins += len(total)
+        if max_points is not None and len(mjd) > max_points:
+            order = np.argsort(mjd)
+            indexes = order[
+                np.linspace(0, len(mjd) - 1, max_points).round().astype(int)
+            ]
+            mjd, mag, magerr = mjd[indexes], mag[indexes], magerr[indexes]
+            capped.append(filt)
+        columns["mjd"].extend(mjd)
+        columns["filter"].extend([filt] * len(mjd))
+        columns["mag"].extend(mag)
+        columns["magerr"].extend(magerr)
+
+    binned = bin_width is not None and nb_bins < nb_points
+    if not binned and len(capped) == 0:
+        return data, reductions
+    if binned:
+        reductions.append(
+            f"binned {nb_points} points into {nb_bins} bins of {bin_width} days"
+        )
+    if len(capped) > 0:
+        reductions.append(
+            f"kept {max_points} evenly spaced points of filter(s) {', '.join(capped)}"
+        )
+
+    compacted = Table(columns)
+    compacted.sort("mjd")
+    return compacted, reductions
@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from nmma_api.tools.enums import get_model
+from nmma_api.utils.config import load_config
+from nmma_api.utils.dates import parse_datetime
+
+config = load_config()
+
+polling_config = config.get("polling") or {}
+# typical duration of a job, overridden per model by `model_resources.<model>.expected_runtime`
+expected_runtime = polling_config.get("expected_runtime", 7200)  # in seconds
+expected_plot_runtime = polling_config.get("expected_plot_runtime", 900)  # in seconds
+min_interval = polling_config.get("min_interval", 60)  # in seconds
+max_interval = polling_config.get("max_interval", 600)  # in seconds
+# the next check is this fraction of the time away from the submission or the expected completion
+interval_fraction = polling_config.get("interval_fraction", 0.5)
+
+time_limit = config["expanse"].get("time_limit", 6) * 3600  # in seconds
+
+
+def expected_duration(analysis: dict) -> float:
+    """The typical duration of the job of an analysis, in seconds."""
+    if analysis.get("status") == "running_plot":
+        return expected_plot_runtime
+    model = analysis["inputs"].get("analysis_parameters", {}).get("source")
+    try:
+        return get_model(model).resources.get("expected_runtime", expected_runtime)
+    except ValueError:
+        return expected_runtime
+
+
+def next_check_at(analysis: dict, now: float = None) -> float:
+    """
+    When to check next whether the job of an analysis has completed, as a timestamp.
+
+    Checks are frequent right after the submission (for jobs failing or completing
+    quickly), get sparser, then frequent again as the job approaches its expected
+    duration, and sparser again once it overruns it. They never go past the time
+    limit of the job or the expiry of its webhook, so those are handled on time.
+    """
+    if now is None:
+        now = datetime.timestamp(datetime.utcnow())
+    elapsed = max(now - analysis["submitted_at"], 0)
+    interval = interval_fraction * min(
+        elapsed, abs(expected_duration(analysis) - elapsed)
+    )
+    interval = min(max(interval, min_interval), max_interval)
+
+    deadlines = [analysis["submitted_at"] + time_limit]
+    if analysis.get("invalid_after"):
+        deadlines.append(datetime.timestamp(parse_datetime(analysis["invalid_after"])))
+    return min([now + interval] + [d for d in deadlines if d > now])
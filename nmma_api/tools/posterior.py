@@ -0,0 +1,161 @@
+from nmma_api.utils.config import load_config
+
+config = load_config()
+
+# analysis_parameters keys that can be used to override the posterior options per request
+POSTERIOR_PARAMETERS = {
+    "max_samples": "max_posterior_samples",
+    "thinning": "posterior_thinning",
+    "seed": "posterior_seed",
+    "dtype": "posterior_dtype",
+    "compression_level": "posterior_compression_level",
+}
+
+THINNING_METHODS = ["uniform", "random"]
+DTYPES = ["float64", "float32"]
+
+
+def posterior_options(analysis: dict) -> dict:
+    """
+    Get the options used to reduce the posterior samples returned for an analysis.
+
+    The defaults come from the `posterior` section of the config, which can be
+    overridden per model (`posterior.models.<model>`), and then per request
+    through the analysis parameters (see `POSTERIOR_PARAMETERS`).
+
+    Parameters
+    ----------
+    analysis : dict
+        The analysis request.
+
+    Returns
+    -------
+    dict
+        The posterior options: max_samples, thinning, seed, dtype and compression_level.
+
+    Raises
+    ------
+    ValueError
+        If one of the options is invalid.
+    """
+    defaults = config.get("posterior") or {}
+    analysis_parameters = analysis.get("inputs", {}).get("analysis_parameters", {})
+    model = analysis_parameters.get("source")
+
+    options = {
+        "max_samples": None,
+        "thinning": "uniform",
+        "seed": 42,
+        "dtype": "float64",
+        "compression_level": None,
+    }
+    options.update({k: v for k, v in defaults.items() if k in options})
+    options.update((defaults.get("models") or {}).get(model) or {})
+    for key, parameter in POSTERIOR_PARAMETERS.items():
+        if analysis_parameters.get(parameter) not in [None, ""]:
+            options[key] = analysis_parameters[parameter]
+
+    # analysis parameters coming from SkyPortal are often strings
+    try:
+        for key in ["max_samples", "seed", "compression_level"]:
+            if options[key] is not None:
+                options[key] = int(options[key])
+    except (TypeError, ValueError):
+        raise ValueError(f"posterior option {key} must be an integer")
+
+    if options["max_samples"] is not None and options["max_samples"] < 1:
+        raise ValueError("posterior option max_samples must be a positive integer")
+    if options["thinning"] not in THINNING_METHODS:
+        raise ValueError(
+            f"posterior option thinning must be one of: {', '.join(THINNING_METHODS)}"
+        )
+    if options["dtype"] not in DTYPES:
+        raise ValueError(f"posterior option dtype must be one of: {', '.join(DTYPES)}")
+    if options["compression_level"] is not None and not (
+        0 <= options["compression_level"] <= 9
+    ):
+        raise ValueError("posterior option compression_level must be between 0 and 9")
+
+    return options
+
+
+def reduce_posterior(posterior, options: dict) -> tuple:
+    """
+    Thin and downcast the posterior samples.
+
+    Parameters
+    ----------
+    posterior : pd.DataFrame
+        The posterior samples, one row per sample.
+    options : dict
+        The posterior options, as returned by `posterior_options`.
+
+    Returns
+    -------
+    pd.DataFrame
+        The reduced posterior samples.
+    list[str]
+        A description of each reduction that was applied.
+    """
+    import numpy as np
+
+    reductions = []
+
+    nb_samples = len(posterior)
+    max_samples = options.get("max_samples")
+    if max_samples is not None and nb_samples > max_samples:
+        if options.get("thinning") == "random":
+            posterior = posterior.sample(
+                n=max_samples, random_state=options.get("seed")
+            ).sort_index()
+        else:
+            indexes = np.linspace(0, nb_samples - 1, max_samples).round().astype(int)
+            posterior = posterior.iloc[indexes]
+        reductions.append(
+            f"{options.get('thinning')} thinning from {nb_samples} to {max_samples} samples"
+        )
+
+    if options.get("dtype") == "float32":
+        float_columns = posterior.select_dtypes(include=["float64"]).columns
+        if len(float_columns) > 0:
+            posterior = posterior.astype({c: np.float32 for c in float_columns})
+            reductions.append("float32 downcast")
+
+    return posterior, reductions
+
+
+def write_inference_data(inference, filename: str, compression_level: int = None):
+    """
+    Write an arviz InferenceData to a netcdf file.
+
+    Parameters
+    ----------
+    inference : arviz.InferenceData
+        The inference data to write.
+    filename : str
+        The path of the netcdf file.
+    compression_level : int, optional
+        The zlib compression level (0 disables compression), by default None
+        which uses arviz's default compression.
+    """
+    import numpy as np
+
+    if compression_level is None:
+        inference.to_netcdf(filename)
+        return
+    if compression_level == 0:
+        inference.to_netcdf(filename, compress=False)
+        return
+
+    mode = "w"
+    for group in inference.groups():
+        data = getattr(inference, group)
+        encoding = {
+            name: {"zlib": True, "complevel": compression_level, "shuffle": True}
+            for name, values in data.data_vars.items()
+            if np.issubdtype(values.dtype, np.number)
+        }
+        data.to_netcdf(
+            filename, mode=mode, group=group, engine="h5netcdf", encoding=encoding
+        )
+        mode = "a"
@@ -0,0 +1,197 @@
+import math
+from datetime import datetime, timedelta
+
+import fire
+
+from nmma_api.utils.config import load_config
+from nmma_api.utils.mongo import Mongo
+
+config = load_config()
+
+mongo = Mongo(**config["database"])
+
+# the statuses after which an analysis has no more transitions
+FINAL_STATUSES = [
+    "completed",
+    "failed_upload",
+    "webhook_expired",
+    "failed_submission",
+    "failed_plot",
+]
+
+# the usual order of the events, to print the stages in that order
+EVENTS_ORDER = [
+    "pending",
+    "running",
+    "job_expired",
+    "running_plot",
+    "fetched",
+    "failed_submission_to_upload",
+    "uploading",
+] + FINAL_STATUSES
+
+PERCENTILES = [50, 90, 99]
+
+
+def stages_pipeline(since: datetime, model: str = None, by_day: bool = True) -> list:
+    """
+    The aggregation pipeline computing the duration of each stage of the analyses created since a date.
+
+    A stage is the time between two consecutive events of an analysis (e.g. "running → fetched",
+    the job on SLURM including its pending time), plus "total → <final status>" from the creation
+    of the analysis to its final status. The durations are grouped per model, stage, and day
+    (the day the stage started) if by_day.
+    """
+    match = {"events.1": {"$exists": True}, "events.0.at": {"$gte": since}}
+    if model is not None:
+        match["inputs.analysis_parameters.source"] = model
+
+    group_id = {"model": "$model", "stage": "$stage"}
+    if by_day:
+        group_id["day"] = "$day"
+
+    is_last = {"$eq": ["$index", {"$subtract": [{"$size": "$events"}, 1]}]}
+    return [
+        {"$match": match},
+        {
+            "$project": {
+                "_id": 0,
+                "model": {"$ifNull": ["$inputs.analysis_parameters.source", "unknown"]},
+                "events": 1,
+                "event": "$events",
+            }
+        },
+        # one document per event, each paired with the next one, and the last one
+        # (that has no next event) with the first one, for the total
+        {"$unwind": {"path": "$event", "includeArrayIndex": "index"}},
+        {
+            "$project": {
+                "model": 1,
+                "total": is_last,
+                "from": {
+                    "$cond": [is_last, {"$arrayElemAt": ["$events", 0]}, "$event"]
+                },
+                "to": {
+                    "$cond": [
+                        is_last,
+                        "$event",
+                        {"$arrayElemAt": ["$events", {"$add": ["$index", 1]}]},
+                    ]
+                },
+            }
+        },
+        {"$match": {"$or": [{"total": False}, {"to.event": {"$in": FINAL_STATUSES}}]}},
+        {
+            "$project": {
+                "model": 1,
+                "stage": {
+                    "$cond": [
+                        "$total",
+                        {"$concat": ["total → ", "$to.event"]},
+                        {"$concat": ["$from.event", " → ", "$to.event"]},
+                    ]
+                },
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$from.at"}},
+                # in seconds
+                "duration": {"$divide": [{"$subtract": ["$to.at", "$from.at"]}, 1000]},
+            }
+        },
+        {
+            "$group": {
+                "_id": group_id,
+                "durations": {"$push": "$duration"},
+            }
+        },
+    ]
+
+
+def percentile(values: list, p: float) -> float:
+    """The p-th percentile of sorted values (nearest rank)."""
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 120:
+        return f"{seconds:.1f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+
+def stage_order(stage: str) -> tuple:
+    events = stage.replace("total → ", "").split(" → ")
+    rank = [
+        EVENTS_ORDER.index(event) if event in EVENTS_ORDER else len(EVENTS_ORDER)
+        for event in events
+    ]
+    # the totals after the stages
+    return (stage.startswith("total"), rank, stage)
+
+
+def stage_latencies(days: int = 7, model: str = None, by_day: bool = True) -> list:
+    """
+    The latency percentiles of each stage of the analyses created in the last days.
+
+    Returns
+    -------
+    list of dict
+        model, day (if by_day), stage, count, and the PERCENTILES (p50, p90, p99) in seconds.
+    """
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = []
+    # the durations are grouped server-side, the percentiles computed here
+    # ($percentile is only available from MongoDB 7.0)
+    for group in mongo.db.analysis.aggregate(stages_pipeline(since, model, by_day)):
+        durations = sorted(d for d in group["durations"] if d is not None)
+        if len(durations) == 0:
+            continue
+        row = {**group["_id"], "count": len(durations)}
+        for p in PERCENTILES:
+            row[f"p{p}"] = percentile(durations, p)
+        rows.append(row)
+    rows.sort(
+        key=lambda row: (row["model"], row.get("day", ""), stage_order(row["stage"]))
+    )
+    return rows
+
+
+def report(days: int = 7, model: str = None, by_day: bool = True):
+    """
+    Print the latency percentiles of each stage of the analyses, per model (and per day).
+
+    Parameters
+    ----------
+    days : int, optional
+        Only the analyses created in the last days, by default 7.
+    model : str, optional
+        Only the analyses of this model, by default all.
+    by_day : bool, optional
+        Group the stages per day too, by default True.
+    """
+    rows = stage_latencies(days, model, by_day)
+    if len(rows) == 0:
+        print(f"No analyses with lifecycle events in the last {days} days")
+        return
+
+    columns = ["model"] + (["day"] if by_day else []) + ["stage", "count"]
+    columns += [f"p{p}" for p in PERCENTILES]
+    table = [
+        [format_duration(row[c]) if c.startswith("p") else str(row[c]) for c in columns]
+        for row in rows
+    ]
+    widths = [
+        max(len(c), *(len(line[i]) for line in table)) for i, c in enumerate(columns)
+    ]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    previous = None
+    for row, line in zip(rows, table):
+        group = (row["model"], row.get("day"))
+        if previous is not None and group != previous:
+            print()
+        previous = group
+        print("  ".join(value.ljust(w) for value, w in zip(line, widths)))
+
+
+if __name__ == "__main__":
+    fire.Fire(report)
@@ -1,7 +1,15 @@
+import asyncio
+import random
+import threading
 import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from nmma_api.utils.codec import dumps
 from nmma_api.utils.config import load_config
 from nmma_api.utils.logs import make_log
 from nmma_api.utils.mongo import Mongo
@@ -12,6 +20,22 @@ config = load_config()
 
 mongo = Mongo(**config["database"])
 
+webhook_config = config.get("webhook") or {}
+max_attempts = webhook_config.get("max_attempts", 10)
+request_timeout = webhook_config.get("request_timeout", 60)
+backoff_base = webhook_config.get("backoff_base", 2)
+backoff_max = webhook_config.get("backoff_max", 300)
+max_concurrency = webhook_config.get("max_concurrency", 8)
+pool_size = webhook_config.get("pool_size", max_concurrency)
+chunk_size = webhook_config.get("chunk_size", 65536)
+# callback hosts (scheme://host[:port]) accepting gzip-compressed request bodies
+gzip_hosts = set(webhook_config.get("gzip_hosts") or [])
+gzip_level = webhook_config.get("gzip_level", 6)
+
+# one session per callback host, reused across uploads and retrieval cycles
+_sessions = {}
+_sessions_lock = threading.Lock()
+
 
 def get_error_message(response: requests.Response):
     try:
@@ -24,18 +48,142 @@ def get_error_message(response: requests.Response):
     return message
 
 
-def upload_analysis_results(results, data_dict, request_timeout=60):
+def backoff_delay(attempt: int) -> float:
+    """Jittered exponential backoff before the next attempt, in seconds ("full jitter")."""
+    return random.uniform(0, min(backoff_max, backoff_base * 2**attempt))
+
+
+def callback_host(url: str) -> str:
+    """The scheme and host (with port) of a callback URL, which identifies its connection pool."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url: str) -> requests.Session:
+    """
+    Get the session of the host of a callback URL, creating it on first use.
+
+    Each session keeps up to `pool_size` persistent (HTTP/1.1 keep-alive)
+    connections to its host, so consecutive uploads skip the TCP and TLS handshakes.
+    """
+    host = callback_host(url)
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            # retries are handled by the callers, with backoff
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, max_retries=0
+            )
+            session.mount(host, adapter)
+            _sessions[host] = session
+    return session
+
+
+def connection_stats() -> dict:
+    """
+    Count the requests made to each callback host, and how many opened a new connection.
+
+    Returns
+    -------
+    dict
+        For each host: the number of requests, of new connections, and of requests
+        that reused a pooled connection.
+    """
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for host, session in sessions:
+        pools = session.get_adapter(host).poolmanager.pools
+        nb_requests = nb_connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                nb_requests += pool.num_requests
+                nb_connections += pool.num_connections
+        stats[host] = {
+            "requests": nb_requests,
+            "new_connections": nb_connections,
+            "reused_connections": nb_requests - nb_connections,
+        }
+    return stats
+
+
+def iter_json(obj, chunk_size: int = chunk_size):
+    """
+    Serialize an object to JSON incrementally, yielding bytes.
+
+    Long strings (the base64 encoded files of the results) are written in slices
+    of `chunk_size` characters, so the whole document is never held in memory at once.
+    """
+    if isinstance(obj, dict):
+        yield b"{"
+        for i, (key, value) in enumerate(obj.items()):
+            yield (b", " if i else b"") + dumps(str(key)) + b": "
+            yield from iter_json(value, chunk_size)
+        yield b"}"
+    elif isinstance(obj, (list, tuple)):
+        yield b"["
+        for i, value in enumerate(obj):
+            if i:
+                yield b", "
+            yield from iter_json(value, chunk_size)
+        yield b"]"
+    elif isinstance(obj, str) and len(obj) > chunk_size:
+        yield b'"'
+        for start in range(0, len(obj), chunk_size):
+            end = start + chunk_size
+            # escaping is per character, so slices can be escaped independently
+            yield dumps(obj[start:end])[1:-1]
+        yield b'"'
+    else:
+        yield dumps(obj)
+
+
+def coalesce(chunks, size: int = chunk_size):
+    """Merge a stream of small chunks into chunks of at least `size` bytes (except the last)."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def iter_gzip(chunks, level: int = gzip_level):
+    """Compress a stream of bytes with gzip, incrementally."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def encode_body(results, url: str):
     """
-    Upload the results to the webhook.
+    Encode results as a streamed JSON body, gzip-compressed if the callback host accepts it.
 
-    Parameters
-    ----------
-    results : dict
-        The results to upload.
-    data_dict : dict
-        The analysis request.
-    request_timeout : int, optional
-        The timeout for the request in seconds, by default 60.
+    Returns
+    -------
+    generator
+        The chunks of the body.
+    dict
+        The headers of the request.
+    """
+    headers = {"Content-Type": "application/json"}
+    body = coalesce(iter_json(results))
+    if callback_host(url) in gzip_hosts:
+        headers["Content-Encoding"] = "gzip"
+        body = iter_gzip(body)
+    return body, headers
+
+
+def post_results(results, data_dict, request_timeout=request_timeout):
+    """
+    Make a single attempt at uploading the results to the webhook.
 
     Returns
     -------
@@ -44,43 +192,130 @@ def upload_analysis_results(results, data_dict, request_timeout=60):
     str
         The error message if the upload failed.
     """
+    try:
+        # the body is a generator, consumed by each attempt: it is sent with chunked encoding
+        body, headers = encode_body(results, data_dict["callback_url"])
+        response = get_session(data_dict["callback_url"]).post(
+            data_dict["callback_url"],
+            data=body,
+            headers=headers,
+            timeout=request_timeout,
+        )
+        if response.status_code == 200:
+            return True, None
+        log(f"Callback URL returned status code {response.status_code}.")
+        return False, get_error_message(response) or f"status {response.status_code}"
+    except requests.exceptions.Timeout:
+        log("Callback URL timedout.")
+        return False, "Callback URL timedout."
+    except Exception as e:
+        log(f"Callback URL returned error: {e}.")
+        return False, str(e)
+
+
+class WebhookDispatcher:
+    """
+    Deliver results to webhooks concurrently, without blocking the caller.
+
+    Deliveries run on an asyncio loop in a background thread: each attempt is
+    bounded by the request timeout, and failed attempts are retried with jittered
+    exponential backoff, while other deliveries carry on. At most
+    `max_concurrency` requests are in flight at once, one per executor thread.
+    """
 
-    log(f"Uploading results to webhook: {data_dict['callback_url']}")
-    if data_dict["callback_method"] != "POST":
-        log("Callback URL is not a POST URL. Skipping.")
-        return
-    url = data_dict["callback_url"]
-    n_retries = 0
-    error = None
-    while n_retries < 10:
-        try:
-            response = requests.post(
-                url,
-                json=results,
-                timeout=request_timeout,
+    def __init__(self, max_concurrency: int = max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix="webhook"
+            )
+            self.loop.set_default_executor(self.executor)
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            threading.Thread(
+                target=self.loop.run_forever, name="webhook_dispatcher", daemon=True
+            ).start()
+
+    async def deliver(self, results, data_dict, attempts: int = None):
+        if data_dict["callback_method"] != "POST":
+            log("Callback URL is not a POST URL. Skipping.")
+            return (
+                False,
+                f"callback method {data_dict['callback_method']} not supported",
             )
-            if response.status_code == 200:
-                log("Results uploaded successfully.")
-                break
-            else:
+
+        attempts = attempts or max_attempts
+        error = None
+        start = time.time()
+        for attempt in range(attempts):
+            async with self.semaphore:
+                # bounded by the request timeout only: a blocking request can't be cancelled,
+                # so a deadline here would retry (and post twice) while it is still running
+                uploaded, error = await self.loop.run_in_executor(
+                    None, post_results, results, data_dict, request_timeout
+                )
+            if uploaded:
                 log(
-                    f"Callback URL returned status code {response.status_code}. Retrying."
+                    f"Results uploaded successfully to {data_dict['callback_url']}.",
+                    analysis_id=data_dict.get("analysis_id", data_dict.get("_id")),
+                    duration=time.time() - start,
                 )
-                n_retries += 1
-                error = get_error_message(response)
-        except Exception as e:
-            if e == requests.exceptions.Timeout:
-                log("Callback URL timedout. Retrying.")
-                n_retries += 1
-                error = "Callback URL timedout."
-            else:
-                log(f"Callback URL returned error: {e}. Retrying.")
-                n_retries += 1
-                error = str(e)
-        time.sleep(10)
-
-    if n_retries == 10:
-        log("Callback URL failed after 10 retries. Analysis results won't be uploaded.")
+                return True, None
+            if attempt < attempts - 1:
+                await asyncio.sleep(backoff_delay(attempt))
+
+        log(
+            f"Callback URL {data_dict['callback_url']} failed after {attempts} attempts.",
+            level="warning",
+            analysis_id=data_dict.get("analysis_id", data_dict.get("_id")),
+            duration=time.time() - start,
+        )
         return False, error
-    else:
-        return True, None
+
+    def dispatch(
+        self, results, data_dict, callback=None, attempts: int = None
+    ) -> Future:
+        """
+        Start delivering results to the webhook of an analysis.
+
+        Parameters
+        ----------
+        results : dict
+            The results to upload.
+        data_dict : dict
+            The analysis request.
+        callback : callable, optional
+            Called with (uploaded, error) once the delivery succeeded or all attempts failed.
+        attempts : int, optional
+            The maximum number of attempts, by default `webhook.max_attempts`.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to (uploaded, error).
+        """
+        self.start()
+        log(f"Uploading results to webhook: {data_dict['callback_url']}")
+        future = asyncio.run_coroutine_threadsafe(
+            self.deliver(results, data_dict, attempts), self.loop
+        )
+        if callback is not None:
+
+            def done(future):
+                try:
+                    uploaded, error = future.result()
+                except Exception as e:
+                    uploaded, error = False, str(e)
+                try:
+                    callback(uploaded, error)
+                except Exception as e:
+                    log(f"Webhook delivery callback failed: {e}")
+
+            future.add_done_callback(done)
+        return future
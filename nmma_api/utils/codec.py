@@ -0,0 +1,135 @@
+"""
+JSON encoding and decoding of the analysis requests and results, with orjson
+if it is installed (`pip install orjson`), several times faster than the
+standard library on the large payloads (light curves, posteriors, results).
+
+With orjson, NaN and infinities are encoded as null (they are not valid JSON),
+but are still decoded, as the standard library does.
+"""
+import json
+from typing import NamedTuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# raised by `loads` and `decode` when the data is not valid JSON
+DecodeError = json.JSONDecodeError
+
+TYPE_NAMES = {
+    dict: "an object",
+    list: "an array",
+    str: "a string",
+    int: "an integer",
+    float: "a number",
+    bool: "a boolean",
+}
+
+
+class SchemaError(ValueError):
+    """Raised by `decode` when the data does not match the schema."""
+
+
+class Field(NamedTuple):
+    # the allowed type(s) of the value
+    types: Union[type, tuple]
+    required: bool = True
+    # the fields of the value, if it is an object
+    schema: dict = None
+
+
+def _default(obj):
+    # numpy arrays and scalars, as orjson does with OPT_SERIALIZE_NUMPY
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    """Encode an object as JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(
+            obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(obj, default=_default).encode()
+
+
+def loads(data: Union[bytes, str]):
+    """Decode JSON bytes or string."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and infinities, rejected by orjson (also re-raises the invalid JSON)
+            pass
+    try:
+        return json.loads(data)
+    except UnicodeDecodeError as e:
+        raise DecodeError(f"Invalid UTF-8: {e.reason}", "", e.start) from e
+
+
+def check(obj, schema: dict, path: str = "data_dict") -> str:
+    """
+    Check that a decoded object matches a schema, returning the first error found (None if valid).
+
+    Parameters
+    ----------
+    obj : any
+        The decoded object.
+    schema : dict
+        The Field of each key of the object.
+    path : str, optional
+        Name of the object in the error messages, by default "data_dict".
+    """
+    if not isinstance(obj, dict):
+        return f"{path} must be an object"
+
+    missing_keys = [
+        key for key, field in schema.items() if field.required and key not in obj
+    ]
+    if len(missing_keys) > 0:
+        return f"missing required key(s) {missing_keys} in {path}"
+
+    for key, field in schema.items():
+        if key not in obj:
+            continue
+        value = obj[key]
+        types = field.types if isinstance(field.types, tuple) else (field.types,)
+        # bool is a subclass of int, but not a valid integer here
+        if not isinstance(value, types) or (
+            isinstance(value, bool) and bool not in types
+        ):
+            names = " or ".join(TYPE_NAMES.get(t, t.__name__) for t in types)
+            return f"{path}.{key} must be {names}"
+        if field.schema is not None:
+            err = check(value, field.schema, f"{path}.{key}")
+            if err is not None:
+                return err
+    return None
+
+
+def decode(data: Union[bytes, str], schema: dict = None):
+    """
+    Decode JSON bytes or string, and check the decoded object against a schema.
+
+    Parameters
+    ----------
+    data : bytes or str
+        The JSON document, e.g. the body of a request.
+    schema : dict, optional
+        The Field of each key of the decoded object (see `check`).
+
+    Raises
+    ------
+    DecodeError
+        If the data is not valid JSON.
+    SchemaError
+        If the decoded object does not match the schema.
+    """
+    obj = loads(data)
+    if schema is not None:
+        err = check(obj, schema)
+        if err is not None:
+            raise SchemaError(err)
+    return obj
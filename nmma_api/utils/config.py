@@ -5,7 +5,7 @@ import os
 
 # use literal_eval to convert strings to python objects (e.g. True, False, None)
 from ast import literal_eval
-from nmma_api.utils.logs import make_log
+from nmma_api.utils.logs import configure_logging, make_log
 
 log = make_log("config")
 
@@ -143,6 +143,7 @@ def load_config(config_files=["config.yaml"]):
 
         cfg = Config(all_configs)
         _cache.update({"cfg": cfg})
+        configure_logging(**(cfg.get("logging") or {}))
 
     return _cache["cfg"]
 
@@ -0,0 +1,30 @@
+from datetime import datetime, timezone
+
+
+def parse_datetime(value) -> datetime:
+    """
+    Parse a date (as sent by SkyPortal, e.g. str(datetime.utcnow())) into a naive UTC datetime,
+    the representation pymongo stores as a BSON date and returns.
+
+    Raises
+    ------
+    ValueError
+        If the value is not a valid date.
+    """
+    if isinstance(value, datetime):
+        date = value
+    elif isinstance(value, str):
+        date = datetime.fromisoformat(value.strip())
+    else:
+        raise ValueError(f"invalid date {value!r}")
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def from_timestamp(timestamp: float) -> datetime:
+    """
+    Convert a timestamp stored by the services (`datetime.timestamp(datetime.utcnow())`)
+    back to a naive UTC datetime.
+    """
+    return datetime.fromtimestamp(timestamp)
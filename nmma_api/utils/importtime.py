@@ -0,0 +1,66 @@
+import subprocess
+import sys
+
+import fire
+
+SERVICES = [
+    "nmma_api.services.api",
+    "nmma_api.services.submission_queue",
+    "nmma_api.services.retrieval_queue",
+    "nmma_api.services.delivery_queue",
+    "nmma_api.services.combined",
+]
+
+
+def import_times(module: str) -> list[tuple]:
+    """
+    Import a module in a fresh interpreter with `-X importtime`.
+
+    Returns
+    -------
+    list[tuple]
+        For each imported module: its name, nesting level, self and cumulative time in us.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    times = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line.removeprefix("import time:").split("|")
+        # names are indented by two spaces per nesting level, after a separating space
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((name.strip(), level, int(self_time), int(cumulative)))
+    return times
+
+
+def report(*modules, top: int = 10):
+    """
+    Print the total import time of each service, and its slowest direct imports.
+
+    Parameters
+    ----------
+    modules : str
+        The modules to import, by default all the services.
+    top : int, optional
+        The number of slowest imports to show, by default 10.
+    """
+    for module in modules or SERVICES:
+        times = import_times(module)
+        total = next((t[3] for t in times if t[0] == module), None)
+        if total is None:
+            print(f"{module}: failed to import")
+            continue
+        print(f"{module}: {total / 1e6:.3f}s")
+        direct = sorted(
+            (t for t in times if t[1] == 1), key=lambda t: t[3], reverse=True
+        )
+        for name, _, _, cumulative in direct[:top]:
+            print(f"    {name.ljust(50)} {cumulative / 1e6:.3f}s")
+
+
+if __name__ == "__main__":
+    fire.Fire(report)
@@ -1,5 +1,16 @@
+import atexit
+import ctypes
+import ctypes.util
+import fcntl
 import glob
+import gzip
+import json
 import os
+import queue
+import select
+import shutil
+import signal
+import sys
 import threading
 import time
 import zlib
@@ -25,6 +36,195 @@ COLOR_TABLE = [
 # Here, to stay consistent with the rest of SkyPortal's & baselayer's code, we use the same methods for logging.
 # The only addition is the save_to_file method.
 
+LOGS_DIR = "logs"
+
+# set from the `logging` section of the config by `configure_logging`
+# (called by load_config, the config module itself logging through this one)
+options = {
+    "format": "text",  # "text", or "json": one JSON object per line in the log files
+    "color": "auto",  # True, False, or "auto": only when stdout is a terminal
+    "max_bytes": 10 * 1024 * 1024,  # rotate a log file once it exceeds this size
+    "rotate_daily": True,  # rotate a log file on the first write of a new day
+    "backup_count": 7,  # rotated (gzip-compressed) files kept per log
+    "flush_interval": 0.5,  # in seconds, how often the writer flushes
+}
+
+
+def configure_logging(**kwargs):
+    """Update the logging options, ignoring the unknown ones."""
+    options.update({k: v for k, v in kwargs.items() if k in options})
+
+
+def use_color() -> bool:
+    if options["color"] == "auto":
+        return sys.stdout.isatty()
+    return bool(options["color"])
+
+
+class LogWriter:
+    """
+    Write the logs from a background thread.
+
+    Callers only enqueue their lines, the writer batches them: the lines of each
+    log file are written with a single append, and stdout is flushed once per batch.
+
+    Log files are opened with O_APPEND, so that whole batches from different
+    processes never overwrite each other, and rotated (by size or day) under an
+    exclusive lock, each process reopening a file rotated by another one.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="log_writer", daemon=True
+                )
+                self.thread.start()
+
+    def write(self, app: str, console_line: str = None, file_line: str = None):
+        self.queue.put((app, console_line, file_line))
+        if self.thread is None:
+            self.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # give the callers a chance to add more lines to this batch
+            time.sleep(options["flush_interval"])
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not self.flush(batch):
+                return
+
+    def flush(self, batch: list) -> bool:
+        """Write a batch of lines, returning False if the writer should stop."""
+        console_lines, file_lines = [], {}
+        stop = False
+        for item in batch:
+            if item is None:
+                stop = True
+                continue
+            app, console_line, file_line = item
+            if console_line is not None:
+                console_lines.append(console_line)
+            if file_line is not None:
+                file_lines.setdefault(app, []).append(file_line)
+
+        if console_lines:
+            try:
+                sys.stdout.write("\n".join(console_lines) + "\n")
+                sys.stdout.flush()
+            except Exception:
+                pass
+        for app, lines in file_lines.items():
+            try:
+                self.append(app, ("\n".join(lines) + "\n").encode())
+            except Exception as e:
+                print(f"Failed to write logs/{app}.log: {e}", file=sys.stderr)
+        return not stop
+
+    def open(self, path: str) -> int:
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        return os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def append(self, app: str, data: bytes):
+        path = pjoin(LOGS_DIR, f"{app}.log")
+        fd = self.files.get(app)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        # the file was rotated (or removed), by this or another process
+        if fd is not None and (stat is None or stat.st_ino != os.fstat(fd).st_ino):
+            os.close(fd)
+            fd = None
+        if stat is not None and self.should_rotate(stat, len(data)):
+            if fd is not None:
+                os.close(fd)
+                fd = None
+            self.rotate(app, path, stat.st_ino)
+        if fd is None:
+            fd = self.open(path)
+            self.files[app] = fd
+        os.write(fd, data)
+
+    def should_rotate(self, stat, size: int) -> bool:
+        if options["max_bytes"] and stat.st_size + size > options["max_bytes"]:
+            return stat.st_size > 0
+        if options["rotate_daily"]:
+            return datetime.fromtimestamp(stat.st_mtime).date() != datetime.now().date()
+        return False
+
+    def rotate(self, app: str, path: str, inode: int):
+        """Rename the log file aside and compress it, unless another process just did."""
+        with open(pjoin(LOGS_DIR, f".{app}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino != inode:
+                    return
+            except FileNotFoundError:
+                return
+            rotated = f"{path}.{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+            os.rename(path, rotated)
+        # compressed by the writer thread, off the callers' path
+        self.compress(app, rotated)
+
+    def compress(self, app: str, rotated: str):
+        try:
+            with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+            backups = sorted(glob.glob(pjoin(LOGS_DIR, f"{app}.log.*.gz")))
+            for backup in backups[: max(len(backups) - options["backup_count"], 0)]:
+                os.remove(backup)
+        except Exception as e:
+            print(f"Failed to compress {rotated}: {e}", file=sys.stderr)
+
+    def close(self, timeout: float = 5):
+        """Write the pending lines and stop the writer."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+
+_writer = LogWriter()
+atexit.register(_writer.close)
+
+
+def flush_on_sigterm(signum=None, frame=None):
+    _writer.close()
+    # then terminate, as SIGTERM would have
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def install_sigterm_flush():
+    """
+    Write the pending lines when the process is terminated (e.g. stopped by supervisor),
+    which atexit doesn't do. Call from the main thread.
+    """
+    signal.signal(signal.SIGTERM, flush_on_sigterm)
+
+
+def _reset_writer():
+    # a forked child has no writer thread, it starts its own on its first log
+    global _writer
+    _writer = LogWriter()
+    atexit.register(_writer.close)
+
+
+os.register_at_fork(after_in_child=_reset_writer)
+
+
 def time_stamp():
     """
 
@@ -49,12 +249,7 @@ def save_to_file(app, message):
         None
     """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # check if logs directory exists
-    if not os.path.exists("logs"):
-        os.mkdir("logs")
-
-    with open(f"logs/{app}.log", "a") as f:
-        f.write(f"{timestamp} {message}\n")
+    _writer.write(app, file_line=f"{timestamp} {message}")
 
 
 def colorize(s, fg=None, bg=None, bold=False, underline=False, reverse=False):
@@ -108,9 +303,12 @@ def colorize(s, fg=None, bg=None, bold=False, underline=False, reverse=False):
     return style_start + s + style_end
 
 
-def log(app, message):
+LEVELS = ["debug", "info", "warning", "error"]
+
+
+def log(app, message, level="info", **fields):
     """
-    Logs a message the console and saves it to a file.
+    Logs a message the console and saves it to a file (asynchronously).
 
     Arguments
     ---------
@@ -118,6 +316,11 @@ def log(app, message):
             The name of the app.
         message : str
             The message to log.
+        level : str, optional
+            One of LEVELS, by default "info".
+        **fields
+            Structured fields (e.g. analysis_id, job_id, duration), saved along
+            with the message when the `logging.format` is "json".
 
     Returns
     -------
@@ -127,8 +330,22 @@ def log(app, message):
     color_table = ["red", "green", "yellow", "blue", "magenta", "cyan", "white"]
     color = color_table[zlib.crc32(app.encode("ascii")) % len(color_table)]
     formatted_message = f"[{timestamp} {app}] {message}"
-    print(colorize(formatted_message, fg=color, bold=True))
-    save_to_file(app, message)
+    if use_color():
+        formatted_message = colorize(formatted_message, fg=color, bold=True)
+    if options["format"] == "json":
+        record = {
+            "time": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+            "app": app,
+            "level": level,
+            "message": message,
+        }
+        record.update({k: v for k, v in fields.items() if v is not None})
+        file_line = json.dumps(record, default=str)
+    else:
+        file_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        file_line = f"{file_timestamp} {message}"
+    # written by the background writer, the callers never block on I/O
+    _writer.write(app, formatted_message, file_line)
 
 
 def make_log(app):
@@ -150,92 +367,195 @@ def make_log(app):
 
     return app_log
 
+
 basedir = pjoin(os.path.dirname(__file__), "..")
 logdir = "../log"
 
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
 
-def tail_f(filename, interval=1.0):
-    f = None
-
-    while not f:
-        try:
-            f = open(filename)
-            break
-        except OSError:
-            time.sleep(1)
-
-    # Find the size of the file and move to the end
-    st_results = os.stat(filename)
-    st_size = st_results[6]
-    f.seek(st_size)
-
-    while True:
-        where = f.tell()
-        line = f.readline()
-        if not line:
-            time.sleep(interval)
-            f.seek(where)
-        else:
-            yield line.rstrip("\n")
 
+def inotify_watch(path: str):
+    """
+    Watch a directory for files being written, created or moved into it.
 
-def print_log(filename, color="default", stream=None):
+    Returns an inotify file descriptor, readable once events are pending,
+    or None where inotify is not available (e.g. not on Linux).
     """
-    Print log to stdout; stream is ignored.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CREATE | IN_MOVED_TO
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class LogFollower:
     """
+    Follow all the log files of a directory, from a single thread.
 
-    def print_col(line):
-        print(colorize(line, fg=color))
-
-    print_col(f"-> {filename}")
+    New files are picked up as they are created, and rotated files are read
+    to their end before switching to the new one. Waits on inotify events
+    where available, and polls the files otherwise.
+    """
 
-    for line in tail_f(filename):
-        print_col(line)
+    def __init__(self, directory: str = LOGS_DIR, from_start: bool = False):
+        self.directory = directory
+        self.from_start = from_start
+        # path -> [file, inode, partial last line]
+        self.files = {}
+        self.fd = None
 
-def log_watcher(printers=None):
-    """Watch for new logs, and start following them.
+    def open(self, path: str, at_end: bool):
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return
+        if at_end:
+            f.seek(0, os.SEEK_END)
+        self.files[path] = [f, os.fstat(f.fileno()).st_ino, b""]
+
+    def read(self, path: str) -> list:
+        entry = self.files[path]
+        data = entry[0].read()
+        if not data:
+            return []
+        *lines, entry[2] = (entry[2] + data).split(b"\n")
+        return [(path, line.decode(errors="replace")) for line in lines]
+
+    def rotated(self, path: str) -> bool:
+        f, inode, _ = self.files[path]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != inode or stat.st_size < f.tell()
+
+    def scan(self, first: bool = False) -> list:
+        """Read the lines written since the last scan, as (path, line) pairs."""
+        lines = []
+        for path in sorted(glob.glob(pjoin(self.directory, "*.log"))):
+            if path not in self.files:
+                # files created while following are read from their start
+                self.open(path, at_end=first and not self.from_start)
+            elif self.rotated(path):
+                lines += self.read(path)
+                self.files.pop(path)[0].close()
+                self.open(path, at_end=False)
+            if path in self.files:
+                lines += self.read(path)
+        return lines
+
+    def wait(self, timeout: float):
+        """Wait for files to be written to, at most `timeout` seconds."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # the events are drained, the files are all scanned anyway
+            os.read(self.fd, 65536)
+
+    def follow(self, poll_interval: float = 1.0):
+        """Yield (path, line) pairs as lines are written, forever."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.fd = inotify_watch(self.directory)
+        # with inotify, still rescan now and then, e.g. if the directory was recreated
+        timeout = poll_interval if self.fd is None else 10
+        first = True
+        while True:
+            yield from self.scan(first)
+            first = False
+            self.wait(timeout)
+
+
+def parse_line(line: str):
+    """Parse a line of a log file in the json format, None for the text format."""
+    if not line.startswith("{"):
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def level_rank(level: str) -> int:
+    return LEVELS.index(level) if level in LEVELS else LEVELS.index("info")
+
+
+def format_record(record: dict) -> str:
+    fields = {
+        k: v for k, v in record.items() if k not in ("time", "app", "level", "message")
+    }
+    level = record.get("level", "info")
+    line = f"{record.get('time', '')} {record.get('message', '')}"
+    if level != "info":
+        line = f"{line} [{level}]"
+    if fields:
+        line += " (" + ", ".join(f"{k}={v}" for k, v in fields.items()) + ")"
+    return line
+
+
+def log_watcher(
+    apps=None,
+    analysis_id: str = None,
+    level: str = None,
+    from_start: bool = False,
+    poll_interval: float = 1.0,
+):
+    """Follow the log files of all the services, printing their new lines.
 
     Parameters
     ----------
-    printers : list of callables
-        Functions of form `f(logfile, color=None)` used to print the
-        tailed log file.  By default, logs are sent to stdout.  Note
-        that the printer is also responsible for following (tailing)
-        the log file
-
-    See Also
-    --------
-    print_log : the default stdout printer
-
+    apps : str or list of str, optional
+        Only follow the logs of these apps (e.g. retrieval_queue), by default all.
+    analysis_id : str, optional
+        Only print the lines about this analysis: the lines with that analysis_id
+        field in the json format, the lines mentioning it in the text format.
+    level : str, optional
+        Only print the lines of at least this level (json format only), e.g. "warning".
+    from_start : bool, optional
+        Print the existing lines of the log files too, by default only the new ones.
+    poll_interval : float, optional
+        In seconds, how often the files are polled where inotify is not available.
     """
-    # Start with a short discovery interval, then back off
-    # until that interval is 60s
-    interval = 1
-
-    if printers is None:
-        printers = [print_log]
+    if isinstance(apps, str):
+        apps = apps.split(",")
+    min_level = level_rank(level) if level else 0
 
     colors = ["default", "green", "yellow", "blue", "magenta", "cyan", "red"]
-    watched = set()
-
-    color = 0
-    while True:
-        all_logs = set(glob.glob("logs/*.log"))
-        new_logs = all_logs - watched
-
-        for logfile in sorted(new_logs):
-            color = (color + 1) % len(colors)
-            for printer in printers:
-                thread = threading.Thread(
-                    target=printer, args=(logfile,), kwargs={"color": colors[color]}
-                )
-                thread.start()
-
-        watched = all_logs
-
-        time.sleep(interval)
-        interval = max(interval * 2, 60)
+    app_colors = {}
+    for path, line in LogFollower(from_start=from_start).follow(poll_interval):
+        app = os.path.basename(path).removesuffix(".log")
+        if apps and app not in apps:
+            continue
+        record = parse_line(line)
+        if record is not None:
+            if level_rank(record.get("level")) < min_level:
+                continue
+            if analysis_id and str(record.get("analysis_id")) != analysis_id:
+                continue
+            line = format_record(record)
+        elif min_level > 0 or (analysis_id and analysis_id not in line):
+            continue
+
+        line = f"[{app}] {line}"
+        if app not in app_colors:
+            app_colors[app] = colors[(len(app_colors) + 1) % len(colors)]
+            line = f"-> {path}\n{line}"
+        if use_color():
+            line = colorize(line, fg=app_colors[app])
+        print(line, flush=True)
 
 
 if __name__ == "__main__":
-    log_watcher()
+    import fire
+
+    fire.Fire(log_watcher)
@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from nmma_api.tools.polling import time_limit
+from nmma_api.utils.config import load_config
+from nmma_api.utils.dates import from_timestamp, parse_datetime
+from nmma_api.utils.logs import make_log
+from nmma_api.utils.mongo import Mongo
+
+log = make_log("migrations")
+
+config = load_config()
+
+
+def migrate_dates(mongo: Mongo) -> int:
+    """
+    Convert the dates stored as strings by earlier versions to BSON dates:
+    the invalid_after of the analyses and of the outbox entries, and add
+    the deadline_at of the running analyses.
+
+    Safe to run repeatedly, only the documents left to migrate are updated.
+
+    Returns
+    -------
+    int
+        The number of documents migrated.
+    """
+    nb_migrated = 0
+    for collection in ["analysis", "outbox"]:
+        for document in mongo.db[collection].find(
+            {"invalid_after": {"$type": "string"}}, {"invalid_after": 1}
+        ):
+            try:
+                update = {
+                    "$set": {"invalid_after": parse_datetime(document["invalid_after"])}
+                }
+            except ValueError:
+                log(
+                    f"Invalid invalid_after {document['invalid_after']!r} in {collection} {document['_id']}, removing it"
+                )
+                update = {"$unset": {"invalid_after": ""}}
+            mongo.db[collection].update_one({"_id": document["_id"]}, update)
+            nb_migrated += 1
+
+    for analysis in mongo.db.analysis.find(
+        {
+            "status": {"$in": ["running", "running_plot"]},
+            "deadline_at": None,
+            "submitted_at": {"$type": "number"},
+        },
+        {"submitted_at": 1},
+    ):
+        deadline_at = from_timestamp(analysis["submitted_at"]) + timedelta(
+            seconds=time_limit
+        )
+        mongo.db.analysis.update_one(
+            {"_id": analysis["_id"]}, {"$set": {"deadline_at": deadline_at}}
+        )
+        nb_migrated += 1
+
+    if nb_migrated > 0:
+        log(f"Migrated the dates of {nb_migrated} documents")
+    return nb_migrated
+
+
+if __name__ == "__main__":
+    migrate_dates(Mongo(**config["database"]))
@@ -1,3 +1,4 @@
+import threading
 import traceback
 from typing import Optional
 
@@ -11,6 +12,18 @@ config = load_config()
 
 log = make_log("config")
 
+# one client (and so one connection pool) per connection string and process, shared by
+# all the Mongo instances of the process: e.g. all the services of the combined runtime
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(conn_string: str) -> pymongo.MongoClient:
+    with _clients_lock:
+        if conn_string not in _clients:
+            _clients[conn_string] = pymongo.MongoClient(conn_string)
+        return _clients[conn_string]
+
 
 class Mongo:
     def __init__(
@@ -50,7 +63,7 @@ class Mongo:
         if self.replica_set is not None:
             conn_string += f"?replicaSet={self.replica_set}"
 
-        self.client = pymongo.MongoClient(conn_string)
+        self.client = shared_client(conn_string)
         self.db = self.client.get_database(db)
 
         self.verbose = verbose
@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, NamedTuple
+
+from nmma_api.utils.logs import make_log
+
+log = make_log("pipeline")
+
+# marks the end of the items, each worker stops when it gets one
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    name: str
+    # called on each item, returns the item passed to the next stage (or None to drop it)
+    func: Callable
+    workers: int = 1
+
+
+def run_pipeline(items: Iterable, stages: list[Stage], queue_size: int = 8) -> dict:
+    """
+    Run items through a sequence of stages, concurrently.
+
+    Each stage has its own worker threads, and consecutive stages are connected
+    by bounded queues: a slow stage makes the previous ones wait, rather than
+    piling up items in memory. An item failing in a stage is logged and dropped.
+
+    Parameters
+    ----------
+    items : Iterable
+        The items to process.
+    stages : list[Stage]
+        The stages, in order.
+    queue_size : int, optional
+        The maximum number of items waiting in front of each stage, by default 8.
+
+    Returns
+    -------
+    dict
+        For each stage, the number of items it processed and the time its workers were busy.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [None]
+    stats = {stage.name: {"items": 0, "busy": 0.0} for stage in stages}
+    remaining = [max(stage.workers, 1) for stage in stages]
+    lock = threading.Lock()
+
+    def work(index: int):
+        stage = stages[index]
+        while True:
+            item = queues[index].get()
+            if item is _DONE:
+                break
+            start = time.time()
+            try:
+                output = stage.func(item)
+            except Exception as e:
+                log(f"Stage {stage.name} failed: {e}")
+                output = None
+            with lock:
+                stats[stage.name]["items"] += 1
+                stats[stage.name]["busy"] += time.time() - start
+            if output is not None and queues[index + 1] is not None:
+                queues[index + 1].put(output)
+
+        with lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        # once all the workers of a stage are done, so is the next stage
+        if last and queues[index + 1] is not None:
+            for _ in range(remaining[index + 1]):
+                queues[index + 1].put(_DONE)
+
+    threads = [
+        threading.Thread(target=work, args=(index,), name=f"pipeline_{stage.name}")
+        for index, stage in enumerate(stages)
+        for _ in range(remaining[index])
+    ]
+    for thread in threads:
+        thread.start()
+
+    for item in items:
+        queues[0].put(item)
+    for _ in range(remaining[0]):
+        queues[0].put(_DONE)
+
+    for thread in threads:
+        thread.join()
+    return stats
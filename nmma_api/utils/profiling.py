@@ -0,0 +1,200 @@
+import bisect
+import cProfile
+import collections
+import contextlib
+import glob
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from os.path import join as pjoin
+
+from nmma_api.utils.config import load_config
+from nmma_api.utils.logs import LOGS_DIR, make_log
+
+log = make_log("profiling")
+
+config = load_config()
+
+profiling_config = config.get("profiling") or {}
+# toggled at runtime with SIGUSR1, see `install_toggle`
+enabled = profiling_config.get("enabled", False)
+mode = profiling_config.get("mode", "sampling")  # sampling or deterministic
+interval = profiling_config.get("interval", 0.01)  # in seconds, between samples
+slowest_fraction = profiling_config.get("slowest_fraction", 0.05)
+min_duration = profiling_config.get("min_duration", 1)  # in seconds
+window = profiling_config.get("window", 200)
+max_profiles = profiling_config.get("max_profiles", 100)
+
+PROFILES_DIR = pjoin(LOGS_DIR, "profiles")
+
+if mode not in ["sampling", "deterministic"]:
+    raise ValueError("profiling.mode must be one of: sampling, deterministic")
+
+# recent durations, per profiled name, sorted
+_durations = collections.defaultdict(list)
+_recent = collections.defaultdict(collections.deque)
+_lock = threading.Lock()
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of the running threads at a fixed interval, from a background thread.
+
+    The overhead is independent of the code being profiled. The stacks are dumped in
+    the collapsed format (one `thread;frame;...;frame count` line per stack), read by
+    flame graph tools such as flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval: float, all_threads: bool = True):
+        self.interval = interval
+        self.all_threads = all_threads
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.caller = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == threading.get_ident():
+                    continue
+                if not self.all_threads and thread_id != self.caller:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class DeterministicProfiler:
+    """cProfile, of the calling thread only, dumped in the pstats format."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path: str):
+        self.profile.dump_stats(path)
+
+
+class Profile:
+    """What is known about a profiled call, `count` being set by the caller (e.g. analyses processed)."""
+
+    def __init__(self, name: str, count: int = None):
+        self.name = name
+        self.count = count
+        self.duration = None
+
+
+def is_slow(name: str, duration: float) -> bool:
+    """Record the duration of a call, returning whether it is one of the slowest recent ones."""
+    with _lock:
+        durations, recent = _durations[name], _recent[name]
+        # among the slowest `slowest_fraction` of the recent durations, this one included
+        rank = len(durations) - bisect.bisect_left(durations, duration)
+        slow = rank < max(slowest_fraction * (len(durations) + 1), 1)
+        bisect.insort(durations, duration)
+        recent.append(duration)
+        if len(recent) > window:
+            durations.pop(bisect.bisect_left(durations, recent.popleft()))
+    return slow and duration >= min_duration
+
+
+def save(profiler, profile: Profile):
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
+    count = "" if profile.count is None else f"_{profile.count}"
+    extension = "collapsed" if isinstance(profiler, SamplingProfiler) else "prof"
+    path = pjoin(
+        PROFILES_DIR,
+        f"{profile.name}_{timestamp}_{profile.duration:.3f}s{count}.{extension}",
+    )
+    profiler.dump(path)
+    log(f"Saved the profile of a {profile.duration:.1f}s {profile.name} call to {path}")
+
+    profiles = sorted(glob.glob(pjoin(PROFILES_DIR, f"{profile.name}_*")))
+    for old in profiles[: max(len(profiles) - max_profiles, 0)]:
+        os.remove(old)
+
+
+@contextlib.contextmanager
+def profiled(name: str, count: int = None, all_threads: bool = True):
+    """
+    Profile a block (or, as a decorator, a function) when profiling is enabled,
+    saving the profile to logs/profiles only if it is one of the slowest recent calls.
+
+    The file name holds the name, the time, the duration and the count set by the
+    caller on the yielded Profile, e.g. retrieval_queue_20240101_120000_000000_95.312s_12.collapsed.
+
+    Parameters
+    ----------
+    name : str
+        Name of the profiled block, the slowest calls are picked per name.
+    count : int, optional
+        Number of analyses processed, if known beforehand.
+    all_threads : bool, optional
+        Sample all the threads (e.g. the workers of a pipeline), not only the calling
+        one, by default True. The deterministic profiler only profiles the calling thread.
+    """
+    profile = Profile(name, count)
+    if not enabled:
+        yield profile
+        return
+
+    if mode == "sampling":
+        profiler = SamplingProfiler(interval, all_threads)
+    else:
+        profiler = DeterministicProfiler()
+    start = time.time()
+    profiler.start()
+    try:
+        yield profile
+    finally:
+        profiler.stop()
+        profile.duration = time.time() - start
+        if is_slow(name, profile.duration):
+            try:
+                save(profiler, profile)
+            except Exception as e:
+                log(f"Failed to save the profile of {name}: {e}")
+
+
+def toggle(signum=None, frame=None):
+    global enabled
+    enabled = not enabled
+    log(f"Profiling {'enabled' if enabled else 'disabled'} ({mode})")
+
+
+def install_toggle():
+    """Toggle profiling on SIGUSR1, e.g. `kill -USR1 <pid>`. Call from the main thread."""
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle)
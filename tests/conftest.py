@@ -0,0 +1,62 @@
+"""
+The tests run offline, from the root of the repository (for config.yaml.defaults),
+against an in-memory database: `make test` (requirements in requirements_dev.txt).
+"""
+from types import SimpleNamespace
+
+import mongomock
+import pymongo
+import pytest
+
+# before any nmma_api module creates its (shared) client
+pymongo.MongoClient = mongomock.MongoClient
+
+from nmma_api.utils import logs  # noqa: E402
+from nmma_api.utils.config import load_config  # noqa: E402
+from nmma_api.utils.mongo import Mongo  # noqa: E402
+
+
+@pytest.fixture(autouse=True, scope="session")
+def logs_dir(tmp_path_factory):
+    # rather than the logs of the services
+    logs.LOGS_DIR = str(tmp_path_factory.mktemp("logs"))
+
+
+class Clock:
+    """A fake clock, advanced by the tests."""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def make_clock(monkeypatch, module) -> Clock:
+    """Make a module see the time of a fake clock (it must use `time.time()`)."""
+    clock = Clock()
+    monkeypatch.setattr(module, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+@pytest.fixture
+def mongo():
+    """The database of the services, emptied after each test."""
+    mongo = Mongo(**load_config()["database"])
+    yield mongo
+    for name in mongo.db.list_collection_names():
+        mongo.db.drop_collection(name)
+
+
+@pytest.fixture
+def models_metadata(monkeypatch, tmp_path):
+    """Models metadata from a synthetic cache, rather than from the network."""
+    from nmma_api.simulator.synthetic import synthetic_models_metadata
+    from nmma_api.tools import models_metadata
+
+    cache_path = str(tmp_path / "models.json")
+    models_metadata.write_entry(cache_path, synthetic_models_metadata())
+    monkeypatch.setattr(models_metadata, "cache_path", cache_path)
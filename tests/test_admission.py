@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from conftest import make_clock
+from nmma_api.tools import admission
+
+
+@pytest.fixture
+def clock(monkeypatch, mongo):
+    """The time seen by the admission control, with fresh counts and low limits."""
+    monkeypatch.setattr(admission, "_counts", None)
+    monkeypatch.setattr(admission, "max_backlog", 3)
+    monkeypatch.setattr(admission, "max_jobs", 2)
+    return make_clock(monkeypatch, admission)
+
+
+def add_analyses(statuses: list, backend: str = None):
+    admission.mongo.db.analysis.insert_many(
+        [
+            {"status": status, **({"backend": backend} if backend else {})}
+            for status in statuses
+        ]
+    )
+
+
+def test_count_analyses(mongo):
+    add_analyses(["pending", "pending", "job_expired", "completed", "failed"])
+    add_analyses(["running", "running_plot"], backend="local")
+    # submitted before the backends were tracked: on the default one
+    add_analyses(["running"])
+    assert admission.count_analyses() == {
+        "backlog": 3,
+        "jobs": {"local": 2, "expanse": 1},
+    }
+
+
+def test_counts_are_cached(clock):
+    add_analyses(["pending"])
+    assert admission.cached_counts()["backlog"] == 1
+    add_analyses(["pending"])
+    assert admission.cached_counts()["backlog"] == 1
+    clock.advance(admission.cache_ttl + 1)
+    assert admission.cached_counts()["backlog"] == 2
+
+
+def test_admit(clock):
+    add_analyses(["pending", "pending"])
+    add_analyses(["running", "running"], backend="local")
+    assert admission.admit("expanse") == (True, False, "")
+    decision = admission.admit("local")
+    assert decision.admitted and decision.deferred
+    assert decision.message == "submission deferred, 2 jobs already running on local"
+
+    add_analyses(["pending"])
+    clock.advance(admission.cache_ttl + 1)
+    decision = admission.admit("expanse")
+    assert not decision.admitted
+    assert "too many analyses waiting to be submitted (3)" in decision.message
+
+
+def test_admit_does_not_count(clock):
+    # the API only records the analyses it stored, not those it then rejected
+    for _ in range(10):
+        assert admission.admit("expanse").admitted
+    assert admission.cached_counts()["backlog"] == 0
+
+    for _ in range(3):
+        admission.record_admission()
+    # noticed before the next refresh of the counts
+    assert not admission.admit("expanse").admitted
+
+
+def post_all(requests: list) -> list:
+    """POST requests to the analysis endpoint, returning their status codes."""
+    from nmma_api.services import api
+    from nmma_api.utils.codec import dumps
+
+    async def run():
+        sock, port = bind_unused_port()
+        server = HTTPServer(api.make_app())
+        server.add_sockets([sock])
+        codes = []
+        for request in requests:
+            response = await AsyncHTTPClient().fetch(
+                f"http://127.0.0.1:{port}/analysis",
+                method="POST",
+                body=dumps(request),
+                raise_error=False,
+            )
+            codes.append(response.code)
+        server.stop()
+        return codes
+
+    return asyncio.run(run())
+
+
+def test_counts_after_rejections(clock, models_metadata):
+    from nmma_api.simulator.synthetic import synthetic_request
+
+    def request(i: int, **analysis_parameters) -> dict:
+        request = synthetic_request(i)
+        request["callback_url"] = f"http://127.0.0.1/webhook/{i}"
+        request["inputs"]["analysis_parameters"].update(analysis_parameters)
+        return request
+
+    invalid = [
+        request(0, source="unknown"),
+        request(1, photometry_max_points="x"),
+        {**request(2), "invalid_after": "not a date"},
+        {**request(3), "callback_method": "GET"},
+    ]
+    assert post_all(invalid * 3) == [400] * 12
+    assert admission.cached_counts()["backlog"] == 0
+
+    valid = [request(i) for i in range(4)]
+    assert post_all(valid) == [200, 200, 200, 429]
+    assert admission.cached_counts()["backlog"] == 3
+    assert admission.mongo.db.analysis.count_documents({"status": "pending"}) == 3
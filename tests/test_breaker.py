@@ -0,0 +1,95 @@
+import pytest
+
+from conftest import make_clock
+from nmma_api.tools import breaker
+
+HOST = "https://fritz.science"
+
+
+@pytest.fixture
+def clock(monkeypatch, mongo):
+    """The time seen by the breakers."""
+    return make_clock(monkeypatch, breaker)
+
+
+def state() -> str:
+    return breaker.mongo.db.breakers.find_one({"_id": HOST})["state"]
+
+
+def trip():
+    for _ in range(breaker.failure_threshold):
+        breaker.record(HOST, False)
+
+
+def test_closed(clock):
+    assert breaker.allow(HOST, "a")
+    for _ in range(breaker.failure_threshold - 1):
+        breaker.record(HOST, False)
+    assert state() == "closed"
+    assert breaker.allow(HOST, "a")
+    # the failures must be consecutive
+    breaker.record(HOST, True)
+    breaker.record(HOST, False)
+    assert state() == "closed"
+    assert breaker.blocked_hosts() == []
+
+
+def test_opens_after_consecutive_failures(clock):
+    trip()
+    assert state() == "open"
+    assert not breaker.allow(HOST, "a")
+    assert not breaker.allow(HOST, "b")
+    assert breaker.blocked_hosts() == [HOST]
+
+    clock.advance(breaker.open_duration - 1)
+    assert not breaker.allow(HOST, "a")
+
+
+def test_half_open_single_probe(clock):
+    trip()
+    clock.advance(breaker.open_duration + 1)
+    assert breaker.blocked_hosts() == []
+
+    # only the first worker asking gets to send the probe
+    assert breaker.allow(HOST, "a")
+    assert state() == "half_open"
+    assert not breaker.allow(HOST, "b")
+    assert not breaker.allow(HOST, "a")
+    assert breaker.blocked_hosts() == [HOST]
+
+    breaker.record(HOST, True)
+    assert state() == "closed"
+    assert breaker.allow(HOST, "b")
+    assert breaker.mongo.db.breakers.find_one({"_id": HOST})["failures"] == 0
+
+
+def test_failed_probe_reopens(clock):
+    trip()
+    clock.advance(breaker.open_duration + 1)
+    assert breaker.allow(HOST, "a")
+
+    # a single failure is enough, then wait for another open_duration
+    breaker.record(HOST, False)
+    assert state() == "open"
+    assert not breaker.allow(HOST, "b")
+    clock.advance(breaker.open_duration + 1)
+    assert breaker.allow(HOST, "b")
+
+
+def test_lost_probe(clock):
+    trip()
+    clock.advance(breaker.open_duration + 1)
+    assert breaker.allow(HOST, "a")
+
+    # the worker sending the probe died, another one probes once it timed out
+    clock.advance(breaker.probe_timeout - 1)
+    assert not breaker.allow(HOST, "b")
+    clock.advance(2)
+    assert breaker.allow(HOST, "b")
+    assert breaker.mongo.db.breakers.find_one({"_id": HOST})["probe_by"] == "b"
+
+
+def test_hosts_are_independent(clock):
+    trip()
+    assert breaker.allow("https://other.host", "a")
+    assert breaker.blocked_hosts() == [HOST]
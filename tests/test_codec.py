@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+import pytest
+
+from nmma_api.utils import codec
+from nmma_api.utils.codec import DecodeError, Field, SchemaError, check, decode
+
+SCHEMA = {
+    "inputs": Field(dict, schema={"redshift": Field((str, int, float))}),
+    "count": Field(int, required=False),
+    "flag": Field(bool, required=False),
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    """Run a test with orjson (if installed), and with the standard library."""
+    if request.param == "orjson":
+        if codec.orjson is None:
+            pytest.skip("orjson is not installed")
+    else:
+        monkeypatch.setattr(codec, "orjson", None)
+    return request.param
+
+
+def test_round_trip(backend):
+    obj = {"a": [1, 2.5, "é", None, True], "b": {"c": "d"}}
+    assert codec.loads(codec.dumps(obj)) == obj
+    assert codec.loads(codec.dumps(obj).decode()) == obj
+
+
+def test_dumps_numpy(backend):
+    data = {"array": np.arange(3), "scalar": np.float64(0.5)}
+    assert codec.loads(codec.dumps(data)) == {"array": [0, 1, 2], "scalar": 0.5}
+
+
+def test_dumps_nan_as_null():
+    if codec.orjson is None:
+        pytest.skip("orjson is not installed")
+    assert codec.dumps({"a": float("nan")}) == b'{"a":null}'
+
+
+def test_loads_nan_fallback(backend):
+    # not valid JSON (rejected by orjson), but decoded as the standard library does
+    obj = codec.loads(b'{"a": NaN, "b": Infinity, "c": -Infinity}')
+    assert math.isnan(obj["a"])
+    assert obj["b"] == math.inf and obj["c"] == -math.inf
+
+
+@pytest.mark.parametrize("data", [b"", b"{", b'{"a": }', b"[1, 2", b"nul"])
+def test_loads_invalid_json(backend, data):
+    with pytest.raises(DecodeError):
+        codec.loads(data)
+
+
+def test_loads_invalid_utf8(backend):
+    with pytest.raises(DecodeError, match="Invalid UTF-8"):
+        codec.loads(b'{"a": "\xff\xfe"}')
+
+
+def test_check_valid():
+    assert check({"inputs": {"redshift": "0.1"}}, SCHEMA) is None
+    assert check({"inputs": {"redshift": 0}, "count": 3, "flag": False}, SCHEMA) is None
+
+
+def test_check_bool_is_not_an_integer():
+    assert check({"inputs": {"redshift": 1}, "count": True}, SCHEMA) == (
+        "data_dict.count must be an integer"
+    )
+    assert check({"inputs": {"redshift": False}}, SCHEMA) == (
+        "data_dict.inputs.redshift must be a string or an integer or a number"
+    )
+    # unless it is one of the allowed types
+    assert check({"inputs": {"redshift": 1}, "flag": True}, SCHEMA) is None
+
+
+def test_check_errors():
+    assert check([], SCHEMA) == "data_dict must be an object"
+    assert check({}, SCHEMA) == "missing required key(s) ['inputs'] in data_dict"
+    assert check({"inputs": []}, SCHEMA) == "data_dict.inputs must be an object"
+    assert check({"inputs": {}}, SCHEMA) == (
+        "missing required key(s) ['redshift'] in data_dict.inputs"
+    )
+    assert check({"inputs": {"redshift": None}}, SCHEMA) == (
+        "data_dict.inputs.redshift must be a string or an integer or a number"
+    )
+
+
+def test_decode(backend):
+    assert decode(b'{"inputs": {"redshift": 0.1}}', SCHEMA) == {
+        "inputs": {"redshift": 0.1}
+    }
+    with pytest.raises(SchemaError, match="data_dict.count must be an integer"):
+        decode(b'{"inputs": {"redshift": 0.1}, "count": 1.5}', SCHEMA)
+    with pytest.raises(DecodeError):
+        decode(b'{"inputs": ', SCHEMA)
+    # no schema: any JSON document
+    assert decode(b"[1]") == [1]
@@ -0,0 +1,24 @@
+from nmma_api.services import delivery_queue
+from nmma_api.tools.outbox import enqueue
+
+
+def test_unsupported_callback_method(mongo):
+    analysis = {
+        "_id": 1,
+        "callback_url": "https://fritz.science/webhook",
+        "callback_method": "GET",
+        "status": "uploading",
+        "events": [],
+    }
+    mongo.db.analysis.insert_one(analysis)
+    enqueue(analysis, {"status": "success"}, "completed", "failed_upload")
+
+    # failed at once, without any attempt nor tripping the breaker of the host
+    assert delivery_queue.delivery_cycle() == 1
+    entry = mongo.db.outbox.find_one({"analysis_id": 1})
+    assert entry["status"] == "failed"
+    assert entry["nb_attempts"] == 0
+    assert entry["error"] == "callback method GET not supported"
+    assert mongo.db.analysis.find_one({"_id": 1})["status"] == "failed_upload"
+    assert mongo.db.breakers.count_documents({}) == 0
+    assert delivery_queue.slots._value == delivery_queue.max_concurrency
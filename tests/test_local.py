@@ -0,0 +1,81 @@
+import importlib
+import os
+
+import pytest
+
+from conftest import make_clock
+from nmma_api.utils.config import load_config
+
+ANALYSIS = {"resource_id": 1, "created_at": 2}
+
+
+@pytest.fixture
+def local(monkeypatch, tmp_path):
+    """The local backend, writing its job directories to a temporary directory."""
+    # the local section of the configuration is empty by default
+    for key, value in [
+        ("nmma_dir", str(tmp_path)),
+        ("data_dirname", "data"),
+        ("slurm_script_name", "run.sh"),
+    ]:
+        monkeypatch.setitem(load_config()["local"], key, value)
+    local = importlib.import_module("nmma_api.tools.local")
+    monkeypatch.setattr(local, "run_dir", str(tmp_path / "local_outputs"))
+    return local
+
+
+def job_dir(local, name: str, files: list[str], age: float = 0) -> str:
+    """A job directory with the given files, all last modified `age` seconds ago."""
+    path = os.path.join(local.run_dir, name)
+    os.makedirs(path)
+    modified_at = local.time.time() - age
+    for filename in files:
+        open(os.path.join(path, filename), "w").close()
+        os.utime(os.path.join(path, filename), (modified_at, modified_at))
+    os.utime(path, (modified_at, modified_at))
+    return path
+
+
+def test_release_keeps_cancelled_marker(local):
+    path = job_dir(local, "1_2", ["job.log", "1_2_result.json"])
+    os.makedirs(os.path.join(path, "checkpoint"))
+
+    local.LocalBackend().release(ANALYSIS)
+    # a job still queued in the pool must not start
+    assert os.listdir(path) == [local.CANCELLED_FILENAME]
+    # nothing to release
+    local.LocalBackend().release({"resource_id": 3, "created_at": 4})
+
+
+def test_release_skips_running_job(local):
+    path = job_dir(local, "1_2", ["job.log"])
+    with open(os.path.join(path, local.PID_FILENAME), "w") as f:
+        f.write(f"{os.getpid()} {local.process_start_time(os.getpid())}")
+
+    local.LocalBackend().release(ANALYSIS)
+    assert sorted(os.listdir(path)) == ["job.log", local.PID_FILENAME]
+
+
+def test_cleanup_retention(local, monkeypatch):
+    clock = make_clock(monkeypatch, local)
+    old = local.retention + 1
+    job_dir(local, "old_log", ["job.log", "1_2_result.json"], age=old)
+    job_dir(local, "old_cancelled", [local.CANCELLED_FILENAME], age=old)
+    job_dir(local, "old_empty", [], age=old)
+    # not a job directory
+    job_dir(local, "old_other", ["notes.txt"], age=old)
+    # the directory is old, but one of its files is not
+    recent = job_dir(local, "recent", ["job.log"], age=old)
+    os.utime(os.path.join(recent, "job.log"))
+
+    backend = local.LocalBackend()
+    backend.cleanup()
+    assert sorted(os.listdir(local.run_dir)) == ["old_other", "recent"]
+
+    # scanned again only after the interval
+    job_dir(local, "old_again", ["job.log"], age=old)
+    backend.cleanup()
+    assert "old_again" in os.listdir(local.run_dir)
+    clock.advance(local.cleanup_interval)
+    backend.cleanup()
+    assert "old_again" not in os.listdir(local.run_dir)
@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import make_clock
+from nmma_api.tools import outbox
+
+RESULTS = {"status": "success", "message": "done", "analysis": {}}
+
+
+@pytest.fixture
+def clock(monkeypatch, mongo):
+    """The time seen by the outbox, with a fixed backoff delay."""
+    monkeypatch.setattr(outbox, "backoff_delay", lambda attempt: 10)
+    return make_clock(monkeypatch, outbox)
+
+
+def add_analysis(_id: int, url: str = "https://fritz.science/webhook", **fields):
+    analysis = {
+        "_id": _id,
+        "callback_url": url,
+        "callback_method": "POST",
+        "status": "uploading",
+        "events": [],
+        **fields,
+    }
+    outbox.mongo.db.analysis.insert_one(analysis)
+    outbox.enqueue(
+        analysis,
+        RESULTS,
+        status_on_delivery="completed",
+        status_on_failure="failed_upload",
+    )
+    return analysis
+
+
+def entry(analysis_id: int) -> dict:
+    return outbox.mongo.db.outbox.find_one({"analysis_id": analysis_id})
+
+
+def analysis_status(_id: int) -> str:
+    return outbox.mongo.db.analysis.find_one({"_id": _id})["status"]
+
+
+def test_claim_is_exclusive(clock):
+    add_analysis(1)
+    claimed = outbox.claim("a")
+    assert claimed["analysis_id"] == 1
+    assert claimed["status"] == "delivering"
+    assert claimed["worker"] == "a"
+    assert claimed["lease_until"] == clock.now + outbox.lease_duration
+    assert outbox.claim("b") is None
+
+
+def test_claim_oldest_first(clock):
+    add_analysis(1)
+    clock.advance(1)
+    add_analysis(2)
+    assert outbox.claim("a")["analysis_id"] == 1
+    assert outbox.claim("a")["analysis_id"] == 2
+    assert outbox.claim("a") is None
+
+
+def test_claim_excluded_hosts(clock):
+    add_analysis(1)
+    assert outbox.claim("a", excluded_hosts=["https://fritz.science"]) is None
+    assert outbox.claim("a", excluded_hosts=["https://other.host"]) is not None
+
+
+def test_lease_expiry_and_reclaim(clock):
+    add_analysis(1)
+    claimed = outbox.claim("a")
+
+    # worker a is stuck (or died): its lease expires, and b reclaims the delivery
+    clock.advance(outbox.lease_duration - 1)
+    assert outbox.claim("b") is None
+    clock.advance(2)
+    reclaimed = outbox.claim("b")
+    assert reclaimed["_id"] == claimed["_id"]
+    assert reclaimed["worker"] == "b"
+
+    # a lost the lease: its outcome is ignored
+    outbox.record_attempt(claimed, "a", True, None, 0.1)
+    assert entry(1)["status"] == "delivering"
+    assert entry(1)["nb_attempts"] == 0
+    assert analysis_status(1) == "uploading"
+
+    outbox.record_attempt(reclaimed, "b", True, None, 0.1)
+    assert entry(1)["status"] == "done"
+    assert entry(1)["nb_attempts"] == 1
+    assert "results" not in entry(1)
+    assert analysis_status(1) == "completed"
+    assert outbox.claim("a") is None
+
+
+def test_release(clock):
+    add_analysis(1)
+    claimed = outbox.claim("a")
+    # only by the worker holding the lease
+    outbox.release(claimed, "b")
+    assert outbox.claim("b") is None
+    outbox.release(claimed, "a")
+    assert outbox.claim("b")["worker"] == "b"
+
+
+def test_failed_attempt_backoff(clock):
+    add_analysis(1)
+    outbox.record_attempt(outbox.claim("a"), "a", False, "status 500", 0.1)
+    assert entry(1)["status"] == "pending"
+    assert entry(1)["error"] == "status 500"
+    assert entry(1)["attempts"][0]["error"] == "status 500"
+
+    # retried once the backoff delay elapsed
+    assert outbox.claim("a") is None
+    clock.advance(10)
+    assert outbox.claim("a")["nb_attempts"] == 1
+
+
+def test_failed_for_good(clock):
+    add_analysis(1)
+    for _ in range(outbox.max_attempts):
+        claimed = outbox.claim("a")
+        outbox.record_attempt(claimed, "a", False, "status 500", 0.1)
+        clock.advance(10)
+    assert entry(1)["status"] == "failed"
+    assert entry(1)["nb_attempts"] == outbox.max_attempts
+    assert "results" not in entry(1)
+    assert analysis_status(1) == "failed_upload"
+    assert outbox.claim("a") is None
+
+
+def test_expire(clock):
+    past = datetime.utcnow() - timedelta(minutes=1)
+    future = datetime.utcnow() + timedelta(days=1)
+    add_analysis(1, invalid_after=past)
+    add_analysis(2, invalid_after=future)
+    add_analysis(3)
+
+    # an expired webhook is never claimed
+    claimed = [outbox.claim("a")["analysis_id"], outbox.claim("a")["analysis_id"]]
+    assert sorted(claimed) == [2, 3]
+    assert outbox.claim("a") is None
+
+    assert outbox.expire() == 1
+    assert entry(1)["status"] == "expired"
+    assert "results" not in entry(1)
+    assert analysis_status(1) == "webhook_expired"
+    assert analysis_status(2) == "uploading"
+    assert outbox.expire() == 0
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from nmma_api.utils.pipeline import Stage, run_pipeline
+
+
+def run(items, stages, queue_size: int = 8, timeout: float = 10) -> dict:
+    """Run a pipeline in a thread, failing (rather than hanging) if it doesn't shut down."""
+    outcome = {}
+
+    def target():
+        outcome["stats"] = run_pipeline(items, stages, queue_size)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline did not shut down"
+    assert not any(t.name.startswith("pipeline_") for t in threading.enumerate())
+    return outcome["stats"]
+
+
+def collector():
+    collected = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            collected.append(item)
+        return item
+
+    return collected, collect
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_all_items_go_through(workers):
+    collected, collect = collector()
+    stats = run(
+        range(50),
+        [
+            Stage("double", lambda x: 2 * x, workers),
+            Stage("increment", lambda x: x + 1, workers),
+            Stage("collect", collect, workers),
+        ],
+        queue_size=2,
+    )
+    assert sorted(collected) == [2 * x + 1 for x in range(50)]
+    assert {name: s["items"] for name, s in stats.items()} == {
+        "double": 50,
+        "increment": 50,
+        "collect": 50,
+    }
+
+
+def test_no_items():
+    stats = run([], [Stage("a", lambda x: x, 2), Stage("b", lambda x: x, 2)])
+    assert stats == {"a": {"items": 0, "busy": 0.0}, "b": {"items": 0, "busy": 0.0}}
+
+
+def test_dropped_and_failed_items():
+    def check(x):
+        if x % 3 == 0:
+            raise ValueError(f"invalid item {x}")
+        # dropped
+        return x if x % 3 == 1 else None
+
+    collected, collect = collector()
+    stats = run(range(30), [Stage("check", check, 2), Stage("collect", collect)])
+    assert sorted(collected) == list(range(1, 30, 3))
+    # the failed items are counted in the stage that failed, not passed on
+    assert stats["check"]["items"] == 30
+    assert stats["collect"]["items"] == 10
+
+
+def test_all_items_dropped():
+    collected, collect = collector()
+    run(range(20), [Stage("drop", lambda x: None, 4), Stage("collect", collect, 4)])
+    assert collected == []
+
+
+def test_bounded_queues():
+    # a slow stage makes the previous one wait, rather than piling up items
+    in_flight, max_in_flight = [0], [0]
+    lock = threading.Lock()
+
+    def produce(x):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        return x
+
+    def consume(x):
+        with lock:
+            in_flight[0] -= 1
+        time.sleep(0.005)
+        return x
+
+    run(range(40), [Stage("produce", produce), Stage("consume", consume)], 2)
+    # in the queue, or produced and waiting for room in it
+    assert max_in_flight[0] <= 2 + 1